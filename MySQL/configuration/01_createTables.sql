@@ -44,6 +44,7 @@ CREATE TABLE recetas_control (
     fecha_creada DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     cantidad_producida INT NOT NULL,
     PRIMARY KEY (id_receta_control),
+    INDEX (fecha_creada),
     FOREIGN KEY (id_receta_maestra) REFERENCES recetas_maestras (id_receta_maestra) ON UPDATE CASCADE ON DELETE RESTRICT,
     FOREIGN KEY (id_usuario) REFERENCES usuarios (id_usuario) ON UPDATE CASCADE ON DELETE RESTRICT
 );
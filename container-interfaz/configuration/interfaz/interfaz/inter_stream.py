@@ -398,7 +398,11 @@ if st.session_state.recetas and st.session_state.users:
 
 st.subheader("Panel de informes")
 if st.button("Sistema de informes"):
-        st.session_state.evento_queue2.put({"hmiEvent":"getControlRecipesList"})
+        # La lista llega por partes (listChunk), cada parte se muestra en cuanto llega
+        st.session_state.recetas_informes = []
+        st.session_state.id_lista_informes = st.session_state.get("id_lista_informes", 0) + 1
+        st.session_state.evento_queue2.put({"hmiEvent":"getControlRecipesList", "stream": True,
+                                            "requestId": st.session_state.id_lista_informes})
 mensajes2_box = st.empty()
 receta_id: int
 if st.session_state.recetas_informes:
@@ -502,6 +506,19 @@ while not st.session_state.mensaje_queue2.empty():
         st.session_state.fase_informe = "mostrar_mensaje"
         #st.session_state.nuevos_mensajes_informe = True  
 
+    # Partes de la lista; las de peticiones anteriores se descartan
+    if isinstance(nuevo, dict) and "listChunk" in nuevo:
+        if nuevo.get("requestId") == st.session_state.get("id_lista_informes"):
+            st.session_state.recetas_informes = st.session_state.recetas_informes + parsear_mensaje(nuevo["listChunk"])
+            st.session_state.fase_informe = "mostrar_mensaje"
+        continue
+
+    # Fin de la lista; si no se pudo enviar entera se avisa
+    if isinstance(nuevo, dict) and "listEnd" in nuevo:
+        if nuevo.get("requestId") == st.session_state.get("id_lista_informes") and nuevo.get("truncated"):
+            st.session_state.mensaj.append(f"Lista de recetas incompleta, recibidas {nuevo['listEnd']}")
+        continue
+
     nuevo = formato2(nuevo)
     st.session_state.mensaj.append(str(nuevo))
 
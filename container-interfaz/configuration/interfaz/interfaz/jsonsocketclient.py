@@ -1,6 +1,14 @@
 import asyncio
 import json
 
+# Reflex importa el modulo como interfaz.jsonsocketclient, Streamlit (inter_stream.py) como jsonsocketclient
+try:
+    from .socketcodecs import CODEC_JSON, getAvailableCodecs, getCodec
+except ImportError:
+    from socketcodecs import CODEC_JSON, getAvailableCodecs, getCodec
+
+# Segundos esperando la respuesta del servidor al pedir un codec
+CODEC_HANDSHAKE_TIMEOUT = 2
 
 
 
@@ -8,11 +16,15 @@ class JsonSocketClient:
     sms: str=""
     message_received_flag: bool = False
     #port= 10000
-    def __init__(self,host, port, EOM="\r\n", encoding="utf-8"):
+    def __init__(self,host, port, EOM="\r\n", encoding="utf-8", codec=CODEC_JSON):
         self._host = host
         self._port = port
         self._EOM = EOM
         self._encoding = encoding
+        # Se empieza siempre en json por lineas, el codec pedido se negocia al conectar
+        self._codec = getCodec(CODEC_JSON, EOM=EOM, encoding=encoding)
+        self._requestedCodec = codec
+        self._codecAgreed = None
         self._reader = None
         self._writer = None
         self.sendQueue = asyncio.Queue()
@@ -26,17 +38,39 @@ class JsonSocketClient:
         print("Conectado al servidor")
         self.conectado = True
         asyncio.create_task(self._readLoop())
+        if self._requestedCodec != CODEC_JSON and self._requestedCodec in getAvailableCodecs():
+            await self._negotiateCodec()
         asyncio.create_task(self._writeLoop())
 
+    async def _negotiateCodec(self):
+        # Se pide el codec y no se envia nada mas hasta tener respuesta
+        self._codecAgreed = asyncio.get_running_loop().create_future()
+        self._writer.write(self._codec.encode({"codec": self._requestedCodec}))
+        await self._writer.drain()
+        try:
+            codec = await asyncio.wait_for(self._codecAgreed, CODEC_HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("El servidor no responde al pedir codec, se usa json")
+            return
+        print("Codec:", codec)
+
     async def send(self, message: dict):
         await self.sendQueue.put(message)
 
     async def _readLoop(self):
         while True:
             try:
-                data = await self._reader.readuntil(self._EOM.encode(self._encoding))
-                message = json.loads(data.decode(self._encoding).removesuffix(self._EOM))
-                
+                data = await self._codec.readFrame(self._reader)
+                message = self._codec.decode(data)
+
+                # Respuesta del servidor al pedir codec, los siguientes mensajes ya vienen con el nuevo codec
+                if isinstance(message, dict) and list(message) == ["codec"] and self._codecAgreed is not None:
+                    if message["codec"] != CODEC_JSON:
+                        self._codec = getCodec(message["codec"])
+                    if not self._codecAgreed.done():
+                        self._codecAgreed.set_result(message["codec"])
+                    continue
+
                 with open('datos.json', 'w') as f:
                     json.dump(message, f)
 
@@ -58,7 +92,7 @@ class JsonSocketClient:
         while True:
             message = await self.sendQueue.get()
             try:
-                messageEncoded = (json.dumps(message) + self._EOM).encode(self._encoding)
+                messageEncoded = self._codec.encode(message)
                 self._writer.write(messageEncoded)
                 print("Enviando mensaje al servidor:", message)
                 await self._writer.drain()
@@ -69,18 +103,18 @@ class JsonSocketClient:
     def set_on_message(self, callback):
         self.on_message = callback
 
-def iniciar_cliente_socket(nombre_servidor, evento_queue, mensaje_queue, puerto):
+def iniciar_cliente_socket(nombre_servidor, evento_queue, mensaje_queue, puerto, codec=CODEC_JSON):
     import threading
     def _run():
         asyncio.set_event_loop(asyncio.new_event_loop())
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(run_cliente(nombre_servidor, evento_queue, mensaje_queue, puerto))
+        loop.run_until_complete(run_cliente(nombre_servidor, evento_queue, mensaje_queue, puerto, codec))
 
     threading.Thread(target=_run).start()
 
-async def run_cliente(nombre_servidor, evento_queue, mensaje_queue, puerto):
+async def run_cliente(nombre_servidor, evento_queue, mensaje_queue, puerto, codec=CODEC_JSON):
     import queue
-    cliente = JsonSocketClient(nombre_servidor, port=puerto)
+    cliente = JsonSocketClient(nombre_servidor, port=puerto, codec=codec)
     await cliente.connect()
     cliente.set_on_message(lambda msg: mensaje_queue.put(msg))
 
@@ -1,9 +1,24 @@
 import asyncio
+import logging
 
 from jsonsocketserver import JsonSocketServer
-from mysqlclient import mysqlQuery
+from mysqlclient import mysqlPreparedQuery, mysqlQuery
 
 PORT = 10001
+# Control recipes sent in each page (or chunk, when streaming) if the request doesn't give pageSize
+LIST_PAGE_SIZE = 500
+# Maximum pageSize accepted in a request
+LIST_MAX_PAGE_SIZE = 5000
+# Filters of getControlRecipesList, as (event key, condition on the query)
+LIST_FILTERS = [
+    ("from", "recetas_control.fecha_creada >= %s"),
+    ("to", "recetas_control.fecha_creada < %s"),
+    ("masterRecipe", "recetas_maestras.codigo_receta_maestra = %s"),
+    ("user", "usuarios.nombre = %s")
+]
+# Indexes used by the queries, as (table, column). The database is only built from
+# MySQL/configuration/01_createTables.sql the first time, so they are added on start if missing
+INDEXES = [("recetas_control", "fecha_creada")]
 
 
 class EventHandler:
@@ -18,49 +33,151 @@ class EventHandler:
 
                 if (type == "hmiEvent"):
                     if (event[type] == "getControlRecipesList"):
-                        list = await self._getControlRecipesList()
-                        asyncio.create_task(
-                            self._server.sendQueue.put({"list": list}))
+                        if (event.get("stream", False)):
+                            # Streams go at the pace the client reads them, so each runs in its own task
+                            # and a slow client doesn't hold back the requests of the others
+                            task = asyncio.create_task(self._streamControlRecipesList(event))
+                            self._streamTasks.add(task)
+                            task.add_done_callback(self._streamTasks.discard)
+                        else:
+                            try:
+                                list, cursor = await self._getControlRecipesList(event)
+                                self._server.send(event["clientId"], {"list": list, "next": cursor})
+                            except (ValueError, TypeError, KeyError) as e:
+                                self._sendInvalidRequest(event["clientId"], e)
                     elif (event[type] == "getControlRecipeDetails"):
                         id = event["controlRecipeID"]
                         details = await self._getControlRecipeDetails(id)
-                        asyncio.create_task(
-                            self._server.sendQueue.put({"details": details}))
+                        self._server.send(event["clientId"], {"details": details})
 
     def __init__(self, socketServer: JsonSocketServer):
         self._eventQueue = asyncio.Queue()
         self._server = socketServer
+        # Tasks sending streamed lists
+        self._streamTasks = set()
+        self._logger = logging.getLogger("EventHandler")
 
-    async def _getControlRecipesList(self):
-        """Gets list of control recipes
+    async def _getControlRecipesList(self, request: dict):
+        """Gets a page of the list of control recipes, newest first.
+
+        Pages are read by keyset (fecha_creada, id_receta_control): each page starts right after
+        the last row of the previous one, so reading a page doesn't get slower the further it is.
+
+        Args:
+            request (dict): getControlRecipesList event, see loop().
+
+        Raises:
+            ValueError: Wrong pageSize or cursor.
+            KeyError: Cursor without "date" or "id".
 
         Returns:
-            List[dict]: Control recipes:
+            Tuple[List[dict], dict]: Control recipes and cursor of the next page (None if this is the last one):
                 [
-                    {"id": ID_1, "masterRecipe": MASTER_RECIPE_NAME_1, "date": DATE_1},
-                    {"id": ID_2, "masterRecipe": MASTER_RECIPE_NAME_2, "date": DATE_2},
+                    {"id": ID_1, "masterRecipe": MASTER_RECIPE_NAME_1, "user": USER_1, "date": DATE_1},
+                    {"id": ID_2, "masterRecipe": MASTER_RECIPE_NAME_2, "user": USER_2, "date": DATE_2},
                     ...
-                ]
+                ], {"date": DATE_N, "id": ID_N}
         """
-        controlRecipes = await mysqlQuery(
+        pageSize = int(request.get("pageSize", LIST_PAGE_SIZE))
+        if ((pageSize < 1) or (pageSize > LIST_MAX_PAGE_SIZE)):
+            raise ValueError("pageSize must be from 1 to %d." % LIST_MAX_PAGE_SIZE)
+
+        # Query depends on the filters used, one prepared statement for each combination
+        name = "controlRecipesList"
+        conditions = []
+        params = []
+        for (key, condition) in LIST_FILTERS:
+            if (request.get(key) != None):
+                name = name + "_" + key
+                conditions.append(condition)
+                params.append(str(request[key]))
+        after = request.get("after")
+        if (after != None):
+            name = name + "_after"
+            conditions.append("((recetas_control.fecha_creada < %s) OR "
+                              "(recetas_control.fecha_creada = %s AND recetas_control.id_receta_control < %s))")
+            params.extend([str(after["date"]), str(after["date"]), int(after["id"])])
+        where = ("WHERE " + " AND ".join(conditions)) if (len(conditions) > 0) else ""
+        # One row more than the page, to know if there is a next page
+        params.append(pageSize + 1)
+
+        controlRecipes = await mysqlPreparedQuery(
+            name,
             """
             SELECT recetas_control.id_receta_control, recetas_maestras.codigo_receta_maestra,
-                recetas_control.fecha_creada
+                usuarios.nombre, recetas_control.fecha_creada
             FROM recetas_control
             INNER JOIN recetas_maestras
                 ON recetas_control.id_receta_maestra = recetas_maestras.id_receta_maestra
-            """
+            INNER JOIN usuarios
+                ON recetas_control.id_usuario = usuarios.id_usuario
+            %s
+            ORDER BY recetas_control.fecha_creada DESC, recetas_control.id_receta_control DESC
+            LIMIT %%s
+            """ % where,
+            params
         )
-        # Values are a list of tuples [(ID_1,RECIPE_NAME_1,DATE_1),(ID_2,RECIPE_NAME_2,DATE_2),...]
-        controlRecipes = [dict(zip(("id", "masterRecipe", "date"), x))
+        # Values are a list of tuples [(ID_1,RECIPE_NAME_1,USER_1,DATE_1),(ID_2,RECIPE_NAME_2,USER_2,DATE_2),...]
+        controlRecipes = [dict(zip(("id", "masterRecipe", "user", "date"), x))
                           for x in controlRecipes]
         # Date to string so that it can be encoded by socket server
         for i in controlRecipes:
             i["date"] = str(i["date"])
-        return controlRecipes
+        nextCursor = None
+        if (len(controlRecipes) > pageSize):
+            controlRecipes = controlRecipes[:pageSize]
+            nextCursor = {"date": controlRecipes[-1]["date"], "id": controlRecipes[-1]["id"]}
+        return controlRecipes, nextCursor
+
+    async def _streamControlRecipesList(self, request: dict):
+        """Send every control recipe matching the filters of the request, one page per message,
+        so that the client can show them while the next pages are read. Each page is sent once
+        there is room in the client's queue. The stream always ends with a "listEnd" message,
+        marked as truncated if a page couldn't be read or sent.
+
+        Args:
+            request (dict): getControlRecipesList event, see loop().
+        """
+        clientId = request["clientId"]
+        requestId = request.get("requestId")
+        request = dict(request)
+        count = 0
+        truncated = False
+        try:
+            while True:
+                controlRecipes, nextCursor = await self._getControlRecipesList(request)
+                if (len(controlRecipes) > 0):
+                    if (not await self._server.waitForRoom(clientId)):
+                        self._logger.debug("Client %s disconnected during stream of control recipes." % clientId)
+                        return
+                    if (not self._server.send(clientId, {"listChunk": controlRecipes, "requestId": requestId})):
+                        self._logger.warning("Stream of control recipes to client %s stopped after %d." % (clientId, count))
+                        truncated = True
+                        break
+                    count = count + len(controlRecipes)
+                if (nextCursor == None):
+                    break
+                request["after"] = nextCursor
+        except (ValueError, TypeError, KeyError) as e:
+            self._sendInvalidRequest(clientId, e)
+            return
+        except Exception:
+            self._logger.exception("Stream of control recipes to client %s failed after %d." % (clientId, count))
+            truncated = True
+        message = {"listEnd": count, "requestId": requestId}
+        if (truncated):
+            message["truncated"] = True
+        self._server.send(clientId, message)
+
+    def _sendInvalidRequest(self, clientId: int, error: Exception):
+        """Answer a getControlRecipesList request with wrong params.
+        """
+        self._logger.warning("Invalid getControlRecipesList request: %s" % error)
+        self._server.send(clientId, {"error": "invalidRequest", "message": str(error)})
 
     async def _getControlRecipeDetails(self, id: int):
-        details = await mysqlQuery(
+        details = await mysqlPreparedQuery(
+            "controlRecipeDetails",
             """
             SELECT recetas_maestras.codigo_receta_maestra, usuarios.nombre,
                 recetas_control.fecha_creada, recetas_control.cantidad_producida
@@ -77,7 +194,8 @@ class EventHandler:
             zip(("masterRecipe", "user", "date", "produced"), details[0]))
         # Date to string so that it can be encoded by socket server
         details["date"] = str(details["date"])
-        paramValues = await mysqlQuery(
+        paramValues = await mysqlPreparedQuery(
+            "controlRecipeParameterValues",
             """
             SELECT parametros.nombre, valores_parametros.valor
             FROM valores_parametros
@@ -93,7 +211,8 @@ class EventHandler:
             paramValuesDict[i[0]] = i[1]
         details["parameterValues"] = paramValuesDict
 
-        alarms = await mysqlQuery(
+        alarms = await mysqlPreparedQuery(
+            "controlRecipeAlarms",
             """
             SELECT id_alarma,descripcion,fecha
             FROM alarmas
@@ -108,8 +227,30 @@ class EventHandler:
 
         return details
 
+async def addMissingIndexes():
+    """Add the indexes of INDEXES that the database doesn't have. Can be run any number of times.
+    Sql client will raise error on timeout or conection error.
+    """
+    for (table, column) in INDEXES:
+        found = await mysqlQuery(
+            """
+            SELECT COUNT(*)
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s AND seq_in_index = 1
+            """,
+            (table, column)
+        )
+        if (found[0][0] == 0):
+            logging.getLogger("productionlogs").warning("Adding index on %s.%s." % (table, column))
+            await mysqlQuery("ALTER TABLE %s ADD INDEX (%s)" % (table, column))
+
 async def main():
     await asyncio.sleep(5)
+    try:
+        await addMissingIndexes()
+    except Exception:
+        # Queries still work without them, only slower
+        logging.getLogger("productionlogs").exception("Could not add missing indexes.")
     
     server = JsonSocketServer(PORT)
     eventHandler = EventHandler(server)
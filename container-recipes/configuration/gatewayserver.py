@@ -0,0 +1,189 @@
+import csv
+import logging
+import os
+
+from asyncua import Server, uamethod
+from asyncua.ua import NodeId, Variant, VariantType
+from mysqlclient import mysqlQuery
+from opcuaclient import GATEWAY_NODE_ID
+from plantsimulator import PlantSimulator, STATE_COMPLETE, STATE_IDLE
+
+# Endpoint of the server, same port as the Node-RED gateway
+GATEWAY_ENDPOINT = "opc.tcp://0.0.0.0:54840"
+# Opcua types of the variable types in table variables_me, as converted by the gateway
+VARIABLE_TYPES = {
+    "BOOL": VariantType.Boolean,
+    "DWORD": VariantType.Int32,
+    "INT": VariantType.Int16,
+    "REAL": VariantType.Double
+}
+# Variables of each equipment module used when they are not loaded from variables_me,
+# (name, type, permission)
+DEFAULT_VARIABLES = [
+    ("Evento", "INT", "W"),
+    ("NumSRV", "INT", "W"),
+    ("EstadoActual", "INT", "R"),
+    ("ServicioActual", "INT", "R")
+]
+
+
+class GatewayServer:
+    """Opcua server standing in for the Node-RED gateway, backed by a PlantSimulator.
+
+    Exposes the same address space: gateway object GATEWAY_NODE_ID with one object per equipment
+    module, holding the variables of table variables_me, and methods IniciarFase, CompletarFase,
+    ResetModulo and AbortarModulos, which return True if the gateway would have sent the event to the module.
+    Variables driven by the simulator (EstadoActual, ServicioActual) are written on every change, so
+    subscriptions are notified as with the plant. The rest keep their initial value.
+    """
+
+    async def loadVariablesFromDatabase(self):
+        """Load the variables of the equipment modules from table variables_me.
+        Sql client will raise error on timeout or conection error.
+        """
+        rows = await mysqlQuery("""
+            SELECT modulos_equipamiento.codigo_modulo_equipamiento, variables_me.codigo_variable_me, variables_me.node_id_variable_me,
+                variables_me.tipo, variables_me.permiso
+            FROM variables_me
+            INNER JOIN modulos_equipamiento ON variables_me.id_modulo_equipamiento = modulos_equipamiento.id_modulo_equipamiento;
+        """)
+        self._variables = [tuple(row) for row in rows]
+        self._logger.debug("Loaded %d variables from database." % len(rows))
+
+    def loadVariablesFromCsv(self, directory: str):
+        """Load the variables of the equipment modules from the csv files the database is built from
+        (modulos_equipamiento.csv and variables_me.csv).
+
+        Args:
+            directory (str): Folder of the csv files.
+        """
+        with open(os.path.join(directory, "modulos_equipamiento.csv"), newline="", encoding="utf-8") as file:
+            modules = {row["id_modulo_equipamiento"]: row["codigo_modulo_equipamiento"]
+                       for row in csv.DictReader(file, delimiter=";")}
+        with open(os.path.join(directory, "variables_me.csv"), newline="", encoding="utf-8") as file:
+            self._variables = [(modules[row["id_modulo_equipamiento"]], row["codigo_variable_me"], row["node_id_variable_me"],
+                                row["tipo"], row["permiso"])
+                               for row in csv.DictReader(file, delimiter=";")]
+        self._logger.debug("Loaded %d variables from %s." % (len(self._variables), directory))
+
+    async def start(self):
+        """Build the address space and start serving.
+        """
+        self._server = Server()
+        await self._server.init()
+        self._server.set_endpoint(self._endpoint)
+        self._server.set_server_name("Spinners gateway simulator")
+
+        # Gateway objects and variables go in the server's own namespace (1), as in the gateway
+        gateway = await self._server.nodes.objects.add_object(NodeId.from_string(GATEWAY_NODE_ID), "1:PasarelaModbusOPCUA")
+        moduleNodes = {}
+        for module in self.simulator.getModules():
+            moduleNodes[module] = await gateway.add_object(NodeId(module, 1), f"1:{module}")
+        for (module, variable, nodeId, variableType, permission) in self._variables:
+            if (module not in moduleNodes):
+                continue
+            variantType = VARIABLE_TYPES.get(variableType, VariantType.Int16)
+            node = await moduleNodes[module].add_variable(
+                NodeId.from_string(nodeId), f"1:{variable}", Variant(self._initialValue(module, variable, variantType), variantType))
+            if (permission == "W"):
+                await node.set_writable()
+            self._nodes[(module, variable)] = (node, variantType)
+
+        await gateway.add_method(1, "IniciarFase", self._startPhase,
+                                 [VariantType.String, VariantType.UInt16, VariantType.UInt32], [VariantType.Boolean])
+        await gateway.add_method(1, "CompletarFase", self._completePhase, [VariantType.String], [VariantType.Boolean])
+        await gateway.add_method(1, "ResetModulo", self._resetModule, [VariantType.String], [VariantType.Boolean])
+        await gateway.add_method(1, "AbortarModulos", self._abortModules, [], [VariantType.Boolean])
+
+        self.simulator.addListener(self._onVariableChanged)
+        await self._server.start()
+        self._logger.info("Serving simulated gateway on %s." % self._endpoint)
+
+    async def stop(self):
+        """Stop serving.
+        """
+        if (self._server != None):
+            await self._server.stop()
+            self._server = None
+
+    def getStats(self):
+        """Get method calls served and simulation metrics.
+
+        Returns:
+            Dict: {"methodCalls": {"METHOD_NAME": Calls, ...}, plus the metrics of PlantSimulator.getStats()}
+        """
+        stats = self.simulator.getStats()
+        stats["methodCalls"] = dict(self._methodCalls)
+        return stats
+
+    def __init__(self, simulator: PlantSimulator = None, endpoint: str = GATEWAY_ENDPOINT):
+        """Constructor.
+
+        Args:
+            simulator (PlantSimulator, optional): Simulated plant. Defaults to None, a new one.
+            endpoint (str, optional): Endpoint to serve on. Defaults to GATEWAY_ENDPOINT.
+        """
+        self.simulator = simulator if (simulator != None) else PlantSimulator()
+        self._endpoint = endpoint
+        self._logger = logging.getLogger("GatewayServer")
+        self._server = None
+        self._variables = [(module, variable, f"ns=1;s={module}_{variable}", variableType, permission)
+                           for module in self.simulator.getModules()
+                           for (variable, variableType, permission) in DEFAULT_VARIABLES]
+        # Node and type of each (module, variable)
+        self._nodes = {}
+        self._methodCalls = {"IniciarFase": 0, "CompletarFase": 0, "ResetModulo": 0, "AbortarModulos": 0}
+
+    def _initialValue(self, module: str, variable: str, variantType: VariantType):
+        if (variable == "EstadoActual"):
+            return self.simulator.getState(module)
+        if (variable == "ServicioActual"):
+            return self.simulator.getCurrentService(module)
+        if (variantType == VariantType.Boolean):
+            return False
+        if (variantType == VariantType.Double):
+            return 0.0
+        return 0
+
+    async def _onVariableChanged(self, module: str, variable: str, value: int):
+        """Listener of the simulator, writes the new value to the node.
+        """
+        entry = self._nodes.get((module, variable))
+        if (entry != None):
+            (node, variantType) = entry
+            await node.write_value(Variant(value, variantType))
+
+    @uamethod
+    async def _startPhase(self, parent: NodeId, module: str, numSrv: int, setpoint: int):
+        self._methodCalls["IniciarFase"] += 1
+        if ((module not in self.simulator.getModules()) or (self.simulator.getState(module) != STATE_IDLE)):
+            return False
+        try:
+            await self.simulator.startPhase(module, numSrv, setpoint)
+        except ValueError as e:
+            self._logger.warning("IniciarFase %s: %s" % (module, e))
+            return False
+        return True
+
+    @uamethod
+    async def _completePhase(self, parent: NodeId, module: str):
+        self._methodCalls["CompletarFase"] += 1
+        # The gateway only completes phases in complete state, aborted modules need ResetModulo
+        if ((module not in self.simulator.getModules()) or (self.simulator.getState(module) != STATE_COMPLETE)):
+            return False
+        await self.simulator.completePhase(module)
+        return True
+
+    @uamethod
+    async def _resetModule(self, parent: NodeId, module: str):
+        self._methodCalls["ResetModulo"] += 1
+        if (module not in self.simulator.getModules()):
+            return False
+        await self.simulator.resetModule(module)
+        return True
+
+    @uamethod
+    async def _abortModules(self, parent: NodeId):
+        self._methodCalls["AbortarModulos"] += 1
+        await self.simulator.abortModules()
+        return True
@@ -1,47 +1,407 @@
 import asyncio
-import copy
 import logging
-from mysqlclient import mysqlQuery
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+from mysqlclient import mysqlMultipleQueries, mysqlPreparedQuery
+from referencedata import getReferenceData
+
+
+@dataclass(frozen=True, slots=True)
+class EquipmentPhase:
+    """Equipment phase launched by a state of a master recipe.
+
+    Attributes:
+        me (str): Equipment module code, e.g. "ME_BASES".
+        numSrv (int): Service number.
+        setpointParam (str): Name of the recipe parameter that gives the setpoint, or None.
+        defaultSetpoint (int | float): Setpoint used if the parameter is not given, or None.
+    """
+    me: str
+    numSrv: int
+    setpointParam: str = None
+    defaultSetpoint: int | float = None
+
+
+@dataclass(frozen=True, slots=True)
+class Transition:
+    """Transition between two states of a master recipe.
+
+    Attributes:
+        name (str): Auto-generated name, e.g. "tran_E0_E1".
+        initialState (str): State the transition comes from.
+        finalState (str): State the transition goes to.
+    """
+    name: str
+    initialState: str
+    finalState: str
+
+
+@dataclass(frozen=True, slots=True)
+class MasterRecipe:
+    """Immutable master recipe. Recipes are shared between readers without copying,
+    so none of their fields may be modified.
+
+    Attributes:
+        name (str): Recipe name (MySQL column "codigo_receta_maestra").
+        description (str): Recipe description.
+        states (tuple[str]): State names, e.g. ("E0", "E1", "E2").
+        initialState (str): Name of the initial state.
+        finalState (str): Name of the final state.
+        actions (Mapping[str, tuple[EquipmentPhase]]): Read-only mapping of state name to the phases it launches.
+        transitions (tuple[Transition]): Transitions between states.
+        parameters (tuple[tuple[str, str]]): (name, type) of each parameter, e.g. (("REPETICIONES", "INT"),).
+        version (str): Version stamp of the recipe's rows in the database.
+    """
+    name: str
+    description: str
+    states: tuple[str, ...]
+    initialState: str
+    finalState: str
+    actions: Mapping[str, tuple[EquipmentPhase, ...]]
+    transitions: tuple[Transition, ...]
+    parameters: tuple[tuple[str, str], ...]
+    version: str = None
+
+    @classmethod
+    def fromDict(cls, name: str, recipe: dict, version: str = None):
+        """Build an immutable recipe from the dict assembled when querying the database.
+
+        Args:
+            name (str): Recipe name.
+            recipe (dict): Recipe dict:
+                {
+                    "description" : "aeiou",
+                    "states" : ['E0', 'E1', 'E2', ...],
+                    "initialState" : "E0",
+                    "finalState" : "E5"
+                    "actions" : {
+                        "E0" : [{"me" : "ME_CODE_1", "numSrv" : numSrv1, "setpoint_param": None, "default_setpoint": None}],
+                        ...
+                    },
+                    "transitions" : [{"name" : "tran_E0_E1", "initialState" : "E0", "finalState" : E1}, ...],
+                    "parameters" : [("PARAM_1_NAME", "PARAM_1_TYPE"), ...]
+                }
+            version (str, optional): Version stamp. Defaults to None.
+
+        Returns:
+            MasterRecipe: Recipe.
+        """
+        actions = dict()
+        for stateName, phases in recipe["actions"].items():
+            actions[stateName] = tuple(
+                EquipmentPhase(
+                    me=x["me"],
+                    numSrv=x["numSrv"],
+                    setpointParam=x["setpoint_param"],
+                    defaultSetpoint=x["default_setpoint"])
+                for x in phases)
+        return cls(
+            name=name,
+            description=recipe["description"],
+            states=tuple(recipe["states"]),
+            initialState=recipe["initialState"],
+            finalState=recipe["finalState"],
+            actions=MappingProxyType(actions),
+            transitions=tuple(Transition(**x) for x in recipe["transitions"]),
+            parameters=tuple(tuple(x) for x in recipe["parameters"]),
+            version=version
+        )
 
 
 class MasterRecipeFinder:
     """Gets information about all master recipes in mysql database.
 
-    Recipe data is stored as a dict:
+    Recipes are stored as a read-only mapping of recipe name to immutable MasterRecipe objects:
 
         masterRecipes = {
-        "RECIPE_1" : {
-            "description" : "aeiou",
-            "states" : ['E0', 'E1', 'E2', ...],
-            "initialState" : "E0",
-            "finalState" : "E5"
-            "actions" : {
-                "E0" : [{"me" : "ME_CODE_1", "numSrv" : numSrv1, "setpoint_param": None, "default_setpoint": None}],
-                "E1" : [{"me" : "ME_CODE_2", "numSrv" : numSrv2, "setpoint_param": None, "default_setpoint": 30},
-                        {"me" : "ME_CODE_3", "numSrv" : numSrv3, "setpoint_param": "PARAM_6_NAME", "default_setpoint": -9.5}, ...]
+        "RECIPE_1" : MasterRecipe(
+            name="RECIPE_1",
+            description="aeiou",
+            states=('E0', 'E1', 'E2', ...),
+            initialState="E0",
+            finalState="E5",
+            actions={
+                "E0" : (EquipmentPhase(me="ME_CODE_1", numSrv=numSrv1, setpointParam=None, defaultSetpoint=None),),
+                "E1" : (EquipmentPhase(me="ME_CODE_2", numSrv=numSrv2, setpointParam=None, defaultSetpoint=30),
+                        EquipmentPhase(me="ME_CODE_3", numSrv=numSrv3, setpointParam="PARAM_6_NAME", defaultSetpoint=-9.5), ...)
                 ...
             },
-            "transitions" : [{"name" : "tran_E0_E1", "initialState" : "E0", "finalState" : E1},
-                             {"name" : "tran_E1_E2", "initialState" : "E1", "finalState" : E2}, ...],
-            "parameters" : {"PARAM_1_NAME" : "PARAM_1_TYPE",
-                            "PARAM_2_NAME" : "PARAM_2_TYPE", ...}
-        },
-        "RECIPE_2" : {...},
+            transitions=(Transition(name="tran_E0_E1", initialState="E0", finalState="E1"),
+                         Transition(name="tran_E1_E2", initialState="E1", finalState="E2"), ...),
+            parameters=(("PARAM_1_NAME", "PARAM_1_TYPE"),
+                        ("PARAM_2_NAME", "PARAM_2_TYPE"), ...),
+            version="..."
+        ),
+        "RECIPE_2" : MasterRecipe(...),
         ...
         }
+
+    Updating the recipes builds a new mapping (reusing the unchanged MasterRecipe objects)
+    and swaps it in with a single assignment, so readers never need to copy or lock.
     """
 
     async def updateMasterRecipes(self):
-        """Queries database and retrieves data about all master recipes.
+        """Queries database and retrieves data about master recipes that changed since the last update.
+
+        A version stamp (checksum of the recipe's rows in recetas_maestras, etapas, fases_etapas,
+        transiciones and parametros) is queried for every recipe. Only recipes that are new or whose
+        version changed are reloaded; recipes that no longer exist are dropped.
+
+        In bulk mode, recipes are fetched with a fixed number of set-based queries sent in a single round trip.
+        Otherwise, each recipe is queried one by one. If recipes changed since the last update, the
+        IDs cached by the reference data cache (see referencedata.py) are reloaded on their next lookup.
+
+        Updates run one at a time. A caller that had to wait queries the versions again once the
+        previous update is done, so the recipes that update reloaded aren't reloaded again.
 
         The sql client will raise error on timeout or conection error.
         """
-        self._logger.debug("Querying master recipes.")
+        async with self._updateLock:
+            invalidations = self._invalidations
+            self._logger.debug("Querying master recipe versions.")
+            versions = await self._queryRecipeVersions()
+
+            changedRecipes = [name for name in versions if self._versions.get(name) != versions[name][1]]
+            removedRecipes = [name for name in self._versions if name not in versions]
+            if ((self._masterRecipes != None) and (not changedRecipes) and (not removedRecipes)):
+                self._logger.debug("Master recipes have not changed.")
+                self._cacheHits = self._cacheHits + 1
+                return
+
+            self._cacheMisses = self._cacheMisses + 1
+            if (self._masterRecipes != None):
+                # Recipes or their parameters changed, IDs cached for the storer may be stale
+                getReferenceData().invalidate()
+            self._logger.debug("Querying master recipes %s." % changedRecipes)
+            if (self._bulkLoad):
+                queriedRecipes = await self._queryMasterRecipesBulk(
+                    recipeIDs=[versions[name][0] for name in changedRecipes])
+            else:
+                queriedRecipes = await self._queryMasterRecipesOneByOne(recipeNames=changedRecipes)
+            self._reloadedRecipes = self._reloadedRecipes + len(changedRecipes)
+
+            # Keep unchanged recipes, replace the rest
+            if (self._masterRecipes != None):
+                recipes = {name: recipe for name, recipe in self._masterRecipes.items() if name in versions}
+            else:
+                recipes = dict()
+            for name, recipe in queriedRecipes.items():
+                recipes[name] = MasterRecipe.fromDict(name, recipe, versions[name][1])
+
+            if (self._invalidations == invalidations):
+                self._versions = {name: versions[name][1] for name in versions}
+            else:
+                # invalidate() was called while querying, what was loaded may already be stale
+                self._versions = dict()
+            # Readers holding the previous mapping keep a consistent snapshot
+            self._masterRecipes = MappingProxyType(recipes)
+
+    def invalidate(self, masterRecipeName: str = None):
+        """Forget the version of a recipe (or of all recipes),
+        so that it is reloaded on the next call to updateMasterRecipes().
+
+        Args:
+            masterRecipeName (str, optional): Recipe to reload. Defaults to None (reload all recipes).
+        """
+        self._invalidations = self._invalidations + 1
+        if (masterRecipeName == None):
+            self._versions = dict()
+        else:
+            self._versions.pop(masterRecipeName, None)
+
+    def getCacheStats(self):
+        """Get counters of the master recipe cache.
+
+        Returns:
+            Dict: {"hits": Updates where nothing had changed,
+                   "misses": Updates that had to reload recipes,
+                   "reloadedRecipes": Total number of recipes reloaded}
+        """
+        return {
+            "hits": self._cacheHits,
+            "misses": self._cacheMisses,
+            "reloadedRecipes": self._reloadedRecipes
+        }
+
+    async def getMasterRecipes(self):
+        """Get saved master recipes.
+
+        Returns:
+            Mapping[str, MasterRecipe]: Read-only snapshot of the recipes. Will be None if updateMasterRecipes() has never been called.
+        """
+        return self._masterRecipes
+
+    async def updateAndGetMasterRecipes(self):
+        """Queries database and retrieves data about master recipes that changed since the last update.
+
+        The sql client will raise error on timeout or conection error.
+
+        Returns:
+            Mapping[str, MasterRecipe]: Read-only snapshot of the recipes.
+        """
+        await self.updateMasterRecipes()
+        return await self.getMasterRecipes()
+
+    def __init__(self, bulkLoad: bool = True):
+        """Constructor.
+
+        Args:
+            bulkLoad (bool, optional): Load all recipes with a single round trip to the database,
+                instead of querying each recipe separately. Defaults to True.
+        """
+        self._bulkLoad = bulkLoad
+        self._masterRecipes = None
+        # Version stamp of each loaded recipe
+        self._versions = dict()
+        self._cacheHits = 0
+        self._cacheMisses = 0
+        self._reloadedRecipes = 0
+        # Times invalidate() was called, to know if it was called during an update
+        self._invalidations = 0
+        self._updateLock = asyncio.Lock()
+        self._logger = logging.getLogger("MasterRecipeFinder")
+
+    async def _queryMasterRecipesBulk(self, recipeIDs: list[int] = None):
+        """Query master recipes with one set-based query per table, sent in a single round trip,
+        and assemble the recipes dict in memory. Sql client will raise error on timeout or conection error.
+
+        Args:
+            recipeIDs (list[int], optional): Recipes to query (MySQL column "id_receta_maestra").
+                Defaults to None (all recipes).
+
+        Returns:
+            Dict: Master recipes dict.
+        """
+        if (recipeIDs == None):
+            recipeFilter = ""
+            params = None
+        elif (len(recipeIDs) == 0):
+            return dict()
+        else:
+            placeholders = ", ".join(["%s"] * len(recipeIDs))
+            recipeFilter = "WHERE {table}.id_receta_maestra IN (%s)" % placeholders
+            # Same filter in each of the 5 statements
+            params = tuple(recipeIDs) * 5
+
+        recipesRows, statesRows, actionsRows, transitionsRows, parametersRows = await mysqlMultipleQueries(
+            """
+            SELECT id_receta_maestra, codigo_receta_maestra, descripcion
+            FROM recetas_maestras
+            {recipesFilter}
+            ORDER BY id_receta_maestra;
+
+            SELECT id_etapa, id_receta_maestra, nombre, es_inicial, es_final
+            FROM etapas
+            {statesFilter}
+            ORDER BY id_etapa;
+
+            SELECT fases_etapas.id_etapa, modulos_equipamiento.codigo_modulo_equipamiento,
+                fases_equipamiento.num_srv, parametros.nombre,
+                fases_etapas.tipo_setpoint, fases_etapas.valor_por_defecto_setpoint
+            FROM fases_etapas
+                INNER JOIN etapas
+                    ON fases_etapas.id_etapa = etapas.id_etapa
+                INNER JOIN fases_equipamiento
+                    ON fases_etapas.id_fase_equipamiento = fases_equipamiento.id_fase_equipamiento
+                INNER JOIN modulos_equipamiento
+                    ON fases_equipamiento.id_modulo_equipamiento = modulos_equipamiento.id_modulo_equipamiento
+                LEFT JOIN parametros
+                    ON fases_etapas.id_parametro_setpoint = parametros.id_parametro
+            {statesFilter}
+            ORDER BY fases_etapas.id_fases_etapas;
+
+            SELECT transiciones.id_etapa_inicial, transiciones.id_etapa_final
+            FROM transiciones
+                INNER JOIN etapas
+                    ON transiciones.id_etapa_inicial = etapas.id_etapa
+            {statesFilter}
+            ORDER BY transiciones.id_transicion;
+
+            SELECT id_receta_maestra, nombre, tipo
+            FROM parametros
+            {parametersFilter}
+            ORDER BY id_parametro;
+            """.format(
+                recipesFilter=recipeFilter.format(table="recetas_maestras"),
+                statesFilter=recipeFilter.format(table="etapas"),
+                parametersFilter=recipeFilter.format(table="parametros")
+            ),
+            params
+        )
+
+        queriedRecipes = dict()
+        # Recipe name by id_receta_maestra
+        recipeNames = dict()
+        for recipeID, name, description in recipesRows:
+            recipeNames[recipeID] = name
+            queriedRecipes[name] = {
+                "description": description,
+                "states": [],
+                "initialState": None,
+                "finalState": None,
+                "actions": dict(),
+                "transitions": [],
+                "parameters": []
+            }
+        self._logger.debug("Found names %s"% list(queriedRecipes.keys()))
+
+        # (recipe name, state name) by id_etapa
+        states = dict()
+        for stateID, recipeID, stateName, isInitial, isFinal in statesRows:
+            recipe = queriedRecipes[recipeNames[recipeID]]
+            states[stateID] = (recipeNames[recipeID], stateName)
+            recipe["states"].append(stateName)
+            recipe["actions"][stateName] = []
+            if (isInitial):
+                recipe["initialState"] = stateName
+            if (isFinal):
+                recipe["finalState"] = stateName
+
+        for stateID, me, numSrv, paramName, setpointType, setpointValue in actionsRows:
+            recipeName, stateName = states[stateID]
+            queriedRecipes[recipeName]["actions"][stateName].append(
+                {
+                    "me": me,
+                    "numSrv": numSrv,
+                    "setpoint_param": paramName,
+                    "default_setpoint": self._decodeSetpoint(setpointType, setpointValue)
+                }
+            )
+
+        for initialStateID, finalStateID in transitionsRows:
+            recipeName, initialState = states[initialStateID]
+            finalState = states[finalStateID][1]
+            queriedRecipes[recipeName]["transitions"].append(
+                {
+                    "name": "tran_"+initialState+"_"+finalState,
+                    "initialState": initialState,
+                    "finalState": finalState
+                }
+            )
+
+        # Parameters are kept as (name, type) pairs, the same as _queryParameters() returns them
+        for recipeID, paramName, paramType in parametersRows:
+            queriedRecipes[recipeNames[recipeID]]["parameters"].append((paramName, paramType))
+
+        return queriedRecipes
+
+    async def _queryMasterRecipesOneByOne(self, recipeNames: list[str] = None):
+        """Query master recipes separately (several queries per recipe and state).
+        Sql client will raise error on timeout or conection error.
+
+        Args:
+            recipeNames (list[str], optional): Recipes to query. Defaults to None (all recipes).
+
+        Returns:
+            Dict: Master recipes dict.
+        """
         queriedRecipes = dict()
 
         # Getting names of all master recipes
-        recipeNames = await self._queryMasterRecipes()
-        self._logger.debug("Found names %s"% recipeNames)
+        if (recipeNames == None):
+            recipeNames = await self._queryMasterRecipes()
+            self._logger.debug("Found names %s"% recipeNames)
 
         for name in recipeNames:
             self._logger.debug("Querying %s"% name)
@@ -73,40 +433,57 @@ class MasterRecipeFinder:
             # Getting parameters
             queriedRecipes[name]["parameters"] = await self._queryParameters(masterRecipeName=name)
             self._logger.debug("Got parameters %s"% queriedRecipes[name]["parameters"])
+        return queriedRecipes
 
+    async def _queryRecipeVersions(self):
+        """Get a version stamp for every master recipe, in a single query.
+        Sql client will raise error on timeout or conection error.
 
-        await self._lock.acquire()
-        self._masterRecipes = queriedRecipes
-        self._lock.release()
-
-    async def getMasterRecipes(self):
-        """Get saved master recipes.
-
-        Returns:
-            Dict: Deep copy of recipes dict. Will be None if updateMasterRecipes() has never been called.
-        """
-        await self._lock.acquire()
-        recipes = copy.deepcopy(self._masterRecipes)
-        self._lock.release()
-        return recipes
-
-    async def updateAndGetMasterRecipes(self):
-        """Queries database and retrieves data about all master recipes.
-
-        The sql client will raise error on timeout or conection error.
+        The version is a checksum of the recipe's rows in recetas_maestras, etapas, fases_etapas
+        (with the equipment phase it calls), transiciones and parametros, so it changes whenever
+        any of them is inserted, deleted or modified.
 
         Returns:
-            Dict: Deep copy of recipes dict.
-        """
-        await self.updateMasterRecipes()
-        return await self.getMasterRecipes()
-
-    def __init__(self):
-        """Constructor. Sets up asyncio lock for reading/writing saved recipes.
+            Dict: {"RECIPE_1": (id_receta_maestra, "version"), ...}
         """
-        self._lock = asyncio.Lock()
-        self._masterRecipes = None
-        self._logger = logging.getLogger("MasterRecipeFinder")
+        versions = await mysqlPreparedQuery(
+            "recipeVersions",
+            """
+            SELECT recetas_maestras.id_receta_maestra, recetas_maestras.codigo_receta_maestra,
+                CONCAT_WS(':',
+                    CRC32(IFNULL(recetas_maestras.descripcion, 'NULL')),
+                    (SELECT IFNULL(BIT_XOR(CRC32(CONCAT_WS('|',
+                            etapas.id_etapa, etapas.nombre, etapas.es_inicial, etapas.es_final))), 0)
+                        FROM etapas
+                        WHERE etapas.id_receta_maestra = recetas_maestras.id_receta_maestra),
+                    (SELECT IFNULL(BIT_XOR(CRC32(CONCAT_WS('|',
+                            fases_etapas.id_fases_etapas, fases_etapas.id_etapa,
+                            fases_equipamiento.id_modulo_equipamiento, fases_equipamiento.num_srv,
+                            IFNULL(fases_etapas.id_parametro_setpoint, 'NULL'),
+                            IFNULL(fases_etapas.tipo_setpoint, 'NULL'),
+                            IFNULL(fases_etapas.valor_por_defecto_setpoint, 'NULL')))), 0)
+                        FROM fases_etapas
+                            INNER JOIN etapas
+                                ON fases_etapas.id_etapa = etapas.id_etapa
+                            INNER JOIN fases_equipamiento
+                                ON fases_etapas.id_fase_equipamiento = fases_equipamiento.id_fase_equipamiento
+                        WHERE etapas.id_receta_maestra = recetas_maestras.id_receta_maestra),
+                    (SELECT IFNULL(BIT_XOR(CRC32(CONCAT_WS('|',
+                            transiciones.id_transicion, transiciones.id_etapa_inicial, transiciones.id_etapa_final))), 0)
+                        FROM transiciones
+                            INNER JOIN etapas
+                                ON transiciones.id_etapa_inicial = etapas.id_etapa
+                        WHERE etapas.id_receta_maestra = recetas_maestras.id_receta_maestra),
+                    (SELECT IFNULL(BIT_XOR(CRC32(CONCAT_WS('|',
+                            parametros.id_parametro, parametros.nombre, parametros.tipo))), 0)
+                        FROM parametros
+                        WHERE parametros.id_receta_maestra = recetas_maestras.id_receta_maestra)
+                )
+            FROM recetas_maestras;
+            """
+        )
+        # Query returns versions as tuples inside of a list - [(ID_1, "RECIPE_1", "VERSION_1"), ...]
+        return {x[1]: (x[0], x[2]) for x in versions}
 
     async def _queryMasterRecipes(self):
         """Get all master recipe names. Sql client will raise error on timeout or conection error.
@@ -114,7 +491,7 @@ class MasterRecipeFinder:
         Returns:
             List[str]: Recipe names.
         """
-        recipeNames = await mysqlQuery("""
+        recipeNames = await mysqlPreparedQuery("recipeNames", """
             SELECT codigo_receta_maestra FROM recetas_maestras;
         """)
         # Query returns names in separate tuples within the recipeNames list - [("RECIPE_1",), ("RECIPE_2"), ...]
@@ -130,7 +507,8 @@ class MasterRecipeFinder:
         Returns:
             str: Recipe description.
         """
-        description = await mysqlQuery(
+        description = await mysqlPreparedQuery(
+            "recipeDescription",
             """
                 SELECT descripcion FROM recetas_maestras
                 WHERE recetas_maestras.codigo_receta_maestra = %s;
@@ -151,7 +529,8 @@ class MasterRecipeFinder:
         Returns:
             Tuple[List[str],str,str]: States list ["E0", "E1", ...], name of initial state, and name of final state.
         """
-        states = await mysqlQuery(
+        states = await mysqlPreparedQuery(
+            "recipeStates",
             """
                 SELECT nombre, es_inicial, es_final
                 FROM etapas
@@ -190,7 +569,8 @@ class MasterRecipeFinder:
                 {"me" : "ME_CODE_2", "numSrv" : "numSrv_2", "setpoint_param" : "PARAMETER_1_NAME", "default_setpoint" : 3},
                 ... ]
         """
-        actions = await mysqlQuery(
+        actions = await mysqlPreparedQuery(
+            "stateActions",
             """
             SELECT modulos_equipamiento.codigo_modulo_equipamiento,
                 fases_equipamiento.num_srv, parametros.nombre,
@@ -219,22 +599,34 @@ class MasterRecipeFinder:
         # Decoding the setpoint values according to type
         n = 0
         for i in actions:
-            match(i[3]):
-                case "INT":
-                    setpoint_value = int(i[4])
-                case "REAL":
-                    setpoint_value = float(i[4])
-                case None:
-                    setpoint_value = None
-                case _ :
-                    raise TypeError("Invalid setpoint type %s"% i[4])
-
-            actionsList[n]["default_setpoint"] = setpoint_value
-
+            actionsList[n]["default_setpoint"] = self._decodeSetpoint(i[3], i[4])
             n = n + 1
 
         return actionsList
 
+    def _decodeSetpoint(self, setpointType: str, setpointValue: str):
+        """Decode a default setpoint value stored as a string according to its type.
+
+        Args:
+            setpointType (str): "INT", "REAL" or None (MySQL column "tipo_setpoint")
+            setpointValue (str): Value (MySQL column "valor_por_defecto_setpoint")
+
+        Raises:
+            TypeError: Invalid setpoint type.
+
+        Returns:
+            int | float | None: Decoded value.
+        """
+        match(setpointType):
+            case "INT":
+                return int(setpointValue)
+            case "REAL":
+                return float(setpointValue)
+            case None:
+                return None
+            case _ :
+                raise TypeError("Invalid setpoint type %s"% setpointType)
+
     async def _queryTransitions(self, masterRecipeName: str):
         """Get transitions of the specified recipe. Sql client will raise error on timeout or conection error.
 
@@ -252,7 +644,8 @@ class MasterRecipeFinder:
         """
 
         # Initial states of transitions
-        initialStates = await mysqlQuery(
+        initialStates = await mysqlPreparedQuery(
+            "transitionInitialStates",
             """
             SELECT etapas.nombre
             FROM transiciones
@@ -266,7 +659,8 @@ class MasterRecipeFinder:
         )
 
         # Final states of transitions
-        finalStates = await mysqlQuery(
+        finalStates = await mysqlPreparedQuery(
+            "transitionFinalStates",
             """
             SELECT etapas.nombre
             FROM transiciones
@@ -309,7 +703,8 @@ class MasterRecipeFinder:
                 "NAME_2": "TYPE_2",
                 ...}
         """
-        parameters = await mysqlQuery(
+        parameters = await mysqlPreparedQuery(
+            "recipeParameters",
             """
                 SELECT nombre, tipo
                 FROM parametros
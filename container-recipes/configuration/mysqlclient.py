@@ -1,10 +1,508 @@
 import asyncio
+import collections
+import logging
+import re
+import time
+import weakref
+from contextlib import asynccontextmanager
+from metrics import isMetricsEnabled, observe
 from mysql.connector.aio import connect
 from typing import Sequence
 
+# Connection pool settings, shared by every pool created by getMysqlPool()
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 5
+POOL_ACQUIRE_TIMEOUT = 5
+POOL_CONNECT_TIMEOUT = 5
+POOL_MAX_IDLE_TIME = 300
+POOL_HEALTH_CHECK_INTERVAL = 30
+# String literals, quoted identifiers and comments, where %s isn't a placeholder; or a %s placeholder; or an escaped %
+SQL_PLACEHOLDER_PATTERN = re.compile(
+    r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`|--[^\n]*|#[^\n]*|/\*.*?\*/)|%s|%%""",
+    re.DOTALL)
+
+
+class MysqlConnectionPool:
+    """Pool of async mysql connections.
+
+    Keeps between minSize and maxSize connections open so that queries don't pay
+    the connection setup (TCP + authentication) every time. Idle connections are
+    checked before being reused if they haven't been used in a while, and closed
+    if they stay idle for too long (always keeping minSize connections open).
+
+    Use it as:
+
+        async with pool.connection() as cnx:
+            cur = await cnx.cursor()
+            ...
+    """
+
+    async def start(self):
+        """Open the minimum number of connections. Raises error on timeout or conection error.
+        """
+        while (self._size < self._minSize):
+            self._size = self._size + 1
+            try:
+                cnx = await self._openConnection()
+            except BaseException:
+                self._size = self._size - 1
+                raise
+            self._idle.append((cnx, time.monotonic()))
+        self._startReaper()
+
+    async def acquire(self):
+        """Get a connection from the pool, opening a new one if none are idle and the pool isn't full.
+        Waits for a connection to be released if the pool is full.
+
+        Raises:
+            TimeoutError: No connection was available before acquireTimeout.
+
+        Returns:
+            MySQLConnectionAbstract: Connection. Must be given back with release().
+        """
+        start = time.perf_counter()
+        if (self._semaphore.locked()):
+            self._waits = self._waits + 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self._acquireTimeout)
+        except TimeoutError:
+            self._timeouts = self._timeouts + 1
+            raise
+
+        try:
+            cnx = await self._getIdleConnection()
+            if (cnx == None):
+                self._size = self._size + 1
+                try:
+                    cnx = await self._openConnection()
+                except BaseException:
+                    self._size = self._size - 1
+                    raise
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        self._inUse = self._inUse + 1
+        self._acquired = self._acquired + 1
+        latency = time.perf_counter() - start
+        self._acquireLatencyTotal = self._acquireLatencyTotal + latency
+        self._acquireLatencyMax = max(self._acquireLatencyMax, latency)
+        self._startReaper()
+        return cnx
+
+    async def release(self, cnx, discard: bool = False):
+        """Give a connection back to the pool.
+
+        Args:
+            cnx (MySQLConnectionAbstract): Connection gotten from acquire().
+            discard (bool, optional): Close the connection instead of reusing it
+                (for example, after an error in the middle of a query). Defaults to False.
+        """
+        self._inUse = self._inUse - 1
+        try:
+            if (discard or self._closed):
+                await self._closeConnection(cnx)
+            else:
+                self._idle.append((cnx, time.monotonic()))
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        """Context manager to acquire a connection and release it when done.
+        The connection is discarded if an exception is raised while using it.
+
+        Yields:
+            MySQLConnectionAbstract: Connection.
+        """
+        cnx = await self.acquire()
+        try:
+            yield cnx
+        except BaseException:
+            await self.release(cnx, discard=True)
+            raise
+        else:
+            await self.release(cnx)
+
+    async def close(self):
+        """Close all idle connections. Connections that are in use will be closed when released.
+        """
+        self._closed = True
+        if (self._reaperTask != None):
+            self._reaperTask.cancel()
+            self._reaperTask = None
+        while (self._idle):
+            cnx, _ = self._idle.popleft()
+            await self._closeConnection(cnx)
+
+    def getStats(self):
+        """Get pool metrics, for sizing the pool.
+
+        Returns:
+            Dict: Metrics:
+                {
+                    "size": Open connections,
+                    "idle": Idle connections,
+                    "inUse": Connections currently acquired,
+                    "maxSize": Maximum number of connections,
+                    "acquired": Total number of acquires,
+                    "waits": Acquires that had to wait for a connection to be released,
+                    "timeouts": Acquires that timed out,
+                    "created": Connections opened,
+                    "closed": Connections closed (evicted, failed health check or discarded),
+                    "acquireLatencyAvg": Average acquire time (s),
+                    "acquireLatencyMax": Maximum acquire time (s)
+                }
+        """
+        if (self._acquired > 0):
+            latencyAvg = self._acquireLatencyTotal / self._acquired
+        else:
+            latencyAvg = 0
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "inUse": self._inUse,
+            "maxSize": self._maxSize,
+            "acquired": self._acquired,
+            "waits": self._waits,
+            "timeouts": self._timeouts,
+            "created": self._created,
+            "closed": self._closedCount,
+            "acquireLatencyAvg": latencyAvg,
+            "acquireLatencyMax": self._acquireLatencyMax
+        }
+
+    def __init__(self, user: str, password: str, host: str, database: str,
+                 minSize: int = POOL_MIN_SIZE, maxSize: int = POOL_MAX_SIZE,
+                 acquireTimeout: float = POOL_ACQUIRE_TIMEOUT, connectTimeout: float = POOL_CONNECT_TIMEOUT,
+                 maxIdleTime: float = POOL_MAX_IDLE_TIME, healthCheckInterval: float = POOL_HEALTH_CHECK_INTERVAL):
+        """Constructor. Connections are not opened until start() or acquire() are called.
+
+        Args:
+            user (str): Mysql user.
+            password (str): Mysql password.
+            host (str): Mysql host.
+            database (str): Database to use.
+            minSize (int, optional): Connections to keep open even if idle. Defaults to POOL_MIN_SIZE.
+            maxSize (int, optional): Maximum number of open connections. Defaults to POOL_MAX_SIZE.
+            acquireTimeout (float, optional): Seconds to wait for a connection. Defaults to POOL_ACQUIRE_TIMEOUT.
+            connectTimeout (float, optional): Seconds to wait when opening a connection. Defaults to POOL_CONNECT_TIMEOUT.
+            maxIdleTime (float, optional): Seconds after which idle connections are closed. Defaults to POOL_MAX_IDLE_TIME.
+            healthCheckInterval (float, optional): Idle connections older than this (seconds)
+                are pinged before being reused. Defaults to POOL_HEALTH_CHECK_INTERVAL.
+        """
+        self._user = user
+        self._password = password
+        self._host = host
+        self._database = database
+        self._minSize = minSize
+        self._maxSize = maxSize
+        self._acquireTimeout = acquireTimeout
+        self._connectTimeout = connectTimeout
+        self._maxIdleTime = maxIdleTime
+        self._healthCheckInterval = healthCheckInterval
+        self._logger = logging.getLogger("MysqlConnectionPool")
+
+        # Idle connections as (connection, time it was released)
+        self._idle = collections.deque()
+        # Limits connections in use to maxSize
+        self._semaphore = asyncio.Semaphore(maxSize)
+        self._size = 0
+        self._closed = False
+        self._reaperTask = None
+
+        # Metrics
+        self._inUse = 0
+        self._acquired = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._created = 0
+        self._closedCount = 0
+        self._acquireLatencyTotal = 0
+        self._acquireLatencyMax = 0
+
+    async def _openConnection(self):
+        """Open a new connection. Raises error on timeout or conection error.
+
+        Returns:
+            MySQLConnectionAbstract: Connection.
+        """
+        cnx = await asyncio.wait_for(
+            connect(
+                user=self._user,
+                password=self._password,
+                host=self._host,
+                database=self._database),
+            self._connectTimeout
+        )
+        self._created = self._created + 1
+        self._logger.debug("Opened connection to %s (pool size %s)." % (self._host, self._size))
+        return cnx
+
+    async def _closeConnection(self, cnx):
+        """Close a connection, ignoring errors (the connection may already be broken).
+
+        Args:
+            cnx (MySQLConnectionAbstract): Connection.
+        """
+        self._size = self._size - 1
+        self._closedCount = self._closedCount + 1
+        try:
+            await cnx.close()
+        except Exception:
+            pass
+
+    async def _getIdleConnection(self):
+        """Pop the most recently used idle connection, checking it is still alive
+        if it has been idle for longer than healthCheckInterval.
+
+        Returns:
+            MySQLConnectionAbstract: Connection, or None if there are no usable idle connections.
+        """
+        while (self._idle):
+            cnx, releasedAt = self._idle.pop()
+            if ((time.monotonic() - releasedAt) < self._healthCheckInterval):
+                return cnx
+            try:
+                alive = await asyncio.wait_for(cnx.is_connected(), self._connectTimeout)
+            except Exception:
+                alive = False
+            if (alive):
+                return cnx
+            self._logger.debug("Discarding dead connection.")
+            await self._closeConnection(cnx)
+        return None
+
+    def _startReaper(self):
+        """Launch the task that closes connections that have been idle for too long, if it isn't running.
+        """
+        if ((self._reaperTask == None) and (not self._closed)):
+            self._reaperTask = asyncio.create_task(self._reapLoop())
+
+    async def _reapLoop(self):
+        """Loops forever, closing the oldest idle connections once they exceed maxIdleTime.
+        Keeps at least minSize connections open.
+        """
+        while True:
+            await asyncio.sleep(min(self._maxIdleTime, self._healthCheckInterval))
+            now = time.monotonic()
+            # Oldest connections are on the left of the deque
+            while (self._idle and (self._size > self._minSize)
+                   and ((now - self._idle[0][1]) > self._maxIdleTime)):
+                cnx, _ = self._idle.popleft()
+                self._logger.debug("Closing idle connection.")
+                await self._closeConnection(cnx)
+
+
+class MysqlTransaction:
+    """Queries executed on a single connection as part of one transaction, see mysqlTransaction().
+    Nothing is committed until the transaction ends.
+
+    Attributes:
+        lastRowId (int): Id generated by the last INSERT into a table with an AUTO_INCREMENT column.
+    """
+
+    async def query(self, query: str, params: Sequence[any] = None):
+        """Execute a query. Raises error on timeout or conection error.
+
+        Args:
+            query (str): SQL Query to execute.
+            params (Sequence[any], optional): Params for query, if needed. Defaults to None.
+
+        Returns:
+            List[Any]: Results
+        """
+        start = time.perf_counter()
+        cur = await self._cnx.cursor()
+        await cur.execute(query, params)
+        results = await cur.fetchall()
+        self.lastRowId = cur.lastrowid
+        await cur.close()
+        if (isMetricsEnabled()):
+            observe("sql_query_seconds", time.perf_counter() - start, statement=_statementType(query))
+        return results
+
+    async def multipleQueries(self, query: str, params: Sequence[any] = None):
+        """Execute several statements in one round trip. Raises error on timeout or conection error.
+
+        Args:
+            query (str): SQL Query to execute.
+            params (Sequence[any], optional): Params for query, if needed. Defaults to None.
+
+        Returns:
+            List[List[Any]]: List of results for each statement in order
+        """
+        start = time.perf_counter()
+        cur = await self._cnx.cursor()
+        await cur.execute(query, params)
+        results = []
+        async for statement, result_set in cur.fetchsets():
+            results.append(result_set)
+        self.lastRowId = cur.lastrowid
+        await cur.close()
+        if (isMetricsEnabled()):
+            observe("sql_query_seconds", time.perf_counter() - start, statement="MULTIPLE")
+        return results
+
+    async def preparedQuery(self, name: str, query: str, params: Sequence[any] = None):
+        """Execute a query as a named prepared statement, see StatementRegistry.
+        Raises error on timeout or conection error.
+
+        Args:
+            name (str): Name of the statement, for reusing it and for its metrics.
+            query (str): SQL Query to execute, a single statement.
+            params (Sequence[any], optional): Params for query, if needed. Defaults to None.
+
+        Returns:
+            List[Any]: Results
+        """
+        results, self.lastRowId = await _statements.execute(self._cnx, name, query, params)
+        return results
+
+    def __init__(self, cnx):
+        """Constructor.
+
+        Args:
+            cnx (MySQLConnectionAbstract): Connection the transaction runs on.
+        """
+        self._cnx = cnx
+        self.lastRowId = None
+
+
+class StatementRegistry:
+    """Named SQL statements, executed as server-side prepared statements (binary protocol).
+
+    A statement is prepared the first time it is executed on a connection, and the prepared
+    statement is reused for as long as the connection lives, so the server parses it only once
+    and later executions only send its id and the params. Execution counts and times are kept
+    for each statement name.
+
+    Use the process-wide registry through mysqlPreparedQuery(), MysqlTransaction.preparedQuery()
+    and getStatementStats().
+    """
+
+    async def execute(self, cnx, name: str, query: str, params: Sequence[any] = None):
+        """Execute a statement on a connection, preparing it if it wasn't prepared on it yet.
+        Raises error on timeout or conection error.
+
+        Args:
+            cnx (MySQLConnectionAbstract): Connection.
+            name (str): Name of the statement.
+            query (str): SQL Query, a single statement. Must be the same every time name is used.
+                Placeholders are %s, and a % outside string literals is written %%. This only applies to
+                prepared statements: mysqlQuery() sends %% as it is.
+            params (Sequence[any], optional): Params for query, if needed. Defaults to None.
+
+        Raises:
+            ValueError: name is registered with a different query, or wrong number of params.
+
+        Returns:
+            Tuple[List[Any], int]: Results and ID generated by an INSERT (None if no ID was generated).
+        """
+        start = time.perf_counter()
+        registered = self._queries.setdefault(name, query)
+        if (registered != query):
+            raise ValueError("Statement %s is already registered with a different query." % name)
+        stats = self._stats.setdefault(name, {"executions": 0, "prepares": 0, "time": 0.0, "maxTime": 0.0})
+
+        prepared = self._prepared.setdefault(cnx, dict())
+        if (name not in prepared):
+            # Prepared statements take ? placeholders and no trailing ;
+            statementText = _toPreparedSyntax(query.strip().rstrip(";"))
+            prepared[name] = await cnx.cmd_stmt_prepare(statementText.encode("utf-8"))
+            stats["prepares"] = stats["prepares"] + 1
+        statement = prepared[name]
+        params = tuple(params) if (params != None) else ()
+        if (len(params) != len(statement["parameters"])):
+            raise ValueError("Statement %s takes %d params, got %d." % (name, len(statement["parameters"]), len(params)))
+
+        result = await cnx.cmd_stmt_execute(statement["statement_id"], data=params, parameters=statement["parameters"])
+        if (isinstance(result, dict)):
+            # OK packet, the statement returns no rows
+            rows = []
+            lastRowId = result.get("insert_id") or None
+        else:
+            # Result set as (column count, columns, eof)
+            cnx.unread_result = True
+            rows, _ = await cnx.get_rows(binary=True, columns=result[1])
+            lastRowId = None
+
+        elapsed = time.perf_counter() - start
+        stats["executions"] = stats["executions"] + 1
+        stats["time"] = stats["time"] + elapsed
+        stats["maxTime"] = max(stats["maxTime"], elapsed)
+        if (isMetricsEnabled()):
+            observe("sql_prepared_statement_seconds", elapsed, statement=name)
+        return rows, lastRowId
+
+    def getStats(self):
+        """Get execution metrics of each statement.
+
+        Returns:
+            Dict: {"STATEMENT_NAME": {
+                        "executions": Times executed,
+                        "prepares": Times prepared (once per connection it ran on),
+                        "time": Total execution time (s),
+                        "avgTime": Average execution time (s),
+                        "maxTime": Maximum execution time (s)
+                    }, ...}
+        """
+        stats = dict()
+        for name, statementStats in self._stats.items():
+            stats[name] = dict(statementStats)
+            stats[name]["avgTime"] = statementStats["time"] / max(1, statementStats["executions"])
+        return stats
+
+    def __init__(self):
+        # Query of each statement name
+        self._queries = dict()
+        # Prepared statements of each open connection {connection: {name: prepared statement}}
+        self._prepared = weakref.WeakKeyDictionary()
+        self._stats = dict()
+
+
+# Process-wide statement registry
+_statements = StatementRegistry()
+
+
+# Process-wide pools, one for each (user, host, database)
+_pools = dict()
+
+
+def getMysqlPool(user="admin", password="password", host="spinners-mysql", database: str = "spinners"):
+    """Get the process-wide connection pool for these credentials, creating it if needed.
+
+    Args:
+        user (str, optional): Defaults to "admin".
+        password (str, optional): Defaults to "password".
+        host (str, optional): Defaults to "spinners-mysql".
+        database (str, optional): Defaults to "spinners".
+
+    Returns:
+        MysqlConnectionPool: Pool.
+    """
+    key = (user, password, host, database)
+    if (key not in _pools):
+        _pools[key] = MysqlConnectionPool(
+            user=user,
+            password=password,
+            host=host,
+            database=database)
+    return _pools[key]
+
+
+def getMysqlPoolStats():
+    """Get metrics of every connection pool.
+
+    Returns:
+        Dict: {"user@host/database": MysqlConnectionPool.getStats(), ...}
+    """
+    return {"%s@%s/%s" % (key[0], key[2], key[3]): pool.getStats() for key, pool in _pools.items()}
+
 
 async def mysqlQuery(query: str, params: Sequence[any] = None, user="admin", password="password", host="spinners-mysql", database: str = "spinners"):
-    """Connecto to mysql, execute query, commit and disconnect. Raises error on timeout or conection error.
+    """Get a pooled connection to mysql, execute query and commit. Raises error on timeout or conection error.
+
     Args:
         query (str): SQL Query to execute.
         params (Sequence[any], optional): Params for query, if needed. Defaults to None.
@@ -16,35 +514,31 @@ async def mysqlQuery(query: str, params: Sequence[any] = None, user="admin", pas
     Returns:
         List[Any]: Results
     """
-    # Connect to a MySQL server
-    cnx = await asyncio.wait_for(
-        connect(
-            user=user,
-            password=password,
-            host=host,
-            database=database),
-        5
-    )
-    # Get a cursor
-    cur = await cnx.cursor()
+    start = time.perf_counter()
+    pool = getMysqlPool(user=user, password=password, host=host, database=database)
+    async with pool.connection() as cnx:
+        # Get a cursor
+        cur = await cnx.cursor()
 
-    # Execute a non-blocking query
-    await cur.execute(query, params)
+        # Execute a non-blocking query
+        await cur.execute(query, params)
 
-    # Retrieve the results of the query asynchronously
-    results = await cur.fetchall()
+        # Retrieve the results of the query asynchronously
+        results = await cur.fetchall()
 
-    # Commit changes
-    await cnx.commit()
+        # Commit changes
+        await cnx.commit()
 
-    # Close cursor and connection
-    await cur.close()
-    await cnx.close()
+        # Close cursor, connection goes back to the pool
+        await cur.close()
 
+    if (isMetricsEnabled()):
+        observe("sql_query_seconds", time.perf_counter() - start, statement=_statementType(query))
     return results
 
 async def mysqlMultipleQueries(query: str, params: Sequence[any] = None, user="admin", password="password", host="spinners-mysql", database: str = "spinners"):
-    """Connecto to mysql, execute query, commit and disconnect. Raises error on timeout or conection error.
+    """Get a pooled connection to mysql, execute several statements and commit. Raises error on timeout or conection error.
+
     Args:
         query (str): SQL Query to execute.
         params (Sequence[any], optional): Params for query, if needed. Defaults to None.
@@ -56,37 +550,84 @@ async def mysqlMultipleQueries(query: str, params: Sequence[any] = None, user="a
     Returns:
         List[List[Any]]: List of results for each statement in order
     """
-    # Connect to a MySQL server
-    cnx = await asyncio.wait_for(
-        connect(
-            user=user,
-            password=password,
-            host=host,
-            database=database),
-        5
-    )
-    # Get a cursor
-    cur = await cnx.cursor()
+    start = time.perf_counter()
+    pool = getMysqlPool(user=user, password=password, host=host, database=database)
+    async with pool.connection() as cnx:
+        # Get a cursor
+        cur = await cnx.cursor()
+
+        # Execute a non-blocking query
+        await cur.execute(query, params)
+
+        # Retrieve the results of the query asynchronously
+        results = []
+        async for statement, result_set in cur.fetchsets():
+            results.append(result_set)
+
+        # Commit changes
+        await cnx.commit()
 
-    # Execute a non-blocking query
-    await cur.execute(query, params)
+        # Close cursor, connection goes back to the pool
+        await cur.close()
 
-    # Retrieve the results of the query asynchronously
-    results = []
-    async for statement, result_set in cur.fetchsets():
-        results.append(result_set)
+    if (isMetricsEnabled()):
+        observe("sql_query_seconds", time.perf_counter() - start, statement="MULTIPLE")
+    return results
 
-    # Commit changes
-    await cnx.commit()
+async def mysqlPreparedQuery(name: str, query: str, params: Sequence[any] = None, user="admin", password="password", host="spinners-mysql", database: str = "spinners"):
+    """Get a pooled connection to mysql, execute query as a named prepared statement and commit.
+    The statement is only prepared the first time it runs on each connection, see StatementRegistry.
+    Raises error on timeout or conection error.
 
-    # Close cursor and connection
-    await cur.close()
-    await cnx.close()
+    Args:
+        name (str): Name of the statement, for reusing it and for its metrics.
+        query (str): SQL Query to execute, a single statement.
+        params (Sequence[any], optional): Params for query, if needed. Defaults to None.
+        user (str, optional): Defaults to "admin".
+        password (str, optional): Defaults to "password".
+        host (str, optional): Defaults to "host".
+        database (str, optional):  Defaults to "spinners".
 
+    Returns:
+        List[Any]: Results
+    """
+    pool = getMysqlPool(user=user, password=password, host=host, database=database)
+    async with pool.connection() as cnx:
+        results, _ = await _statements.execute(cnx, name, query, params)
+        await cnx.commit()
     return results
 
+@asynccontextmanager
+async def mysqlTransaction(user="admin", password="password", host="spinners-mysql", database: str = "spinners"):
+    """Context manager to execute several queries on one pooled connection, committing them
+    all together when done. If an exception is raised nothing is committed: the connection is
+    discarded and the server rolls back the transaction. Raises error on timeout or conection error.
+
+    Use it as:
+
+        async with mysqlTransaction() as transaction:
+            rows = await transaction.query(...)
+            await transaction.multipleQueries(...)
+
+    Args:
+        user (str, optional): Defaults to "admin".
+        password (str, optional): Defaults to "password".
+        host (str, optional): Defaults to "spinners-mysql".
+        database (str, optional): Defaults to "spinners".
+
+    Yields:
+        MysqlTransaction: Transaction to execute the queries with.
+    """
+    pool = getMysqlPool(user=user, password=password, host=host, database=database)
+    async with pool.connection() as cnx:
+        yield MysqlTransaction(cnx)
+        start = time.perf_counter()
+        await cnx.commit()
+        if (isMetricsEnabled()):
+            observe("sql_query_seconds", time.perf_counter() - start, statement="COMMIT")
+
 async def mysqlTestConnection(user="admin", password="password", host="spinners-mysql", database: str = "spinners"):
-    """Connect and disconnect from mysql server to check if it is active.
+    """Check that the mysql server is active, opening the minimum number of pooled connections.
     Raises error on timeout or conection error
 
     Args:
@@ -94,16 +635,35 @@ async def mysqlTestConnection(user="admin", password="password", host="spinners-
         password (str, optional): Defaults to "password".
         host (str, optional): Defaults to "spinners-mysql".
         database (str, optional): Defaults to "spinners".
+    """
+    pool = getMysqlPool(user=user, password=password, host=host, database=database)
+    await pool.start()
+    async with pool.connection() as cnx:
+        if (not await cnx.is_connected()):
+            raise ConnectionError("Could not connect to mysql server %s" % host)
+
+def getStatementStats():
+    """Get execution metrics of the prepared statements.
 
     Returns:
-        bool: True if connection was established. False if timeout.
+        Dict: See StatementRegistry.getStats().
     """
-    cnx = await asyncio.wait_for(
-        connect(
-            user=user,
-            password=password,
-            host=host,
-            database=database),
-        5
-    )
-    await cnx.close()
+    return _statements.getStats()
+
+
+def _toPreparedSyntax(query: str):
+    """Replace the %s placeholders of a query with ?, and %% with %, leaving string literals,
+    quoted identifiers and comments as they are.
+    """
+    def replace(match):
+        if (match.group(1) != None):
+            return match.group(1)
+        return "?" if (match.group(0) == "%s") else "%"
+    return SQL_PLACEHOLDER_PATTERN.sub(replace, query)
+
+
+def _statementType(query: str):
+    """Get the first keyword of a query (SELECT, INSERT...), used as metrics label.
+    """
+    words = query.split(None, 1)
+    return words[0].upper() if words else ""
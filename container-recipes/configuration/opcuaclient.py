@@ -1,72 +1,176 @@
 import asyncio
 import logging
+import time
 
 from asyncua import Client, Node
-from asyncua.ua import Variant, VariantType
+from asyncua.ua import AttributeIds, NodeId, Variant, VariantType
 from functools import partial
-
-
-class MockOpcuaClient:
-    """Mock opcua client for trying out program without connection to
-    opcua server / plant.
+from metrics import observe
+from mysqlclient import mysqlQuery
+
+OPCUA_URL = "opc.tcp://spinners-node-red:54840"
+# Node of the gateway, has the equipment modules and the methods to control them
+GATEWAY_NODE_ID = "ns=1;i=1000"
+EQUIPMENT_MODULES = ["ME_TRANSPORTE", "ME_BASES", "ME_SPINNERS"]
+# Variables of each equipment module that are subscribed to
+SUBSCRIBED_VARIABLES = ["EstadoActual"]
+# Seconds between checks that the session is still alive
+OPCUA_KEEPALIVE_INTERVAL = 5
+# Seconds to wait before reconnecting after losing the session
+OPCUA_RECONNECT_DELAY = 2
+# Seconds that method calls wait for the session to be (re)connected
+OPCUA_SESSION_TIMEOUT = 10
+# Publishing interval of the subscription to equipment module variables (ms)
+OPCUA_PUBLISHING_INTERVAL = 100
+# Seconds waiting for a state change notification before reading the state directly,
+# in case a notification was lost
+STATE_WATCHDOG_INTERVAL = 5
+# Seconds waiting for a module to leave the running state after an abort, and to reach idle state after a reset
+MODULE_RESET_TIMEOUT = 10
+# Seconds given to the gateway to abort the modules before reading their state again,
+# the last known states may be from before AbortarModulos
+MODULE_ABORT_SETTLE_TIME = 0.5
+
+
+class OpcuaNodeRegistry:
+    """Node ids of the equipment module variables, resolved once instead of on every use.
+
+    Maps (module, variable) to its node, so phases can read states without translating browse paths,
+    and node id to (module, variable), so subscription notifications can be identified without
+    browsing the server. Node ids can be seeded from the database (column "node_id_variable_me"),
+    seeded node ids are checked against the server once when resolving.
     """
 
-    async def start(self, eventHandler: any):
-        self._eventHandler = eventHandler
-        await asyncio.sleep(0.5)
-        await self._eventHandler.handleEvent({"opcuaEvent": "started"})
+    async def seedFromDatabase(self):
+        """Load node ids of equipment module variables from the database.
+        Sql client will raise error on timeout or conection error.
+        """
+        rows = await mysqlQuery("""
+            SELECT modulos_equipamiento.codigo_modulo_equipamiento, variables_me.codigo_variable_me, variables_me.node_id_variable_me
+            FROM variables_me
+            INNER JOIN modulos_equipamiento ON variables_me.id_modulo_equipamiento = modulos_equipamiento.id_modulo_equipamiento;
+        """)
+        for (equipmentModuleName, variableName, nodeId) in rows:
+            self._seeds[(equipmentModuleName, variableName)] = NodeId.from_string(nodeId)
+        self._logger.debug("Seeded %d node ids from database." % len(rows))
+
+    async def resolve(self, client: Client, gatewayNode: Node, equipmentModuleNames: list, variableNames: list):
+        """Resolve the nodes of the specified variables, binding them to the client's session.
+        Only variables not resolved in a previous session are looked up in the server: seeded node ids
+        are checked in one read of their browse names and the rest are translated from browse paths
+        in one call.
 
-    async def subscribeToData(self, equipmentModuleNames: list, variableNames: list):
-        await asyncio.sleep(0.5)
+        Args:
+            client (Client): Client with an open session.
+            gatewayNode (Node): Gateway node, parent of the equipment modules.
+            equipmentModuleNames (list): Names of the equipment modules.
+            variableNames (list): Names of the variables of each equipment module.
 
-    async def startEquipmentPhases(self, phases: list[dict]):
-        await asyncio.sleep(0.5)
-        await self.mockPhasesCompleted()
+        Raises:
+            KeyError: A variable was not found in the server.
+        """
+        keys = [(module, variable) for module in equipmentModuleNames for variable in variableNames]
+        unresolved = [key for key in keys if key not in self._nodeIds]
+
+        # Check seeded node ids, discarding those that don't point to a variable with the expected name
+        # or that are repeated
+        seeded = [key for key in unresolved if key in self._seeds]
+        if (len(seeded) > 0):
+            results = await client.read_attributes(
+                [client.get_node(self._seeds[key]) for key in seeded], AttributeIds.BrowseName)
+            for key, result in zip(seeded, results):
+                if (result.StatusCode.is_good() and (result.Value.Value.Name == key[1])
+                        and (self._seeds[key] not in self._names)):
+                    self._addNodeId(key, self._seeds[key])
+                else:
+                    self._logger.warning(f"Seeded node id {self._seeds[key].to_string()} of {key} is not valid, browsing for it.")
+
+        # Translate browse paths of the rest
+        unresolved = [key for key in unresolved if key not in self._nodeIds]
+        if (len(unresolved) > 0):
+            results = await client.translate_browsepaths(
+                gatewayNode.nodeid, [f"/1:{module}/1:{variable}" for (module, variable) in unresolved])
+            for key, result in zip(unresolved, results):
+                if ((not result.StatusCode.is_good()) or (len(result.Targets) == 0)):
+                    raise KeyError(f"Variable {key} not found in opcua server.")
+                targetId = result.Targets[0].TargetId
+                self._addNodeId(key, NodeId(targetId.Identifier, targetId.NamespaceIndex))
+        self._logger.debug("Resolved %d nodes (%d looked up in server)." % (len(keys), len(unresolved)))
+
+        self._nodes = {key: client.get_node(nodeId) for key, nodeId in self._nodeIds.items()}
+
+    def getNode(self, equipmentModuleName: str, variableName: str):
+        """Get the node of a variable.
 
-    async def abortAllPhases(self):
-        await asyncio.sleep(0.5)
+        Args:
+            equipmentModuleName (str): Name of the equipment module.
+            variableName (str): Name of the variable.
 
-    async def resetAllModules(self):
-        await asyncio.sleep(0.5)
+        Returns:
+            Node: Node, bound to the session of the last call to resolve().
+        """
+        return self._nodes[(equipmentModuleName, variableName)]
 
-    async def mockReceivedData(self, data: dict):
-        """Generate a mock event of data being received.
+    def getName(self, nodeId: NodeId):
+        """Get the equipment module and variable of a node id.
 
         Args:
-            data (dict): Data, such as:
-                {"data": {"me" : "ME_BASES", "variable" : "numSrv", "value" : 4} }
-        """
-        event = {"opcuaEvent": "receivedData"}.update(data)
-        await self._eventHandler.handleEvent(event)
+            nodeId (NodeId): Node id.
 
-    async def mockPhasesCompleted(self):
-        """Generate a mock event of all running equipment phases being completed.
+        Returns:
+            Tuple[str, str]: (equipmentModuleName, variableName), or None if not resolved.
         """
-        event = {"opcuaEvent": "completedPhases"}
-        asyncio.create_task(self._eventHandler.handleEvent(event))
+        return self._names.get(nodeId)
 
     def __init__(self):
-        self._eventHandler = None
+        """Constructor.
+        """
+        self._logger = logging.getLogger("OpcuaNodeRegistry")
+        self._seeds = {}
+        self._nodeIds = {}
+        self._names = {}
+        self._nodes = {}
+
+    def _addNodeId(self, key: tuple, nodeId: NodeId):
+        self._nodeIds[key] = nodeId
+        self._names[nodeId] = key
 
 
 class OpcuaClient:
     """Opcua client for launching and aborting equipment phases.
-    Subscribes to equipment module state variables on start.
+
+    Keeps a single long-lived session to the gateway, shared by phase launches, aborts, resets
+    and the subscription to equipment module state variables. The session is checked periodically
+    and reopened automatically if it is lost.
     """
 
     async def start(self, eventHandler: any):
-        """Start opcua client, subscribing to variables.
+        """Start opcua client, opening the session and subscribing to variables.
 
         Args:
             eventHandler (any): Event handler that will react to changes in subscribed variables.
             Must have method:
                 async eventHandler.handleEvent(event: dict)
         """
-        self._eventHandler = eventHandler
-
-        asyncio.create_task(self._receiveLoop())
-
-        asyncio.create_task(self._eventHandler.handleEvent({"opcuaEvent": "started"}))
+        if(not self._started):
+            self._eventHandler = eventHandler
+            self._sessionTask = asyncio.create_task(self._sessionLoop())
+            asyncio.create_task(self._eventHandler.handleEvent({"opcuaEvent": "started"}))
+            self._started = True
+
+    async def stop(self):
+        """Cancel running phases and close the session.
+        """
+        if (self._runningTask != None):
+            self._runningTask.cancel()
+        if (self._sessionTask != None):
+            self._sessionTask.cancel()
+            try:
+                await self._sessionTask
+            except asyncio.CancelledError:
+                pass
+            self._sessionTask = None
+        self._started = False
 
     async def startEquipmentPhases(self, phases: list[dict]):
         """Create task to run specified phases.
@@ -86,68 +190,237 @@ class OpcuaClient:
     async def abortAllPhases(self):
         """Cancel the startEquipmentPhases task and abort
         all equipment modules, then reset them to idle state.
+        Modules are reset in parallel, as soon as each of them reaches the aborted state.
+
+        Returns:
+            Dict: Result of each module, see _resetModule(). For example:
+                {"ME_TRANSPORTE": {"state": 0, "reset": True, "time": 0.21, "error": None}, ...}
         """
+        start = time.perf_counter()
         # Cancel OpcuaClient task that is running equipment phases
         if (self._runningTask != None):
             self._runningTask.cancel()
 
-        modules = ["ME_TRANSPORTE", "ME_BASES", "ME_SPINNERS"]
-        async with Client(url="opc.tcp://spinners-node-red:54840") as client:
-            # Send abort event to all modules
-            gatewayNode = client.get_node("ns=1;i=1000")
-            await gatewayNode.call_method("1:AbortarModulos")
-            self._logger.debug("Aborted all modules.")
-
-            await asyncio.sleep(0.5)
-
-            # Reset aborted modules to idle state
-            for module in modules:
-                stateNode = await gatewayNode.get_child(f"1:{module}/1:EstadoActual")
-                state = await stateNode.read_value()
-                if (state == 3):  # 3 is the aborted state
-                    param_ME = Variant(
-                        Value=module, VariantType=VariantType.String)
-                    await gatewayNode.call_method("1:ResetModulo", param_ME)
-                    self._logger.debug("Reset %s." % module)
+        gatewayNode = await self._getGatewayNode()
+        # Send abort event to all modules
+        await self._callMethod(gatewayNode, "1:AbortarModulos")
+        self._lastAbortLatency = time.perf_counter() - start
+        self._maxAbortLatency = max(self._maxAbortLatency, self._lastAbortLatency)
+        self._logger.debug("Aborted all modules in %.1f ms." % (self._lastAbortLatency * 1000))
+
+        # Reset aborted modules to idle state
+        results = await asyncio.gather(
+            *[self._resetModule(gatewayNode, module, start, onlyIfAborted=True) for module in EQUIPMENT_MODULES])
+        return dict(zip(EQUIPMENT_MODULES, results))
 
     async def resetAllModules(self):
         """Reset modules from aborted or completed state to idle state.
-        """
-        modules = ["ME_TRANSPORTE", "ME_BASES", "ME_SPINNERS"]
-        async with Client(url="opc.tcp://spinners-node-red:54840") as client:
-            gatewayNode = client.get_node("ns=1;i=1000")
-            for module in modules:
-                stateNode = await gatewayNode.get_child(f"1:{module}/1:EstadoActual")
-                state = await stateNode.read_value()
-                if (state != 0):  # 0 is the idle state
-                    param_ME = Variant(
-                        Value=module, VariantType=VariantType.String)
-                    await gatewayNode.call_method("1:ResetModulo", param_ME)
-                    self._logger.debug("Reset %s." % module)
+        Modules are reset in parallel.
 
-    def __init__(self):
+        Returns:
+            Dict: Result of each module, see _resetModule(). For example:
+                {"ME_TRANSPORTE": {"state": 0, "reset": True, "time": 0.21, "error": None}, ...}
+        """
+        start = time.perf_counter()
+        gatewayNode = await self._getGatewayNode()
+        results = await asyncio.gather(
+            *[self._resetModule(gatewayNode, module, start, onlyIfAborted=False) for module in EQUIPMENT_MODULES])
+        return dict(zip(EQUIPMENT_MODULES, results))
+
+    def getStats(self):
+        """Get session and emergency stop metrics.
+
+        Returns:
+            Dict: {"connected": True if the session is open,
+                   "sessionsOpened": Sessions opened since start (1 unless the session was lost),
+                   "lastAbortLatency": Time from abortAllPhases() being called to AbortarModulos returning (s),
+                   "maxAbortLatency": Maximum of the above (s),
+                   "stateNotifications": State changes received through the subscription,
+                   "watchdogReads": Direct reads of a state after a notification did not arrive in time}
+        """
+        return {
+            "connected": self._connected.is_set(),
+            "sessionsOpened": self._sessionsOpened,
+            "lastAbortLatency": self._lastAbortLatency,
+            "maxAbortLatency": self._maxAbortLatency,
+            "stateNotifications": self._stateNotifications,
+            "watchdogReads": self._watchdogReads
+        }
+
+    def __init__(self, url: str = OPCUA_URL, seedNodeIdsFromDatabase: bool = False):
         """Constructor.
+
+        Args:
+            url (str, optional): Url of the opcua server. Defaults to OPCUA_URL.
+            seedNodeIdsFromDatabase (bool, optional): Take node ids of the variables from the database
+                instead of browsing for them. Defaults to False.
         """
+        self._url = url
+        self._seedNodeIdsFromDatabase = seedNodeIdsFromDatabase
+        self._nodeRegistry = OpcuaNodeRegistry()
         self._eventHandler = None
         self._runningTask = None
         self._logger = logging.getLogger("OpcuaClient")
+        self._started = False
+
+        # Long-lived session
+        self._sessionTask = None
+        self._client = None
+        self._gatewayNode = None
+        self._connected = asyncio.Event()
+
+        # Last known EstadoActual of each module, updated by subscription notifications
+        self._moduleStates = {}
+        self._stateChanged = asyncio.Condition()
+
+        # Metrics
+        self._sessionsOpened = 0
+        self._lastAbortLatency = None
+        self._maxAbortLatency = 0
+        self._stateNotifications = 0
+        self._watchdogReads = 0
+
+    async def _getGatewayNode(self):
+        """Get the gateway node of the open session, waiting for the session to be (re)connected if needed.
+
+        Raises:
+            TimeoutError: Session was not connected within OPCUA_SESSION_TIMEOUT.
 
-    async def _receiveLoop(self):
-        """Subscribes to equipment module state variables and loops forever.
+        Returns:
+            Node: Gateway node.
+        """
+        if (not self._connected.is_set()):
+            self._logger.debug("Waiting for opcua session.")
+            await asyncio.wait_for(self._connected.wait(), OPCUA_SESSION_TIMEOUT)
+        return self._gatewayNode
+
+    async def _sessionLoop(self):
+        """Opens the session, subscribes to equipment module state variables and loops forever checking the connection.
         Changes in the variables will be sent to event handler by subscription handler.
+        If the session is lost, it is opened again.
         """
-        async with Client(url="opc.tcp://spinners-node-red:54840") as client:
-            gatewayNode = client.get_node("ns=1;i=1000")
-            # Subscribe to data
-            subscriptionHandler = OpcuaSubscriptionHandler(self._eventHandler)
-            subscription = await client.create_subscription(100, subscriptionHandler)
-            for module in ["ME_TRANSPORTE", "ME_BASES", "ME_SPINNERS"]:
-                stateNode = await gatewayNode.get_child("1:%s/1:EstadoActual" % module)
-                await subscription.subscribe_data_change(stateNode)
-            self._logger.debug("Subscribed to variables.")
-            # Loop forever to keep subscriptions active
-            while True:
-                await asyncio.sleep(10)
+        while True:
+            client = Client(url=self._url, watchdog_intervall=OPCUA_KEEPALIVE_INTERVAL)
+            try:
+                await client.connect()
+                self._sessionsOpened = self._sessionsOpened + 1
+                gatewayNode = client.get_node(GATEWAY_NODE_ID)
+
+                if (self._seedNodeIdsFromDatabase):
+                    try:
+                        await self._nodeRegistry.seedFromDatabase()
+                    except Exception as e:
+                        self._logger.warning("Could not seed node ids from database (%s), browsing for them." % e)
+                    self._seedNodeIdsFromDatabase = False
+                await self._nodeRegistry.resolve(client, gatewayNode, EQUIPMENT_MODULES, SUBSCRIBED_VARIABLES)
+
+                # Subscribe to data
+                subscriptionHandler = OpcuaSubscriptionHandler(
+                    self._eventHandler, self._nodeRegistry, self._onDataChange)
+                subscription = await client.create_subscription(OPCUA_PUBLISHING_INTERVAL, subscriptionHandler)
+                await subscription.subscribe_data_change(
+                    [self._nodeRegistry.getNode(module, variable)
+                     for module in EQUIPMENT_MODULES for variable in SUBSCRIBED_VARIABLES])
+                self._logger.debug("Subscribed to variables.")
+
+                self._client = client
+                self._gatewayNode = gatewayNode
+                self._connected.set()
+
+                # Loop forever to keep the session and subscriptions active
+                while True:
+                    await asyncio.sleep(OPCUA_KEEPALIVE_INTERVAL)
+                    await client.check_connection()
+            except asyncio.CancelledError:
+                self._connected.clear()
+                await self._disconnect(client)
+                raise
+            except Exception as e:
+                self._logger.warning("Opcua session lost (%s), reconnecting." % e)
+            self._connected.clear()
+            await self._disconnect(client)
+            await asyncio.sleep(OPCUA_RECONNECT_DELAY)
+
+    async def _disconnect(self, client: Client):
+        """Close a session, ignoring errors (the connection may already be broken).
+
+        Args:
+            client (Client): Client to disconnect.
+        """
+        self._client = None
+        self._gatewayNode = None
+        # States are not known until the new subscription sends its initial values
+        self._moduleStates = {}
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+
+    async def _callMethod(self, gatewayNode: Node, methodName: str, *args: Variant):
+        """Call a method of the gateway, timing it.
+
+        Args:
+            gatewayNode (Node): Gateway node.
+            methodName (str): Browse name of the method, for example "1:IniciarFase".
+            args (Variant): Arguments.
+
+        Returns:
+            any: Result of the method.
+        """
+        start = time.perf_counter()
+        result = await gatewayNode.call_method(methodName, *args)
+        observe("opcua_call_seconds", time.perf_counter() - start, method=methodName)
+        return result
+
+    async def _resetModule(self, gatewayNode: Node, equipmentModuleName: str, start: float, onlyIfAborted: bool):
+        """Reset a module to idle state and wait for it to get there.
+
+        Args:
+            gatewayNode (Node): Gateway node.
+            equipmentModuleName (str): Name of the module.
+            start (float): time.perf_counter() when the abort or reset was requested, for timing.
+            onlyIfAborted (bool): Read the state again after MODULE_ABORT_SETTLE_TIME, wait for the module to leave
+                the running state and only reset it if it ends up aborted. Otherwise reset it if it is not idle.
+
+        Returns:
+            Dict: {"state": Last known state of the module,
+                   "reset": True if the module was reset,
+                   "time": Time from start until the module was in its final state (s),
+                   "error": Description of the error if the module could not be reset, else None}
+        """
+        result = {"state": None, "reset": False, "time": None, "error": None}
+        stateNode = self._nodeRegistry.getNode(equipmentModuleName, "EstadoActual")
+        try:
+            if (onlyIfAborted):
+                # Don't trust the last known state, the gateway may abort a module that was idle or complete
+                await asyncio.sleep(MODULE_ABORT_SETTLE_TIME)
+                state = await self._readModuleState(equipmentModuleName, stateNode)
+                if (state == 1):
+                    # Aborted modules go from running to aborted state
+                    state = await self._waitForModuleState(
+                        equipmentModuleName, stateNode, lambda state: state != 1, MODULE_RESET_TIMEOUT)
+                mustReset = (state == 3)  # 3 is the aborted state
+            else:
+                state = await self._getModuleState(equipmentModuleName, stateNode)
+                mustReset = (state != 0)  # 0 is the idle state
+            if (mustReset):
+                param_ME = Variant(
+                    Value=equipmentModuleName, VariantType=VariantType.String)
+                await self._callMethod(gatewayNode, "1:ResetModulo", param_ME)
+                state = await self._waitForModuleState(
+                    equipmentModuleName, stateNode, lambda state: state == 0, MODULE_RESET_TIMEOUT)
+                result["reset"] = True
+                self._logger.debug("Reset %s." % equipmentModuleName)
+            result["state"] = state
+        except TimeoutError:
+            result["state"] = self._moduleStates.get(equipmentModuleName)
+            result["error"] = f"Timed out in state {result["state"]}"
+            self._logger.warning(f"Could not reset {equipmentModuleName}: timed out in state {result["state"]}.")
+        except Exception as e:
+            result["error"] = str(e)
+            self._logger.warning(f"Could not reset {equipmentModuleName}: {e}")
+        result["time"] = time.perf_counter() - start
+        return result
 
     async def _executeSeveralPhases(self, phases: list[dict]):
         """Launch several phases in parallel.
@@ -199,36 +472,112 @@ class OpcuaClient:
         param_setpoint = Variant(
             Value=setpoint, VariantType=VariantType.UInt32)
 
-        async with Client(url="opc.tcp://spinners-node-red:54840") as client:
-            gatewayNode = client.get_node("ns=1;i=1000")
-            stateNode = await gatewayNode.get_child(f"1:{phase["me"]}/1:EstadoActual")
+        gatewayNode = await self._getGatewayNode()
+        stateNode = self._nodeRegistry.getNode(phase["me"], "EstadoActual")
 
-            # Check if in state completed or aborted, in that case reset the module before using it
-            state = await stateNode.read_value()
-            if((state == 2) or (state == 3)):
-                self._logger.debug(f"Trying to launch {phase["me"]} but it is in state {state}, resetting.")
-                await gatewayNode.call_method("1:CompletarFase", param_ME)
-            while((state == 2) or (state == 3)):
-                await asyncio.sleep(0.5)
-                state = await stateNode.read_value()
+        # Check if in state completed or aborted, in that case reset the module before using it
+        state = await self._getModuleState(phase["me"], stateNode)
+        if((state == 2) or (state == 3)):
+            self._logger.debug(f"Trying to launch {phase["me"]} but it is in state {state}, resetting.")
+            await self._callMethod(gatewayNode, "1:CompletarFase", param_ME)
+            await self._waitForModuleState(phase["me"], stateNode, lambda state: (state != 2) and (state != 3))
 
+        # Start phase
+        await self._callMethod(gatewayNode, "1:IniciarFase", param_ME, param_numSrv, param_setpoint)
+        self._logger.debug("Started %s." % phase["me"])
 
-            # Start phase
-            await gatewayNode.call_method("1:IniciarFase", param_ME, param_numSrv, param_setpoint)
-            self._logger.debug("Started %s." % phase["me"])
+        # Wait for completion
+        await self._waitForModuleState(phase["me"], stateNode, lambda state: state == 2)  # 2 is state "complete"
 
-            # Wait for completion
-            state = await stateNode.read_value()
-            while (state != 2):  # 2 is state "complete"
-                await asyncio.sleep(1)
-                state = await stateNode.read_value()
+        # Send reset event on completion
+        self._logger.debug("%s phase completed, resetting"% phase["me"])
+        await self._callMethod(gatewayNode, "1:CompletarFase", param_ME)
+        await self._waitForModuleState(phase["me"], stateNode, lambda state: state != 2)
 
-            # Send reset event on completion
-            self._logger.debug("%s phase completed, resetting"% phase["me"])
-            await gatewayNode.call_method("1:CompletarFase", param_ME)
-            while (state == 2):
-                await asyncio.sleep(0.5)
-                state = await stateNode.read_value()
+    async def _onDataChange(self, equipmentModuleName: str, variableName: str, value):
+        """Called by the subscription handler on every data change.
+        Keeps the last known state of each module and wakes up phases waiting for a state.
+
+        Args:
+            equipmentModuleName (str): Module whose variable changed.
+            variableName (str): Variable that changed.
+            value (_type_): New value.
+        """
+        if (variableName != "EstadoActual"):
+            return
+        self._stateNotifications = self._stateNotifications + 1
+        async with self._stateChanged:
+            self._moduleStates[equipmentModuleName] = value
+            self._stateChanged.notify_all()
+
+    async def _getModuleState(self, equipmentModuleName: str, stateNode: Node):
+        """Get the last known state of a module, reading it from the server if no notification has arrived yet.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+            stateNode (Node): EstadoActual node of the module.
+
+        Returns:
+            int: State of the module.
+        """
+        state = self._moduleStates.get(equipmentModuleName)
+        if (state == None):
+            state = await self._readModuleState(equipmentModuleName, stateNode)
+        return state
+
+    async def _readModuleState(self, equipmentModuleName: str, stateNode: Node):
+        """Read the state of a module from the server and keep it as its last known state,
+        waking up phases waiting for a state. If a notification arrived while reading, it may be
+        newer than the value read, so the value read is not kept.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+            stateNode (Node): EstadoActual node of the module.
+
+        Returns:
+            int: State of the module.
+        """
+        notifications = self._stateNotifications
+        state = await stateNode.read_value()
+        if (self._stateNotifications == notifications):
+            async with self._stateChanged:
+                self._moduleStates[equipmentModuleName] = state
+                self._stateChanged.notify_all()
+        return state
+
+    async def _waitForModuleState(self, equipmentModuleName: str, stateNode: Node, isDone, timeout: float = None):
+        """Wait until the state of a module satisfies a condition.
+        Woken up by subscription notifications; if none arrives within STATE_WATCHDOG_INTERVAL
+        the state is read directly, in case a notification was lost, and kept as the last known state.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+            stateNode (Node): EstadoActual node of the module.
+            isDone (Callable[[int], bool]): Condition on the state.
+            timeout (float, optional): Maximum time to wait (s). Defaults to None, wait forever.
+
+        Raises:
+            TimeoutError: The condition was not satisfied within timeout.
+
+        Returns:
+            int: State of the module satisfying the condition.
+        """
+        def stateIsDone():
+            state = self._moduleStates.get(equipmentModuleName)
+            return (state != None) and isDone(state)
+
+        async with asyncio.timeout(timeout):
+            while True:
+                try:
+                    async with self._stateChanged:
+                        await asyncio.wait_for(self._stateChanged.wait_for(stateIsDone), STATE_WATCHDOG_INTERVAL)
+                        return self._moduleStates[equipmentModuleName]
+                except TimeoutError:
+                    self._watchdogReads = self._watchdogReads + 1
+                    state = await self._readModuleState(equipmentModuleName, stateNode)
+                    if (isDone(state)):
+                        self._logger.debug(f"State {state} of {equipmentModuleName} was not notified, read by watchdog.")
+                        return state
 
 
 class OpcuaSubscriptionHandler:
@@ -236,14 +585,20 @@ class OpcuaSubscriptionHandler:
     Notifies changes in the data to event handler.
     """
 
-    def __init__(self, eventHandler: any):
+    def __init__(self, eventHandler: any, nodeRegistry: OpcuaNodeRegistry, fnDataChanged=None):
         """Constructor.
 
         Args:
             eventHandler (any): Event handler that will react to the data. Must have method:
                 async eventHandler.handleEvent(event: dict)
+            nodeRegistry (OpcuaNodeRegistry): Registry with the subscribed nodes already resolved.
+            fnDataChanged (Callable, optional): Coroutine function also awaited on every change, as
+                fnDataChanged(equipmentModuleName, variableName, value). Defaults to None.
         """
         self._eventHandler = eventHandler
+        self._nodeRegistry = nodeRegistry
+        self._fnDataChanged = fnDataChanged
+        self._logger = logging.getLogger("OpcuaSubscriptionHandler")
 
     async def datachange_notification(self, node: Node, val, data):
         """Callback when subscribed data in the opcua server changes.
@@ -255,12 +610,18 @@ class OpcuaSubscriptionHandler:
             val (_type_): Value of the variable that changed.
             data (_type_): 
         """
-        equipmentModule = await node.get_parent()
-        equipmentModuleName = (await equipmentModule.read_browse_name()).Name
-        variableName = (await node.read_browse_name()).Name
+        # Node names come from the registry, browsing the server here would wait on the
+        # connection that is delivering this notification
+        name = self._nodeRegistry.getName(node.nodeid)
+        if (name == None):
+            self._logger.warning("Received data from unknown node %s." % node.nodeid.to_string())
+            return
+        (equipmentModuleName, variableName) = name
 
         event = {"opcuaEvent": "receivedData"}
         event["data"] = {"me": equipmentModuleName,
                          "var": variableName, "value": val}
 
+        if (self._fnDataChanged != None):
+            await self._fnDataChanged(equipmentModuleName, variableName, val)
         asyncio.create_task(self._eventHandler.handleEvent(event))
@@ -1,12 +1,11 @@
 import asyncio
-import copy
 import logging
 
 from transitions.extensions import AsyncGraphMachine
 
 from masterrecipefinder import MasterRecipeFinder
-from controlrecipesm import ControlRecipeSM
-from controlrecipestorer import ControlRecipeStorer
+from controlrecipesm import ControlRecipeSM, ENGINE_TRANSITIONS
+from productionlogger import ProductionLogger
 
 
 class RecipeHandler:
@@ -44,10 +43,10 @@ class RecipeHandler:
         self._masterRecipes = await self._finder.updateAndGetMasterRecipes()
 
         recipeInfo = {}
-        for recipeName in self._masterRecipes:
+        for recipeName, recipe in self._masterRecipes.items():
             recipeInfo[recipeName] = {}
-            recipeInfo[recipeName]["description"] = self._masterRecipes[recipeName]["description"]
-            recipeInfo[recipeName]["parameters"] = self._masterRecipes[recipeName]["parameters"]
+            recipeInfo[recipeName]["description"] = recipe.description
+            recipeInfo[recipeName]["parameters"] = recipe.parameters
         return recipeInfo
 
     async def startControlRecipe(self, masterRecipeName: str, logInDatabase: bool = True, username: str = None, paramValues: dict = {}):
@@ -99,16 +98,15 @@ class RecipeHandler:
             paramValues=self._currentParamValues
         )
 
-        # TODO: What if user doesn't exist
+        # Stored in the background, the production logger reports unknown users or recipes
         if (self._logInDatabase):
-            await self._storer.storeNewControlRecipe(
+            self._controlRecipeKey = self._productionLogger.logNewControlRecipe(
                 masterRecipeName=masterRecipeName,
                 username=username,
                 paramValues=self._currentParamValues
             )
-            pass
         else:
-            pass
+            self._controlRecipeKey = None
         
         await self._controlRecipeSM.initControlRecipe()
 
@@ -145,16 +143,18 @@ class RecipeHandler:
             emergencyStopDescription (str): Description of the reason for the emergency stop.
         """
         if(self._logInDatabase):
-            await self._storer.addCurrentRecipeAlarm(description=emergencyStopDescription)
+            self._productionLogger.logAlarm(self._controlRecipeKey, emergencyStopDescription)
 
     async def rememberAbortedControlRecipe(self):
-        """Remember the current recipe in case the user wants to continue it later
+        """Remember the current recipe in case the user wants to continue it later.
+        Master recipes are immutable, so the current one is kept by reference.
         """        
-        self._abortedMasterRecipe = copy.deepcopy(self._currentMasterRecipe)
-        self._abortedParamValues = copy.deepcopy(self._currentParamValues)
+        self._abortedMasterRecipe = self._currentMasterRecipe
+        self._abortedParamValues = dict(self._currentParamValues)
         self._abortedCompletedCycles = self._completedCycles
         self._abortedMaxCycles = self._maxCycles
         self._abortedLogInDatabase = self._logInDatabase
+        self._abortedControlRecipeKey = self._controlRecipeKey
 
     async def continueControlRecipe(self):
         """Continue a control recipe after it was aborted. Checks if recipe was completed (all cycles done) or not.
@@ -174,6 +174,7 @@ class RecipeHandler:
             self._completedCycles = self._abortedCompletedCycles
             self._maxCycles = self._abortedMaxCycles
             self._logInDatabase = self._abortedLogInDatabase
+            self._controlRecipeKey = self._abortedControlRecipeKey
             self._paused = False
             self._transitionOnUnpause = False
             await self._controlRecipeSM.initControlRecipe()
@@ -181,15 +182,22 @@ class RecipeHandler:
         else:
             return False
 
-    def __init__(self):
+    def __init__(self, controlRecipeEngine: str = ENGINE_TRANSITIONS, productionLogger: ProductionLogger = None):
         """Constructor.
+
+        Args:
+            controlRecipeEngine (str, optional): Engine used to execute control recipes,
+                controlrecipesm.ENGINE_TRANSITIONS or controlrecipesm.ENGINE_TABLE. Defaults to ENGINE_TRANSITIONS.
+            productionLogger (ProductionLogger, optional): Logger of control recipes in database.
+                Defaults to None, a new one.
         """
         self._finder = MasterRecipeFinder()
         self._controlRecipeSM = ControlRecipeSM(
             fnStartPhases=self._startPhases,
-            fnNotifyFinished=self._onCycleFinished
+            fnNotifyFinished=self._onCycleFinished,
+            engine=controlRecipeEngine
         )
-        self._storer = ControlRecipeStorer()
+        self._productionLogger = productionLogger if (productionLogger != None) else ProductionLogger()
         self._logger = logging.getLogger("RecipeHandler")
         self._eventHandler = None
 
@@ -202,6 +210,8 @@ class RecipeHandler:
         self._completedCycles = 0
         self._maxCycles = 0
         self._logInDatabase = True
+        # Key of the current control recipe in the production logger
+        self._controlRecipeKey = None
 
         # Values for remembering aborted recipe
         self._abortedMasterRecipe = None
@@ -209,6 +219,7 @@ class RecipeHandler:
         self._abortedCompletedCycles = 0
         self._abortedMaxCycles = 0
         self._abortedLogInDatabase = True
+        self._abortedControlRecipeKey = None
 
     async def _onCycleFinished(self):
         """Send message to event handler to notify that a cycle of the recipe has been
@@ -227,7 +238,7 @@ class RecipeHandler:
         self._completedCycles = self._completedCycles + 1
         
         if(self._logInDatabase):
-            await self._storer.setCurrentRecipeProducedAmount(self._completedCycles)
+            self._productionLogger.logProducedAmount(self._controlRecipeKey, self._completedCycles)
 
         await self._eventHandler.handleEvent({"recipeHandlerEvent": "finishedCycle"})
         
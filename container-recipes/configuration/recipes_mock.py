@@ -5,10 +5,25 @@ from jsonsocketserver import JsonSocketServer
 from appstatemachine import AppSM
 from eventhandler import EventHandler
 from recipehandler import RecipeHandler
-from opcuaclient import OpcuaClient, MockOpcuaClient
+from opcuaclient import OpcuaClient
+from plantsimulator import SimulatedOpcuaClient
 from manualcontroller import ManualController
+from metrics import enableMetrics, startLoopLagMonitor, startMetricsServer
+from eventjournal import EventJournal
+from productionlogger import ProductionLogger
 
 PORT = 10000
+# Collect metrics and serve them in Prometheus text format on METRICS_PORT, only to local
+# connections (metrics.METRICS_HOST). Off by default, the endpoint has no authentication
+METRICS_ENABLED = False
+METRICS_PORT = 9100
+# Write every event to a journal in JOURNAL_DIRECTORY, to replay it with benchmarks/replayjournal.py.
+# Off by default: in the container the folder isn't on a volume and the journal takes up to 320 MiB
+JOURNAL_ENABLED = False
+JOURNAL_DIRECTORY = "journal"
+# Control recipes, produced amounts and alarms are written here while the database is down.
+# The folder is a volume (docker-compose.yaml), so records survive recreating the container
+PRODUCTION_LOG_SPILL_FILE = "/var/lib/recipes/productionlog.spill"
 
 
 async def main():
@@ -24,23 +39,31 @@ async def main():
 
     await asyncio.sleep(5)
 
+    if (METRICS_ENABLED):
+        enableMetrics()
+        await startMetricsServer(port=METRICS_PORT)
+        startLoopLagMonitor()
+
     sm = AppSM(makeGraph=False)
     server = JsonSocketServer(port=PORT)
-    opcuaClient = MockOpcuaClient()
-    recipeHandler = RecipeHandler()
+    opcuaClient = SimulatedOpcuaClient(servicesFromDatabase=True)
+    productionLogger = ProductionLogger(spillFile=PRODUCTION_LOG_SPILL_FILE)
+    recipeHandler = RecipeHandler(productionLogger=productionLogger)
     manualController = ManualController()
     eventHandler = EventHandler(
         appSM=sm,
         opcuaClient=opcuaClient,
         recipeHandler=recipeHandler,
         socketServer=server,
-        manualController=manualController
+        manualController=manualController,
+        journal=EventJournal(directory=JOURNAL_DIRECTORY) if JOURNAL_ENABLED else None
         )
 
     await server.start(eventHandler=eventHandler)
     await recipeHandler.setEventHandler(eventHandler=eventHandler)
     await opcuaClient.start(eventHandler=eventHandler)
     await manualController.setEventHandler(eventHandler=eventHandler)
+    await productionLogger.start()
 
     await eventHandler.loop()
 
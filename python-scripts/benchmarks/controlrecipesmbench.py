@@ -0,0 +1,87 @@
+"""Micro-benchmark of ControlRecipeSM, comparing the per-step overhead of the
+transitions engine and the table engine. No database or plant needed.
+
+    python controlrecipesmbench.py --states 20 --cycles 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+from controlrecipesm import ControlRecipeSM, ENGINE_TRANSITIONS, ENGINE_TABLE
+from masterrecipefinder import MasterRecipe
+
+
+def makeLinearRecipe(numStates: int):
+    """Build a master recipe E0 -> E1 -> ... -> En, with one phase per state.
+
+    Returns:
+        MasterRecipe: Recipe.
+    """
+    states = ["E%s" % i for i in range(numStates)]
+    return MasterRecipe.fromDict(
+        name="BENCHMARK",
+        recipe={
+            "description": "Benchmark",
+            "states": states,
+            "initialState": states[0],
+            "finalState": states[-1],
+            "actions": {x: [{"me": "ME_TRANSPORTE", "numSrv": 1, "setpoint_param": None, "default_setpoint": None}]
+                        for x in states},
+            "transitions": [{"name": "tran_%s_%s" % (states[i], states[i + 1]),
+                             "initialState": states[i], "finalState": states[i + 1]}
+                            for i in range(numStates - 1)],
+            "parameters": []
+        },
+        version="1"
+    )
+
+
+async def benchmark(engine: str, recipe: MasterRecipe, cycles: int):
+    """Run several cycles of the recipe, advancing state by state.
+
+    Returns:
+        Tuple[float, float]: Build time (s) and average time per step (s).
+    """
+    finished = []
+
+    async def startPhases(phases):
+        pass
+
+    async def notifyFinished():
+        finished.append(True)
+
+    sm = ControlRecipeSM(fnStartPhases=startPhases, fnNotifyFinished=notifyFinished, engine=engine)
+
+    start = time.perf_counter()
+    sm.buildControlRecipe(recipe)
+    buildTime = time.perf_counter() - start
+
+    steps = 0
+    start = time.perf_counter()
+    for _ in range(cycles):
+        await sm.initControlRecipe()
+        finished.clear()
+        while (not finished):
+            await sm.advanceState()
+            steps = steps + 1
+    stepTime = (time.perf_counter() - start) / steps
+    return buildTime, stepTime
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--states", type=int, default=20)
+    parser.add_argument("--cycles", type=int, default=200)
+    args = parser.parse_args()
+
+    recipe = makeLinearRecipe(args.states)
+    print("%-12s %12s %12s" % ("engine", "build ms", "step us"))
+    for engine in (ENGINE_TRANSITIONS, ENGINE_TABLE):
+        buildTime, stepTime = await benchmark(engine, recipe, args.cycles)
+        print("%-12s %12.3f %12.2f" % (engine, buildTime * 1000, stepTime * 1e6))
+
+asyncio.run(main())
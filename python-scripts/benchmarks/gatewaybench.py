@@ -0,0 +1,127 @@
+"""End to end benchmark of OpcuaClient against a local stand-in of the Node-RED gateway
+(GatewayServer backed by PlantSimulator). Runs the phases of a spinner recipe several times
+and measures phase start latency (startEquipmentPhases() called until the module is running),
+notification latency (state changed in the simulated plant until the client's event
+reaches the event handler) and sessions opened per recipe.
+No plant or Node-RED needed; the variables are read from the database csv files if found.
+The plant runs on a discrete-event clock, or --speed times faster than real time.
+
+    python gatewaybench.py --recipes 20
+"""
+import argparse
+import asyncio
+import collections
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+from gatewayserver import GatewayServer
+from metrics import dumpMetrics, enableMetrics
+from opcuaclient import OpcuaClient
+from plantsimulator import STATE_RUNNING, PlantSimulator, VirtualClock
+
+PORT = 48401
+# Phases launched together in each step of the recipe, as (module, numSrv, setpoint)
+RECIPE_STEPS = [
+    [("ME_BASES", 1, None)],
+    [("ME_TRANSPORTE", 1, None)],
+    [("ME_TRANSPORTE", 4, 2), ("ME_BASES", 2, None)],
+    [("ME_SPINNERS", 1, None)],
+    [("ME_TRANSPORTE", 5, None)],
+    [("ME_TRANSPORTE", 4, 1), ("ME_SPINNERS", 2, None)],
+    [("ME_TRANSPORTE", 2, None)]
+]
+CSV_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "..", "MySQL", "configuration")
+
+
+class BenchmarkEventHandler:
+    """Receives the events of OpcuaClient, timing state notifications.
+    """
+
+    async def handleEvent(self, event: dict):
+        match event.get("opcuaEvent"):
+            case "receivedData":
+                data = event["data"]
+                pending = self.changeTimes[(data["me"], data["value"])]
+                if (len(pending) > 0):
+                    self.notificationLatencies.append(time.perf_counter() - pending.popleft())
+            case "completedPhases":
+                self.completed.set()
+
+    def __init__(self):
+        # Times of state changes in the plant not yet notified, by (module, state)
+        self.changeTimes = collections.defaultdict(collections.deque)
+        self.notificationLatencies = []
+        self.completed = asyncio.Event()
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipes", type=int, default=20, help="Recipes run")
+    parser.add_argument("--speed", type=float, default=0, help="Plant seconds per real second, 0 for a discrete-event clock")
+    parser.add_argument("--csv", default=CSV_DIRECTORY, help="Folder of variables_me.csv and modulos_equipamiento.csv")
+    args = parser.parse_args()
+
+    enableMetrics()
+    simulator = PlantSimulator(clock=VirtualClock(speed=args.speed if (args.speed > 0) else None))
+    server = GatewayServer(simulator, endpoint="opc.tcp://127.0.0.1:%d" % PORT)
+    if (os.path.isfile(os.path.join(args.csv, "variables_me.csv"))):
+        server.loadVariablesFromCsv(args.csv)
+    await server.start()
+
+    eventHandler = BenchmarkEventHandler()
+    startTimes = {}
+    phaseStartLatencies = []
+
+    async def onVariableChanged(module: str, variable: str, value: int):
+        if (variable != "EstadoActual"):
+            return
+        now = time.perf_counter()
+        eventHandler.changeTimes[(module, value)].append(now)
+        if ((value == STATE_RUNNING) and (module in startTimes)):
+            phaseStartLatencies.append(now - startTimes.pop(module))
+    simulator.addListener(onVariableChanged)
+
+    client = OpcuaClient(url="opc.tcp://127.0.0.1:%d" % PORT)
+    start = time.perf_counter()
+    await client.start(eventHandler)
+    while (not client.getStats()["connected"]):
+        await asyncio.sleep(0.01)
+    print("Session opened in %.1f ms" % ((time.perf_counter() - start) * 1e3))
+
+    start = time.perf_counter()
+    for _ in range(args.recipes):
+        for step in RECIPE_STEPS:
+            eventHandler.completed.clear()
+            phases = [{"me": module, "numSrv": numSrv, "setpoint": setpoint} for (module, numSrv, setpoint) in step]
+            stepStart = time.perf_counter()
+            for (module, _, _) in step:
+                startTimes[module] = stepStart
+            await client.startEquipmentPhases(phases)
+            await eventHandler.completed.wait()
+    elapsed = time.perf_counter() - start
+    stats = client.getStats()
+    await client.stop()
+    await server.stop()
+
+    print("%d recipes (%d steps) in %.2f s, %.2f s of plant time" % (
+        args.recipes, args.recipes * len(RECIPE_STEPS), elapsed, simulator.clock.time()))
+    for name, values in (("Phase start latency", phaseStartLatencies), ("Notification latency", eventHandler.notificationLatencies)):
+        print("%-22s n=%-5d mean %7.2f ms  p50 %7.2f ms  p99 %7.2f ms" % (
+            name, len(values), statistics.mean(values) * 1e3, percentile(values, 0.5) * 1e3, percentile(values, 0.99) * 1e3))
+    print("Sessions opened: %d (%.2f per recipe)" % (stats["sessionsOpened"], stats["sessionsOpened"] / args.recipes))
+    print("State notifications: %d, watchdog reads: %d" % (stats["stateNotifications"], stats["watchdogReads"]))
+    print("Method calls served: %s" % server.getStats()["methodCalls"])
+    for labels, histogram in dumpMetrics().get("opcua_call_seconds", {}).items():
+        print("  %-28s n=%-5d mean %7.2f ms" % (labels, histogram["count"], histogram["sum"] / histogram["count"] * 1e3))
+
+
+asyncio.run(main())
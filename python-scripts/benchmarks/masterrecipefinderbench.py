@@ -0,0 +1,101 @@
+"""Benchmark of MasterRecipeFinder.updateMasterRecipes(), comparing the bulk loader
+against querying each recipe one by one.
+
+Both modes are measured doing a full reload (round trips include the version stamp query).
+The cost of an update when no recipe changed is also reported, and the execution counts
+and times of the prepared statements.
+
+Needs a MySQL server with the spinners database:
+
+    python masterrecipefinderbench.py --host localhost --repeats 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+import masterrecipefinder
+import mysqlclient
+from masterrecipefinder import MasterRecipeFinder
+
+
+class RoundTripCounter:
+    """Wraps the sql client functions used by masterrecipefinder to count round trips to the server.
+    """
+
+    def __init__(self, host: str):
+        self.count = 0
+        self._host = host
+        self._mysqlMultipleQueries = mysqlclient.mysqlMultipleQueries
+        self._mysqlPreparedQuery = mysqlclient.mysqlPreparedQuery
+        masterrecipefinder.mysqlMultipleQueries = self._countedMultipleQueries
+        masterrecipefinder.mysqlPreparedQuery = self._countedPreparedQuery
+
+    async def _countedMultipleQueries(self, query, params=None):
+        self.count = self.count + 1
+        return await self._mysqlMultipleQueries(query, params, host=self._host)
+
+    async def _countedPreparedQuery(self, name, query, params=None):
+        self.count = self.count + 1
+        return await self._mysqlPreparedQuery(name, query, params, host=self._host)
+
+
+async def benchmark(finder: MasterRecipeFinder, counter: RoundTripCounter, repeats: int):
+    """Run updateMasterRecipes() several times.
+
+    Returns:
+        Tuple[float, float, Dict]: Round trips per update, average seconds per update, and the recipes loaded.
+    """
+    counter.count = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        # Force a full reload, otherwise the recipe cache skips unchanged recipes
+        finder.invalidate()
+        await finder.updateMasterRecipes()
+    elapsed = time.perf_counter() - start
+    return counter.count / repeats, elapsed / repeats, await finder.getMasterRecipes()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="spinners-mysql")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    counter = RoundTripCounter(args.host)
+
+    # Warm up the connection pool so that both modes start with open connections
+    await mysqlclient.mysqlTestConnection(host=args.host)
+
+    oneByOneTrips, oneByOneTime, oneByOneRecipes = await benchmark(
+        MasterRecipeFinder(bulkLoad=False), counter, args.repeats)
+    bulkTrips, bulkTime, bulkRecipes = await benchmark(
+        MasterRecipeFinder(bulkLoad=True), counter, args.repeats)
+
+    print("Recipes loaded: %s" % len(bulkRecipes))
+    print("%-12s %12s %12s" % ("mode", "round trips", "ms/update"))
+    print("%-12s %12.1f %12.2f" % ("one by one", oneByOneTrips, oneByOneTime * 1000))
+    print("%-12s %12.1f %12.2f" % ("bulk", bulkTrips, bulkTime * 1000))
+    print("Speedup: %.1fx" % (oneByOneTime / bulkTime))
+    print("Same recipes: %s" % (oneByOneRecipes == bulkRecipes))
+
+    # Updating again without changes only queries the version stamps
+    finder = MasterRecipeFinder()
+    await finder.updateMasterRecipes()
+    counter.count = 0
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        await finder.updateMasterRecipes()
+    unchangedTime = (time.perf_counter() - start) / args.repeats
+    print("%-12s %12.1f %12.2f" % ("unchanged", counter.count / args.repeats, unchangedTime * 1000))
+    print("Cache: %s" % finder.getCacheStats())
+
+    print("\n%-24s %10s %9s %10s %10s" % ("prepared statement", "executions", "prepares", "avg (ms)", "max (ms)"))
+    for name, stats in sorted(mysqlclient.getStatementStats().items(), key=lambda item: -item[1]["time"]):
+        print("%-24s %10d %9d %10.3f %10.3f" % (
+            name, stats["executions"], stats["prepares"], stats["avgTime"] * 1e3, stats["maxTime"] * 1e3))
+
+asyncio.run(main())
@@ -0,0 +1,217 @@
+"""Stand-in for the spinners MySQL database, for benchmarks that run without a server.
+
+Builds an in-memory sqlite database from the same files the MySQL container is built from
+(MySQL/configuration/01_createTables.sql and the csv files), adds the MySQL functions used by the
+queries (CRC32, CONCAT_WS, BIT_XOR, LAST_INSERT_ID) and replaces the sql client functions
+imported by the recipes modules, counting round trips. Each round trip can be given a latency,
+to account for the network and server of a real deployment.
+"""
+import asyncio
+import csv
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+from metrics import observe
+
+CONFIGURATION_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "..", "MySQL", "configuration")
+# Tables loaded from csv files, in order of their foreign keys
+CSV_TABLES = ["usuarios", "modulos_equipamiento", "fases_equipamiento", "variables_me", "recetas_maestras",
+              "parametros", "etapas", "fases_etapas", "transiciones"]
+# Names of the sql client functions replaced in the modules
+CLIENT_FUNCTIONS = ["mysqlQuery", "mysqlMultipleQueries", "mysqlPreparedQuery", "mysqlTransaction", "mysqlTestConnection"]
+
+
+class BitXor:
+    """MySQL aggregate BIT_XOR().
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if (value != None):
+            self.value = self.value ^ int(value)
+
+    def finalize(self):
+        return self.value
+
+
+def crc32(value):
+    if (value == None):
+        return None
+    return zlib.crc32(str(value).encode("utf-8"))
+
+
+def concatWs(separator, *values):
+    # NULL values are skipped, as in MySQL
+    return separator.join([str(value) for value in values if value != None])
+
+
+class StandInTransaction:
+    """Same as mysqlclient.MysqlTransaction, on the stand-in database.
+    """
+
+    async def query(self, query: str, params=None):
+        return (await self._database._execute([query], params))[0]
+
+    async def preparedQuery(self, name: str, query: str, params=None):
+        return await self.query(query, params)
+
+    async def multipleQueries(self, query: str, params=None):
+        statements = [statement for statement in query.split(";") if statement.strip() != ""]
+        return await self._database._execute(statements, params)
+
+    @property
+    def lastRowId(self):
+        return self._database._lastRowId
+
+    def __init__(self, database):
+        self._database = database
+
+
+class MysqlStandIn:
+    """In-memory database answering the queries of the recipes modules.
+    """
+
+    def install(self, *modules):
+        """Replace the sql client functions imported by the modules with this database.
+
+        Args:
+            modules (module): Modules that imported any of CLIENT_FUNCTIONS.
+        """
+        for module in modules:
+            for name in CLIENT_FUNCTIONS:
+                if (hasattr(module, name)):
+                    setattr(module, name, getattr(self, name))
+
+    async def mysqlQuery(self, query: str, params=None, **connection):
+        """Same as mysqlclient.mysqlQuery().
+        """
+        return (await self._execute([query], params))[0]
+
+    async def mysqlMultipleQueries(self, query: str, params=None, **connection):
+        """Same as mysqlclient.mysqlMultipleQueries().
+        """
+        statements = [statement for statement in query.split(";") if statement.strip() != ""]
+        return await self._execute(statements, params)
+
+    async def mysqlPreparedQuery(self, name: str, query: str, params=None, **connection):
+        """Same as mysqlclient.mysqlPreparedQuery(), executed as a plain query.
+        """
+        return await self.mysqlQuery(query, params)
+
+    @asynccontextmanager
+    async def mysqlTransaction(self, **connection):
+        """Same as mysqlclient.mysqlTransaction(). The commit counts as a round trip.
+        """
+        self._connection.execute("BEGIN")
+        try:
+            yield StandInTransaction(self)
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        start = time.perf_counter()
+        await self._roundTrip()
+        self._connection.execute("COMMIT")
+        self.time = self.time + time.perf_counter() - start
+
+    async def mysqlTestConnection(self, **connection):
+        """Same as mysqlclient.mysqlTestConnection().
+        """
+        await self._roundTrip()
+
+    def getStats(self):
+        """Get database metrics.
+
+        Returns:
+            Dict: {"roundTrips": Calls to the sql client functions,
+                   "statements": Statements executed,
+                   "time": Time spent in them, including latency (s)}
+        """
+        return {"roundTrips": self.roundTrips, "statements": self.statements, "time": self.time}
+
+    def resetStats(self):
+        self.roundTrips = 0
+        self.statements = 0
+        self.time = 0.0
+
+    def __init__(self, directory: str = CONFIGURATION_DIRECTORY, latency: float = 0):
+        """Constructor.
+
+        Args:
+            directory (str, optional): Folder of 01_createTables.sql and the csv files. Defaults to CONFIGURATION_DIRECTORY.
+            latency (float, optional): Time added to each round trip (s). Defaults to 0.
+        """
+        self._latency = latency
+        self._lastRowId = None
+        self._connection = sqlite3.connect(":memory:", isolation_level=None)
+        self._connection.create_function("CRC32", 1, crc32, deterministic=True)
+        self._connection.create_function("CONCAT_WS", -1, concatWs, deterministic=True)
+        self._connection.create_aggregate("BIT_XOR", 1, BitXor)
+        self._createTables(os.path.join(directory, "01_createTables.sql"))
+        for table in CSV_TABLES:
+            self._loadCsv(table, os.path.join(directory, "%s.csv" % table))
+        self.resetStats()
+
+    def _createTables(self, path: str):
+        """Create the tables of a MySQL script, translated to sqlite.
+        """
+        with open(path, encoding="utf-8") as file:
+            script = file.read()
+        for (table, body) in re.findall(r"CREATE TABLE (\w+) \((.*?)\n\);", script, re.DOTALL):
+            columns = []
+            for line in body.strip().splitlines():
+                line = line.strip().rstrip(",")
+                if (line.startswith(("PRIMARY KEY", "INDEX"))):
+                    continue
+                line = re.sub(r"(\w+) INT NOT NULL AUTO_INCREMENT", r"\1 INTEGER PRIMARY KEY AUTOINCREMENT", line)
+                line = line.replace("UNIQUE KEY", "UNIQUE")
+                columns.append(line)
+            self._connection.execute("CREATE TABLE %s (%s)" % (table, ", ".join(columns)))
+
+    def _loadCsv(self, table: str, path: str):
+        """Load a csv file as done by LOAD DATA INFILE, with NULL as null value.
+        """
+        with open(path, newline="", encoding="utf-8") as file:
+            rows = list(csv.reader(file, delimiter=";"))
+        placeholders = ", ".join(["?"] * len(rows[0]))
+        self._connection.executemany(
+            "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(rows[0]), placeholders),
+            [[None if (value == "NULL") else value for value in row] for row in rows[1:] if len(row) > 0])
+
+    async def _roundTrip(self):
+        self.roundTrips = self.roundTrips + 1
+        if (self._latency > 0):
+            await asyncio.sleep(self._latency)
+
+    async def _execute(self, statements: list, params):
+        """Execute statements, splitting the params between them.
+
+        Returns:
+            List[List[tuple]]: Results of each statement.
+        """
+        start = time.perf_counter()
+        await self._roundTrip()
+        params = list(params or [])
+        results = []
+        for statement in statements:
+            count = statement.count("%s")
+            statementParams = params[:count]
+            params = params[count:]
+            statement = statement.replace("%s", "?").replace("LAST_INSERT_ID()", "last_insert_rowid()")
+            cursor = self._connection.execute(statement, statementParams)
+            results.append(cursor.fetchall())
+            self._lastRowId = cursor.lastrowid
+            self.statements = self.statements + 1
+        elapsed = time.perf_counter() - start
+        self.time = self.time + elapsed
+        statementType = statements[0].split(None, 1)[0].upper() if (len(statements) == 1) else "MULTIPLE"
+        observe("sql_query_seconds", elapsed, statement=statementType)
+        return results
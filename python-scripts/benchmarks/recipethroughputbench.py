@@ -0,0 +1,348 @@
+"""End to end throughput benchmark of the recipes service. Boots the same wiring as recipes.py
+(AppSM, EventHandler, RecipeHandler, JsonSocketServer, ManualController) against a simulated plant
+(PlantSimulator on a discrete-event clock, or running --speed times faster than real time) and an
+in-memory stand-in of the database (mysqlstandin.py), then drives it through the socket like an HMI:
+resets the plant and runs a recipe cycle after another, asking for the recipes and users before each one.
+With the discrete-event clock the plant takes no real time and the runs of the plant are repeated
+exactly; with --speed they depend on the machine's load.
+
+Reports recipe cycles per hour the software can sustain, the software overhead of each cycle
+(wall time with no equipment module running) and the time spent handling each event, events handled per second, database
+round trips per cycle and p50/p99 latency of the HMI commands.
+
+The benchmark is run --runs times and the median of each metric is reported. Results can be
+saved as a baseline and later runs compared against it; a metric worse than the baseline by more
+than --tolerance, and by more than its noise floor, is reported as a regression and the exit status is 1.
+
+    python recipethroughputbench.py --cycles 50 --baseline baselines/recipethroughputbench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+import controlrecipestorer
+import eventhandler
+import masterrecipefinder
+import productionlogger
+import referencedata
+from appstatemachine import AppSM
+from eventhandler import EventHandler
+from jsonsocketserver import JsonSocketServer
+from manualcontroller import ManualController
+from metrics import dumpMetrics, enableMetrics, resetMetrics
+from mysqlstandin import MysqlStandIn
+from plantsimulator import STATE_RUNNING, PlantSimulator, SimulatedOpcuaClient, VirtualClock
+from productionlogger import ProductionLogger
+from recipehandler import RecipeHandler
+from socketcodecs import getCodec
+
+PORT = 10998
+RECIPE = "RECETA_AUTOMATICO"
+RECIPE_PARAMETERS = {"REPETICIONES": 1, "ESTACION_DESTINO": 2}
+USER = "Jorge"
+# Seconds waiting for an answer of the service before giving up
+ANSWER_TIMEOUT = 30
+# Metrics compared with the baseline, as (higher is better, noise floor). A metric only regresses
+# if it is worse by more than the tolerance and by more than the noise floor, in its own units.
+# Latencies are sub-millisecond and their p99 changes several times over between runs.
+BASELINE_METRICS = {
+    "cyclesPerHour": (True, 0),
+    "eventsPerSecond": (True, 0),
+    "overheadPerCycle": (False, 0),
+    "dbRoundTripsPerCycle": (False, 0),
+    "getRecipesP50": (False, 0.001),
+    "getRecipesP99": (False, 0.005),
+    "getUsersP50": (False, 0.001),
+    "getUsersP99": (False, 0.005),
+    "runRecipeP50": (False, 0.001),
+    "runRecipeP99": (False, 0.005)
+}
+
+
+class HmiClient:
+    """Socket client sending commands like the HMI and timing their answers.
+    """
+
+    async def connect(self, port: int):
+        self._reader, self._writer = await asyncio.open_connection("127.0.0.1", port)
+        self._readTask = asyncio.create_task(self._readLoop())
+
+    async def close(self):
+        self._readTask.cancel()
+        self._writer.close()
+
+    def expect(self, isAnswer):
+        """Start waiting for a message satisfying isAnswer, before it can arrive.
+
+        Returns:
+            asyncio.Future: Resolved with the message.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((isAnswer, future))
+        return future
+
+    async def request(self, message: dict, isAnswer):
+        """Send a message and wait for the first message satisfying isAnswer.
+
+        Returns:
+            Tuple[dict, float]: Answer and time from sending (s).
+        """
+        future = self.expect(isAnswer)
+        start = time.perf_counter()
+        self._writer.write(self._codec.encode(message))
+        await self._writer.drain()
+        answer = await asyncio.wait_for(future, ANSWER_TIMEOUT)
+        return answer, time.perf_counter() - start
+
+    def __init__(self):
+        self._codec = getCodec()
+        self._waiters = []
+        self._readTask = None
+
+    async def _readLoop(self):
+        while True:
+            message = self._codec.decode(await self._codec.readFrame(self._reader))
+            for waiter in list(self._waiters):
+                (isAnswer, future) = waiter
+                if ((not future.done()) and isAnswer(message)):
+                    future.set_result(message)
+                    self._waiters.remove(waiter)
+
+
+class PlantBusyTimer:
+    """Measures the real time with some equipment module running, which is time spent
+    waiting for the plant rather than in software.
+    """
+
+    async def onVariableChanged(self, module: str, variable: str, value: int):
+        if (variable != "EstadoActual"):
+            return
+        wasBusy = len(self._running) > 0
+        if (value == STATE_RUNNING):
+            self._running.add(module)
+        else:
+            self._running.discard(module)
+        if ((not wasBusy) and (len(self._running) > 0)):
+            self._busySince = time.perf_counter()
+        elif (wasBusy and (len(self._running) == 0)):
+            self._busyTime = self._busyTime + time.perf_counter() - self._busySince
+
+    def getBusyTime(self):
+        return self._busyTime
+
+    def reset(self):
+        self._busyTime = 0.0
+
+    def __init__(self):
+        self._running = set()
+        self._busySince = None
+        self._busyTime = 0.0
+
+
+def isState(state: str):
+    return lambda message: message.get("state") == state
+
+
+def isAnswerTo(requestId: int):
+    return lambda message: message.get("requestId") == requestId
+
+
+def percentile(values: list, fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def runBenchmark(cycles: int, speed: float, dbLatency: float):
+    """Boot the service, reset the plant and run recipe cycles.
+
+    Returns:
+        Dict: Results, with the keys of BASELINE_METRICS plus details for the report.
+    """
+    database = MysqlStandIn(latency=dbLatency)
+    database.install(eventhandler, masterrecipefinder, controlrecipestorer, productionlogger, referencedata)
+    # The reference data cache is shared by the process, every run starts with it empty
+    referencedata.getReferenceData().invalidate()
+    simulator = PlantSimulator(clock=VirtualClock(speed=speed if (speed > 0) else None))
+    plantBusy = PlantBusyTimer()
+    simulator.addListener(plantBusy.onVariableChanged)
+
+    # Same wiring as recipes.py
+    sm = AppSM(makeGraph=False)
+    server = JsonSocketServer(port=PORT)
+    opcuaClient = SimulatedOpcuaClient(simulator)
+    productionLogger = ProductionLogger()
+    recipeHandler = RecipeHandler(productionLogger=productionLogger)
+    manualController = ManualController()
+    handler = EventHandler(
+        appSM=sm,
+        opcuaClient=opcuaClient,
+        recipeHandler=recipeHandler,
+        socketServer=server,
+        manualController=manualController)
+    await server.start(eventHandler=handler)
+    await recipeHandler.setEventHandler(eventHandler=handler)
+    await opcuaClient.start(eventHandler=handler)
+    await manualController.setEventHandler(eventHandler=handler)
+    await productionLogger.start()
+    loopTask = asyncio.create_task(handler.loop())
+
+    hmi = HmiClient()
+    waitingToReset = hmi.expect(isState("enterWaitingToReset"))
+    await hmi.connect(PORT)
+    await asyncio.wait_for(waitingToReset, ANSWER_TIMEOUT)
+    await hmi.request({"hmiEvent": "resetPlant"}, isState("enterIdle"))
+
+    # Measure only the recipe cycles
+    resetMetrics()
+    database.resetStats()
+    plantBusy.reset()
+    latencies = {"getRecipes": [], "getUsers": [], "runRecipe": []}
+    requestId = 0
+    start = time.perf_counter()
+    plantStart = simulator.clock.time()
+    for _ in range(cycles):
+        for command in ("getRecipes", "getUsers"):
+            requestId = requestId + 1
+            _, latency = await hmi.request({"hmiEvent": command, "requestId": requestId}, isAnswerTo(requestId))
+            latencies[command].append(latency)
+        recipeComplete = hmi.expect(lambda message: message.get("event") == "recipeComplete")
+        idle = hmi.expect(isState("enterIdle"))
+        _, latency = await hmi.request({"hmiEvent": "runRecipe", "recipe": RECIPE, "user": USER,
+                                        "parameters": RECIPE_PARAMETERS}, isState("enterProducingBatch"))
+        latencies["runRecipe"].append(latency)
+        await asyncio.wait_for(recipeComplete, ANSWER_TIMEOUT)
+        await asyncio.wait_for(idle, ANSWER_TIMEOUT)
+    # Records still being written in the background belong to the last cycle
+    await productionLogger.flush()
+    elapsed = time.perf_counter() - start
+    # Real time waiting for the plant, none with the discrete-event clock
+    plantTime = plantBusy.getBusyTime() if (speed > 0) else 0.0
+
+    metrics = dumpMetrics()
+    await hmi.close()
+    # Let the service handle the disconnection before stopping it
+    while (server.getClientCount() > 0):
+        await asyncio.sleep(0.01)
+    await handler.waitUntilIdle()
+    await productionLogger.stop()
+    loopTask.cancel()
+    server._server.close()
+
+    handled = metrics.get("event_handler_seconds", {})
+    events = sum([histogram["count"] for histogram in handled.values()])
+    overhead = elapsed - plantTime
+    results = {
+        "cyclesPerHour": 3600 / (overhead / cycles),
+        "eventsPerSecond": events / elapsed,
+        "overheadPerCycle": overhead / cycles,
+        "dbRoundTripsPerCycle": database.getStats()["roundTrips"] / cycles,
+        "stages": {labels.removeprefix("event="): histogram["sum"] / cycles for labels, histogram in handled.items()},
+        "queueWaitPerCycle": sum([histogram["sum"] for histogram in metrics.get("event_queue_wait_seconds", {}).values()]) / cycles,
+        "dbTimePerCycle": database.getStats()["time"] / cycles,
+        "plantTimePerCycle": (simulator.clock.time() - plantStart) / cycles,
+        "cycles": cycles,
+        "speed": speed
+    }
+    for command, values in latencies.items():
+        results[command + "P50"] = percentile(values, 0.5)
+        results[command + "P99"] = percentile(values, 0.99)
+    return results
+
+
+def medianResults(runs: list):
+    """Median of each metric over several runs, details are those of the median run by cycles per hour.
+
+    Returns:
+        Dict: Results, as returned by runBenchmark().
+    """
+    results = dict(sorted(runs, key=lambda run: run["cyclesPerHour"])[len(runs) // 2])
+    for metric in BASELINE_METRICS:
+        results[metric] = statistics.median([run[metric] for run in runs])
+    results["runs"] = len(runs)
+    return results
+
+
+def printResults(results: dict):
+    cycles = results["cycles"]
+    if (results["runs"] > 1):
+        print("Median of %d runs" % results["runs"])
+    if (results["speed"] > 0):
+        print("%d cycles of %s, plant %gx faster than real time" % (cycles, RECIPE, results["speed"]))
+    else:
+        print("%d cycles of %s, plant on a discrete-event clock" % (cycles, RECIPE))
+    print("Cycles per hour (software limit, plant taking no time): %.0f" % results["cyclesPerHour"])
+    print("Plant time per cycle: %.1f s" % results["plantTimePerCycle"])
+    print("Software overhead per cycle: %.2f ms" % (results["overheadPerCycle"] * 1e3))
+    print("Events per second: %.0f" % results["eventsPerSecond"])
+    print("DB round trips per cycle: %.1f (%.2f ms)" % (results["dbRoundTripsPerCycle"], results["dbTimePerCycle"] * 1e3))
+    print("Queue wait per cycle: %.2f ms" % (results["queueWaitPerCycle"] * 1e3))
+    print("\n%-45s %12s" % ("event handled", "ms per cycle"))
+    for stage, seconds in sorted(results["stages"].items(), key=lambda item: -item[1]):
+        print("%-45s %12.3f" % (stage, seconds * 1e3))
+    print("\n%-12s %10s %10s" % ("command", "p50 (ms)", "p99 (ms)"))
+    for command in ("getRecipes", "getUsers", "runRecipe"):
+        print("%-12s %10.2f %10.2f" % (command, results[command + "P50"] * 1e3, results[command + "P99"] * 1e3))
+
+
+def compareWithBaseline(results: dict, baseline: dict, tolerance: float):
+    """Print the change of each metric against the baseline.
+
+    Returns:
+        List[str]: Metrics worse than the baseline by more than tolerance.
+    """
+    regressions = []
+    print("\n%-22s %12s %12s %9s" % ("metric", "baseline", "now", "change"))
+    for metric, (higherIsBetter, noiseFloor) in BASELINE_METRICS.items():
+        if (metric not in baseline):
+            continue
+        old = baseline[metric]
+        new = results[metric]
+        change = (new - old) / old if (old != 0) else 0
+        worsening = (old - new) if higherIsBetter else (new - old)
+        worse = ((-change if higherIsBetter else change) > tolerance) and (worsening > noiseFloor)
+        if (worse):
+            regressions.append(metric)
+        print("%-22s %12.4g %12.4g %+8.1f%% %s" % (metric, old, new, change * 100, "REGRESSION" if worse else ""))
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=50, help="Recipe cycles run")
+    parser.add_argument("--runs", type=int, default=5, help="Times the benchmark is run, the median is reported")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Plant seconds per real second, 0 for a discrete-event clock (repeatable runs)")
+    parser.add_argument("--dblatency", type=float, default=0.5, help="Latency added to each database round trip (ms)")
+    parser.add_argument("--baseline", help="Baseline to compare with")
+    parser.add_argument("--save", help="Save the results as a baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Relative change considered a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    enableMetrics()
+    runs = []
+    for _ in range(args.runs):
+        runs.append(await runBenchmark(args.cycles, args.speed, args.dblatency / 1000))
+    results = medianResults(runs)
+    printResults(results)
+
+    if (args.save != None):
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump({metric: results[metric] for metric in BASELINE_METRICS}, file, indent=4)
+        print("\nSaved baseline to %s" % args.save)
+    if (args.baseline != None):
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compareWithBaseline(results, json.load(file), args.tolerance)
+        if (len(regressions) > 0):
+            print("\nRegressions: %s" % ", ".join(regressions))
+            sys.exit(1)
+
+
+asyncio.run(main())
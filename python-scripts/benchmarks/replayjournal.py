@@ -0,0 +1,139 @@
+"""Replay an event journal written by the recipes server (see eventjournal.py) through
+EventHandler and the real AppSM, with the OPC UA client, recipe handler, manual controller,
+socket server and database replaced by stubs that only count calls.
+Events generated by AppSM are skipped, they are generated again while replaying.
+
+Each event is fed once the previous ones, and those they generated, have been handled,
+so replays of a journal are deterministic. With --speed the pauses between events are
+kept, scaled (2 is twice as fast); with --speed 0 events are fed as fast as possible,
+which measures the throughput of the event handler.
+
+    python replayjournal.py --journal ../recipes/journal --speed 0
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+import eventhandler
+import referencedata
+from appstatemachine import AppSM
+from eventhandler import EventHandler
+from eventjournal import readJournal
+
+
+class StubComponent:
+    """Stands in for a component of the server: any method can be called and returns a coroutine
+    with a fixed result, as the async methods of the real components do.
+    """
+
+    def __init__(self, results: dict = None):
+        self.calls = collections.Counter()
+        self._results = results or {}
+
+    def __getattr__(self, method: str):
+        async def call(*args, **kwargs):
+            self.calls[method] += 1
+            return self._results.get(method)
+        return call
+
+
+class StubSocketServer:
+    """Stands in for JsonSocketServer, counting messages. Clients are counted from the
+    connections and disconnections in the journal.
+    """
+
+    def send(self, clientId: int, msg: dict):
+        self.messagesSent = self.messagesSent + 1
+
+    def broadcast(self, msg: dict):
+        self.messagesBroadcast = self.messagesBroadcast + 1
+
+    def getClientCount(self):
+        return self.clients
+
+    def __init__(self):
+        self.clients = 0
+        self.messagesSent = 0
+        self.messagesBroadcast = 0
+
+
+async def stubTestConnection():
+    pass
+
+
+async def stubMultipleQueries(query: str, values: tuple = ()):
+    return [[] for statement in query.split(";") if statement.strip() != ""]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--journal", default="journal", help="Folder of the journal")
+    parser.add_argument("--speed", type=float, default=1, help="Speed relative to the recording, 0 for no pauses")
+    parser.add_argument("--verbose", action="store_true", help="Log handled events")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if (args.verbose):
+        logging.getLogger("EventHandler").setLevel(logging.DEBUG)
+
+    eventhandler.mysqlTestConnection = stubTestConnection
+    referencedata.mysqlMultipleQueries = stubMultipleQueries
+    opcuaClient = StubComponent({"abortAllPhases": {}, "resetAllModules": {}})
+    recipeHandler = StubComponent({"continueControlRecipe": True})
+    manualController = StubComponent()
+    socketServer = StubSocketServer()
+    appSM = AppSM(makeGraph=False)
+    handler = EventHandler(
+        appSM=appSM,
+        opcuaClient=opcuaClient,
+        recipeHandler=recipeHandler,
+        socketServer=socketServer,
+        manualController=manualController)
+    loopTask = asyncio.create_task(handler.loop())
+
+    replayed = 0
+    skipped = 0
+    firstTimestamp = None
+    start = time.perf_counter()
+    for timestamp, event in readJournal(args.journal):
+        if ((not isinstance(event, dict)) or ("appSMEvent" in event)):
+            skipped = skipped + 1
+            continue
+        if (firstTimestamp == None):
+            firstTimestamp = timestamp
+        if (args.speed > 0):
+            delay = (timestamp - firstTimestamp) / args.speed - (time.perf_counter() - start)
+            if (delay > 0):
+                await asyncio.sleep(delay)
+
+        # Clients are counted by the socket server before its events are handled
+        if (event.get("socketServerEvent") == "connected"):
+            socketServer.clients = socketServer.clients + 1
+        elif (event.get("error") == "socketClientDisconnected"):
+            socketServer.clients = max(0, socketServer.clients - 1)
+        await handler.handleEvent(event)
+        await handler.waitUntilIdle()
+        replayed = replayed + 1
+    elapsed = time.perf_counter() - start
+    loopTask.cancel()
+
+    machine = appSM.machine
+    print("Replayed %d events (%d skipped) in %.3f s, %.0f events/s" % (
+        replayed, skipped, elapsed, replayed / elapsed if elapsed > 0 else 0))
+    print("Final state: %s" % machine.get_model_state(machine.model).name)
+    print("Messages to clients: %d sent, %d broadcast" % (socketServer.messagesSent, socketServer.messagesBroadcast))
+    for name, component in (("opcuaClient", opcuaClient), ("recipeHandler", recipeHandler),
+                            ("manualController", manualController)):
+        print("%s calls: %s" % (name, dict(component.calls)))
+    print("\n%-45s %8s %14s %14s" % ("event", "count", "avg wait (ms)", "max wait (ms)"))
+    for key, stats in sorted(handler.getQueueStats().items()):
+        print("%-45s %8d %14.3f %14.3f" % (key, stats["count"], stats["averageWait"] * 1e3, stats["maxWait"] * 1e3))
+
+
+asyncio.run(main())
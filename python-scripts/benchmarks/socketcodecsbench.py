@@ -0,0 +1,134 @@
+"""Throughput benchmark of the socket codecs: line delimited json against
+length-prefixed orjson and MessagePack frames. Measures encoding and decoding of
+payloads shaped like the recipe catalogue and the control recipes list, and
+their transfer from JsonSocketServer to a client over loopback.
+No database or plant needed; codecs whose serializer is not installed are skipped.
+
+    python socketcodecsbench.py --recipes 200 --controlrecipes 5000 --messages 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "recipes"))
+
+from jsonsocketserver import JsonSocketServer
+from socketcodecs import CODEC_JSON, FRAME_HEADER_SIZE, MAX_FRAME_SIZE, getAvailableCodecs, getCodec
+
+PORT = 10999
+
+
+def makeRecipeCatalogue(numRecipes: int):
+    """Build a message like the answer to "getRecipes".
+
+    Returns:
+        dict: Message.
+    """
+    recipes = {}
+    for i in range(numRecipes):
+        recipes["RECETA_%s" % i] = {
+            "description": "Receta de prueba numero %s, con una descripcion de longitud realista" % i,
+            "parameters": [["P_%s" % j, "INT"] for j in range(8)]
+        }
+    return {"info": "recipes", "recipes": recipes}
+
+
+def makeControlRecipesList(numControlRecipes: int):
+    """Build a message like the answer to "getControlRecipesList".
+
+    Returns:
+        dict: Message.
+    """
+    return {"list": [{"id": i, "masterRecipe": "RECETA_%s" % (i % 20), "date": "2024-05-%02d 10:%02d:00" % (i % 28 + 1, i % 60)}
+                     for i in range(numControlRecipes)]}
+
+
+def benchmarkCodec(codecName: str, message: dict, repetitions: int):
+    """Encode and decode a message several times.
+
+    Returns:
+        Tuple[int, float, float]: Frame size (bytes), encode time and decode time per message (s).
+    """
+    codec = getCodec(codecName)
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        frame = codec.encode(message)
+    encodeTime = (time.perf_counter() - start) / repetitions
+
+    # Decoders take frames as returned by readFrame(), length prefix already removed
+    payload = frame if (codecName == CODEC_JSON) else frame[FRAME_HEADER_SIZE:]
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        codec.decode(payload)
+    decodeTime = (time.perf_counter() - start) / repetitions
+    return len(frame), encodeTime, decodeTime
+
+
+async def benchmarkTransfer(codecName: str, message: dict, numMessages: int):
+    """Broadcast messages from a JsonSocketServer to a client reading them with the codec.
+
+    Returns:
+        float: Time to receive and decode all messages (s).
+    """
+    class EventHandler:
+        async def handleEvent(self, event):
+            pass
+
+    server = JsonSocketServer(PORT, sendQueueSize=numMessages + 1, sendBufferSize=2 ** 31)
+    await server.start(EventHandler())
+    # Line delimited json can't be read past the default limit of 64 KiB
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT, limit=MAX_FRAME_SIZE)
+
+    # Handshake, answered with line delimited json
+    codec = getCodec(CODEC_JSON)
+    if (codecName != CODEC_JSON):
+        writer.write(codec.encode({"codec": codecName}))
+        await writer.drain()
+        codec.decode(await codec.readFrame(reader))
+        codec = getCodec(codecName)
+    else:
+        while (server.getClientCount() == 0):
+            await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    for _ in range(numMessages):
+        server.broadcast(message)
+    for _ in range(numMessages):
+        codec.decode(await codec.readFrame(reader))
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+    server._server.close()
+    await server._server.wait_closed()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipes", type=int, default=200, help="Recipes in the catalogue")
+    parser.add_argument("--controlrecipes", type=int, default=5000, help="Control recipes in the list")
+    parser.add_argument("--repetitions", type=int, default=200, help="Encodings/decodings per measure")
+    parser.add_argument("--messages", type=int, default=200, help="Messages sent over the socket per measure")
+    args = parser.parse_args()
+
+    payloads = {
+        "catalogue": makeRecipeCatalogue(args.recipes),
+        "controlRecipes": makeControlRecipesList(args.controlrecipes)
+    }
+    codecs = getAvailableCodecs()
+    print("Codecs available: %s" % ", ".join(codecs))
+
+    for payloadName, message in payloads.items():
+        print("\n%s" % payloadName)
+        print("%-8s %10s %12s %12s %14s" % ("codec", "bytes", "encode (us)", "decode (us)", "socket (MB/s)"))
+        for codecName in codecs:
+            size, encodeTime, decodeTime = benchmarkCodec(codecName, message, args.repetitions)
+            transferTime = await benchmarkTransfer(codecName, message, args.messages)
+            print("%-8s %10d %12.1f %12.1f %14.1f" % (
+                codecName, size, encodeTime * 1e6, decodeTime * 1e6,
+                size * args.messages / transferTime / 1e6))
+
+
+asyncio.run(main())
@@ -1,20 +1,42 @@
-import json
 import asyncio
-from collections.abc import Callable
+import logging
+from collections import deque
+from socketcodecs import CODEC_JSON, getAvailableCodecs, getCodec
+
+# Maximum number of messages waiting to be sent to each client
+SEND_QUEUE_SIZE = 256
+# Maximum bytes waiting to be sent to each client
+SEND_BUFFER_SIZE = 1024 * 1024
+# Maximum bytes joined into one write to the socket
+WRITE_COALESCE_SIZE = 64 * 1024
+# Policies when the send queue of a slow client is full
+OVERFLOW_DROP_OLDEST = "dropOldest"  # Discard the oldest broadcast message waiting
+OVERFLOW_DISCONNECT = "disconnect"  # Close the connection
 
 
 class JsonSocketServer:
-    """Async socket server for TCP communication of dictionaries.
+    """Async socket server for TCP communication of dictionaries with several clients.
 
-    Dictionaries are serialized as json and encoded.
+    Dictionaries are serialized as line delimited json by default. A client can switch its connection to
+    another codec (see socketcodecs) by sending {"codec": NAME} as its first message; the server answers
+    {"codec": NAME} with the codec that will be used from then on by both sides, or {"codec": "json"}
+    if the requested one is not available. The answer is the last message sent with the old codec.
 
-    Received data is sent to an event handler. On client connection,
-    the event {"socketServerEvent": "connected"} is sent.
+    Each connected client gets an id. Received data is sent to an event handler,
+    with the key "clientId" added so that replies can be sent to the client that made the request.
+    On client connection and disconnection, the events
+    {"socketServerEvent": "connected", "clientId": ID} and {"error": "socketClientDisconnected", "clientId": ID}
+    are sent.
 
-    Attributes:
-        sendQueue (asyncio.Queue): Put messages here to send them.
+    Messages are sent to one client with send() or to all of them with broadcast().
+    Each client has its own bounded queue of outgoing messages, so a slow client does not delay the others.
+    When the queue of a client is full, the overflow policy either discards its oldest broadcast messages
+    (replies sent with send() are never discarded in favour of newer messages) or disconnects it.
+    A state message {"state": ...} that is broadcast while the previous one is still waiting replaces it.
+    Messages waiting are joined and written to the socket together. A sender of many messages to one client
+    can await waitForRoom() before each of them, to go at the pace the client reads them.
     """
-    
+
     async def start(self, eventHandler: any):
         """Starts the server.
 
@@ -34,7 +56,96 @@ class JsonSocketServer:
         loop = asyncio.get_running_loop()
         loop.create_task(self._server.serve_forever())
 
-    def __init__(self, port: int, EOM="\r\n", encoding="utf-8"):
+    def send(self, clientId: int, message: dict):
+        """Queue a message to be sent to one client.
+
+        Args:
+            clientId (int): Id of the client, as received in the "clientId" key of its events.
+            message (dict): Message to send.
+
+        Returns:
+            bool: True if the message was queued, False if the client is not connected,
+                its queue is full or the message could not be encoded.
+        """
+        connection = self._connections.get(clientId)
+        if (connection == None):
+            self._logger.debug("Client %s is not connected, message discarded." % clientId)
+            return False
+        messageEncoded = self._encode(message, connection.codec)
+        if (messageEncoded == None):
+            return False
+        return self._queue(connection, messageEncoded, droppable=False, isState=False)
+
+    async def waitForRoom(self, clientId: int):
+        """Wait until the queue of a client is at most half full, so that a sender of many messages
+        to one client can go at the pace the client reads them instead of overflowing its queue.
+
+        Args:
+            clientId (int): Id of the client.
+
+        Returns:
+            bool: True if there is room, False if the client is not connected or disconnected while waiting.
+        """
+        connection = self._connections.get(clientId)
+        if (connection == None):
+            return False
+        await connection.roomAvailable.wait()
+        return not connection.closing
+
+    def broadcast(self, message: dict):
+        """Queue a message to be sent to every connected client.
+
+        Args:
+            message (dict): Message to send.
+        """
+        if (len(self._connections) == 0):
+            return
+        # Encoded once for all clients using the same codec
+        messagesEncoded = {}
+        isState = ((len(message) == 1) and ("state" in message))
+        for connection in list(self._connections.values()):
+            codec = connection.codec
+            if (codec.name not in messagesEncoded):
+                messagesEncoded[codec.name] = self._encode(message, codec)
+            if (messagesEncoded[codec.name] != None):
+                self._queue(connection, messagesEncoded[codec.name], droppable=True, isState=isState)
+
+    def getClientCount(self):
+        """Get number of connected clients.
+
+        Returns:
+            int: Number of connected clients.
+        """
+        return len(self._connections)
+
+    def getStats(self):
+        """Get counters of the write path.
+
+        Returns:
+            Dict: {"clients": Connected clients,
+                   "queuedBytes": Bytes waiting to be sent, all clients,
+                   "maxQueuedBytes": Maximum bytes that were waiting to be sent to one client,
+                   "messagesSent": Messages written to sockets,
+                   "bytesSent": Bytes written to sockets,
+                   "dropped": Messages discarded because a queue was full,
+                   "coalesced": State messages replaced by a newer one before being sent,
+                   "slowClientsDisconnected": Clients disconnected because their queue was full,
+                   "flushes": Writes to sockets,
+                   "averageFlushSize": Messages per write,
+                   "maxFlushSize": Maximum messages in one write}
+        """
+        stats = dict(self._stats)
+        stats["clients"] = len(self._connections)
+        stats["queuedBytes"] = sum([connection.queuedBytes for connection in self._connections.values()])
+        if (stats["flushes"] > 0):
+            stats["averageFlushSize"] = stats["messagesSent"] / stats["flushes"]
+        else:
+            stats["averageFlushSize"] = 0
+        return stats
+
+    def __init__(self, port: int, EOM="\r\n", encoding="utf-8", sendQueueSize: int = SEND_QUEUE_SIZE,
+                 sendBufferSize: int = SEND_BUFFER_SIZE, overflowPolicy: str = OVERFLOW_DROP_OLDEST,
+                 coalesceStates: bool = True):
         """Constructor for socket server.
 
         Args:
@@ -42,70 +153,243 @@ class JsonSocketServer:
             EOM (str, optional): Marks the End Of Message.
                 Is deleted from the message when decoding. Defaults to "\\r\\n".
             encoding (str, optional): Byte encoding. **Must be the same on client and server.** Defaults to "utf-8".
+            sendQueueSize (int, optional): Maximum number of messages waiting to be sent to each client.
+                Defaults to SEND_QUEUE_SIZE.
+            sendBufferSize (int, optional): Maximum bytes waiting to be sent to each client.
+                Defaults to SEND_BUFFER_SIZE.
+            overflowPolicy (str, optional): What to do when the queue of a client is full,
+                OVERFLOW_DROP_OLDEST or OVERFLOW_DISCONNECT. Defaults to OVERFLOW_DROP_OLDEST.
+            coalesceStates (bool, optional): Replace state messages still waiting to be sent with newer ones.
+                Defaults to True.
+
+        Raises:
+            ValueError: Unknown overflow policy.
         """
+        if (overflowPolicy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT)):
+            raise ValueError("Unknown overflow policy %s" % overflowPolicy)
         self._eventHandler = None
         self._port = port
         self._EOM = EOM
         self._encoding = encoding
-        self._reader = None
-        self._writer = None
+        self._availableCodecs = getAvailableCodecs()
+        self._sendQueueSize = sendQueueSize
+        self._sendBufferSize = sendBufferSize
+        self._overflowPolicy = overflowPolicy
+        self._coalesceStates = coalesceStates
+        self._logger = logging.getLogger("JsonSocketServer")
 
-        self.sendQueue = asyncio.Queue()
+        self._stats = {
+            "maxQueuedBytes": 0,
+            "messagesSent": 0,
+            "bytesSent": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "slowClientsDisconnected": 0,
+            "flushes": 0,
+            "maxFlushSize": 0
+        }
+
+        # Connected clients by id
+        self._connections = {}
+        self._nextClientId = 1
 
     async def _onConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        """Launches loops to read and write messages to connected client.
+        """Registers the client and runs its read and write loops until it disconnects.
 
         Args:
             reader (asyncio.StreamReader): Stream reader created by asyncio.start_server().
             writer (asyncio.StreamWriter): Stream writer created by asyncio.start_server().
         """
-        self._reader = reader
-        self._writer = writer
+        connection = _ClientConnection(self._nextClientId, reader, writer,
+                                       getCodec(CODEC_JSON, EOM=self._EOM, encoding=self._encoding))
+        self._nextClientId = self._nextClientId + 1
+        self._connections[connection.clientId] = connection
+        self._logger.debug("Client %d connected from %s." % (connection.clientId, writer.get_extra_info("peername")))
+
         # Notify event handler
-        asyncio.create_task(self._eventHandler.handleEvent({"socketServerEvent": "connected"}))
+        await self._eventHandler.handleEvent({"socketServerEvent": "connected", "clientId": connection.clientId})
         # Launch read and write loops
-        asyncio.gather(self._readLoop(), self._writeLoop())
+        writeTask = asyncio.create_task(self._writeLoop(connection))
+        try:
+            await self._readLoop(connection)
+        finally:
+            writeTask.cancel()
+            del self._connections[connection.clientId]
+            # Wake up senders waiting for room
+            connection.closing = True
+            connection.roomAvailable.set()
+            writer.close()
+            self._logger.debug("Client %d disconnected." % connection.clientId)
+            await self._eventHandler.handleEvent({"error": "socketClientDisconnected", "clientId": connection.clientId})
 
-    async def _readLoop(self):
+    async def _readLoop(self, connection: "_ClientConnection"):
         """Reads messages from client, decodes them and sends them to the handler function.
+        Returns when the connection ends.
 
         Sends {"error": "socketServerDecoding"} to message handler if there
         is an error when deserializing and decoding the dictionary.
+        Codec handshakes are answered here and not sent to the handler.
+
+        Args:
+            connection (_ClientConnection): Client to read from.
         """
         while True:
-            # Check if connection ended
-            if (self._reader.at_eof()):
-                loop.create_task(self._fnHandleMessage(
-                    {"error": "socketClientDisconnected"}))
-                await self._writer.write_eof()
-            else:
-                # Wait for message that ends with EOM
-                received = await self._reader.readuntil(self._EOM.encode(self._encoding))
-                loop = asyncio.get_running_loop()
-                try:
-                    message = json.loads(received.decode(
-                        self._encoding).removesuffix(self._EOM))
-                except:
-                    message = {"error": "socketServerDecoding"}
-                finally:
-                    # Send message to external handler
-                    loop.create_task(self._eventHandler.handleEvent(message))
-
-    async def _writeLoop(self):
-        """Encodes and sends messages stored in the queue.
+            # Wait for a whole message
+            try:
+                received = await connection.codec.readFrame(connection.reader)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return
+            try:
+                message = connection.codec.decode(received)
+                if (not isinstance(message, dict)):
+                    raise TypeError("Message is not a dict")
+            except:
+                message = {"error": "socketServerDecoding"}
+            if ((len(message) == 1) and ("codec" in message)):
+                self._switchCodec(connection, message["codec"])
+                continue
+            message["clientId"] = connection.clientId
+            # Send message to external handler
+            await self._eventHandler.handleEvent(message)
+
+    async def _writeLoop(self, connection: "_ClientConnection"):
+        """Sends messages stored in the client's queue.
+        All messages waiting (up to WRITE_COALESCE_SIZE bytes) are written in one call.
+        Closes the connection if writing fails.
+
+        Args:
+            connection (_ClientConnection): Client to write to.
+        """
+        sendQueue = connection.sendQueue
+        try:
+            while True:
+                await connection.dataReady.wait()
+                frames = []
+                size = 0
+                while ((len(sendQueue) > 0) and ((size == 0) or (size + len(sendQueue[0][0]) <= WRITE_COALESCE_SIZE))):
+                    messageEncoded = sendQueue.popleft()[0]
+                    frames.append(messageEncoded)
+                    size = size + len(messageEncoded)
+                connection.queuedBytes = connection.queuedBytes - size
+                if (len(sendQueue) == 0):
+                    connection.dataReady.clear()
+                if (self._hasRoom(connection)):
+                    connection.roomAvailable.set()
+
+                connection.writer.write(b"".join(frames))
+                self._stats["flushes"] = self._stats["flushes"] + 1
+                self._stats["messagesSent"] = self._stats["messagesSent"] + len(frames)
+                self._stats["bytesSent"] = self._stats["bytesSent"] + size
+                self._stats["maxFlushSize"] = max(self._stats["maxFlushSize"], len(frames))
+                await connection.writer.drain()
+        except ConnectionError:
+            connection.writer.close()
+
+    def _encode(self, message: dict, codec: any):
+        """Serialize and encode a message.
 
         Sends {"error": "socketServerEncoding"} to message handler if there
         is an error when serializing and encoding the dictionary.
+
+        Args:
+            message (dict): Message.
+            codec (any): Codec of the connection.
+
+        Returns:
+            bytes: Encoded message, or None if it could not be encoded.
         """
-        while True:
-            message = await self.sendQueue.get()
-            try:
-                messageEncoded = (json.dumps(message) +
-                                  self._EOM).encode(self._encoding)
-            except:
-                loop = asyncio.get_running_loop()
-                loop.create_task(self._eventHandler.handleEvent(
-                    {"error": "socketServerEncoding"}))
-            else:
-                self._writer.write(messageEncoded)
-                await self._writer.drain()
+        try:
+            return codec.encode(message)
+        except:
+            asyncio.create_task(self._eventHandler.handleEvent(
+                {"error": "socketServerEncoding"}))
+            return None
+
+    def _switchCodec(self, connection: "_ClientConnection", codecName: str):
+        """Answer a codec handshake and switch the connection to the agreed codec.
+
+        Args:
+            connection (_ClientConnection): Client.
+            codecName (str): Codec requested by the client.
+        """
+        if (codecName not in self._availableCodecs):
+            self._logger.warning("Client %d requested unavailable codec %s." % (connection.clientId, codecName))
+            codecName = CODEC_JSON
+        # Answer with the old codec, the client switches once it reads it
+        self._queue(connection, connection.codec.encode({"codec": codecName}), droppable=False, isState=False)
+        if (codecName != connection.codec.name):
+            connection.codec = getCodec(codecName, EOM=self._EOM, encoding=self._encoding)
+        self._logger.debug("Client %d uses codec %s." % (connection.clientId, codecName))
+
+    def _queue(self, connection: "_ClientConnection", messageEncoded: bytes, droppable: bool, isState: bool):
+        """Put an encoded message in the queue of a client, applying the overflow policy if it is full.
+
+        Args:
+            connection (_ClientConnection): Client.
+            messageEncoded (bytes): Encoded message.
+            droppable (bool): The message may be discarded to make room for newer ones.
+            isState (bool): The message is a state message, which may replace the previous one.
+
+        Returns:
+            bool: True if queued, False if the message was discarded or the client disconnected.
+        """
+        if (connection.closing):
+            return False
+        sendQueue = connection.sendQueue
+
+        # Replace state message that is still waiting, the client only needs the latest one
+        if (isState and self._coalesceStates and (len(sendQueue) > 0) and sendQueue[-1][2]):
+            connection.queuedBytes = connection.queuedBytes - len(sendQueue.pop()[0])
+            self._stats["coalesced"] = self._stats["coalesced"] + 1
+
+        # Make room
+        while ((len(sendQueue) >= self._sendQueueSize)
+               or ((len(sendQueue) > 0) and (connection.queuedBytes + len(messageEncoded) > self._sendBufferSize))):
+            if (self._overflowPolicy == OVERFLOW_DISCONNECT):
+                self._logger.warning("Send queue of client %d is full, disconnecting it." % connection.clientId)
+                self._stats["slowClientsDisconnected"] = self._stats["slowClientsDisconnected"] + 1
+                connection.closing = True
+                connection.writer.transport.abort()
+                return False
+            oldest = next((i for i, queued in enumerate(sendQueue) if queued[1]), None)
+            self._stats["dropped"] = self._stats["dropped"] + 1
+            if (oldest == None):
+                self._logger.warning("Send queue of client %d is full, message discarded." % connection.clientId)
+                return False
+            connection.queuedBytes = connection.queuedBytes - len(sendQueue[oldest][0])
+            del sendQueue[oldest]
+
+        sendQueue.append((messageEncoded, droppable, isState))
+        connection.queuedBytes = connection.queuedBytes + len(messageEncoded)
+        if (not self._hasRoom(connection)):
+            connection.roomAvailable.clear()
+        self._stats["maxQueuedBytes"] = max(self._stats["maxQueuedBytes"], connection.queuedBytes)
+        connection.dataReady.set()
+        return True
+
+    def _hasRoom(self, connection: "_ClientConnection"):
+        """Check if the queue of a client is at most half full, see waitForRoom().
+        """
+        return ((len(connection.sendQueue) <= self._sendQueueSize // 2)
+                and (connection.queuedBytes <= self._sendBufferSize // 2))
+
+
+class _ClientConnection:
+    """State of a connected client.
+    Messages waiting to be sent are kept as (messageEncoded, droppable, isState).
+    """
+    __slots__ = ("clientId", "reader", "writer", "codec", "sendQueue", "queuedBytes", "dataReady", "roomAvailable",
+                 "closing")
+
+    def __init__(self, clientId: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, codec: any):
+        self.clientId = clientId
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.sendQueue = deque()
+        self.queuedBytes = 0
+        self.dataReady = asyncio.Event()
+        # Set while the queue is at most half full
+        self.roomAvailable = asyncio.Event()
+        self.roomAvailable.set()
+        self.closing = False
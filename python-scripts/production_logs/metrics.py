@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+import logging
+import math
+import signal
+import time
+
+# Upper bounds of the histogram buckets (s)
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds between samples of the asyncio loop lag
+LOOP_LAG_INTERVAL = 0.5
+# Port of the http endpoint serving the metrics in Prometheus text format
+METRICS_PORT = 9100
+
+# Description of each metric, for the Prometheus HELP line
+METRIC_DESCRIPTIONS = {
+    "event_queue_wait_seconds": "Time events wait in the event handler queue.",
+    "event_handler_seconds": "Time the event handler takes to handle an event.",
+    "opcua_call_seconds": "Duration of opcua method calls.",
+    "sql_query_seconds": "Duration of sql queries, including waiting for a pooled connection.",
+    "event_loop_lag_seconds": "Delay of the asyncio loop in waking up a sleeping task."
+}
+
+_logger = logging.getLogger("Metrics")
+_enabled = False
+# Histograms by metric name, then by label values
+_histograms = dict()
+_loopLagTask = None
+_server = None
+
+
+class Histogram:
+    """Cumulative histogram of observed values, with fixed buckets.
+    """
+    __slots__ = ("counts", "sum", "count")
+
+    def observe(self, value: float):
+        """Add a value.
+
+        Args:
+            value (float): Value.
+        """
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def __init__(self):
+        # One more bucket for values above the last bound
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+def enableMetrics(enabled: bool = True):
+    """Enable or disable collecting metrics. While disabled, observe() returns without doing anything.
+
+    Args:
+        enabled (bool, optional): Defaults to True.
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def isMetricsEnabled():
+    """Check if metrics are being collected.
+
+    Returns:
+        bool: True if enabled.
+    """
+    return _enabled
+
+
+def observe(name: str, value: float, **labels: str):
+    """Add a value to a histogram.
+
+    Args:
+        name (str): Metric name, for example "sql_query_seconds".
+        value (float): Value (s).
+        labels (str): Label values, for example statement="SELECT".
+    """
+    if (not _enabled):
+        return
+    series = _histograms.get(name)
+    if (series == None):
+        series = _histograms[name] = dict()
+    key = tuple(labels.items())
+    histogram = series.get(key)
+    if (histogram == None):
+        histogram = series[key] = Histogram()
+    histogram.observe(value)
+
+
+def resetMetrics():
+    """Forget every observed value.
+    """
+    _histograms.clear()
+
+
+def dumpMetrics():
+    """Get a summary of every histogram.
+
+    Returns:
+        Dict: {"METRIC_NAME": {"label=value,...": {"count": Observations, "sum": Sum of the values (s),
+                                                   "p50": Median (s), "p99": 99th percentile (s)}}}
+            Percentiles are the upper bound of the bucket they fall in.
+    """
+    dump = dict()
+    for name, series in _histograms.items():
+        dump[name] = dict()
+        for key, histogram in series.items():
+            dump[name][",".join(["%s=%s" % label for label in key])] = {
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "p50": _percentile(histogram, 0.5),
+                "p99": _percentile(histogram, 0.99)
+            }
+    return dump
+
+
+def renderPrometheus():
+    """Get every histogram in Prometheus text exposition format.
+
+    Returns:
+        str: Metrics.
+    """
+    lines = []
+    for name, series in _histograms.items():
+        if (name in METRIC_DESCRIPTIONS):
+            lines.append("# HELP %s %s" % (name, METRIC_DESCRIPTIONS[name]))
+        lines.append("# TYPE %s histogram" % name)
+        for key, histogram in series.items():
+            labels = ["%s=\"%s\"" % (label, _escapeLabel(value)) for label, value in key]
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS + (math.inf,), histogram.counts):
+                cumulative = cumulative + count
+                le = "+Inf" if (bound == math.inf) else repr(bound)
+                lines.append("%s_bucket{%s} %d" % (name, ",".join(labels + ["le=\"%s\"" % le]), cumulative))
+            labelText = "{%s}" % ",".join(labels) if labels else ""
+            lines.append("%s_sum%s %r" % (name, labelText, histogram.sum))
+            lines.append("%s_count%s %d" % (name, labelText, histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+def startLoopLagMonitor(interval: float = LOOP_LAG_INTERVAL):
+    """Periodically measure how late the asyncio loop wakes up a sleeping task,
+    observed as "event_loop_lag_seconds". Must be called from a running loop.
+
+    Args:
+        interval (float, optional): Seconds between samples. Defaults to LOOP_LAG_INTERVAL.
+    """
+    global _loopLagTask
+    if (_loopLagTask == None):
+        _loopLagTask = asyncio.create_task(_loopLagLoop(interval))
+
+
+async def startMetricsServer(port: int = METRICS_PORT, host: str = "0.0.0.0"):
+    """Serve the metrics in Prometheus text format over http, and log a dump of them on SIGUSR1.
+
+    Args:
+        port (int, optional): Port. Defaults to METRICS_PORT.
+        host (str, optional): Host. Defaults to "0.0.0.0".
+    """
+    global _server
+    if (_server != None):
+        return
+    _server = await asyncio.start_server(_onMetricsRequest, host=host, port=port)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, _logDump)
+    except (NotImplementedError, AttributeError):
+        # No signals on Windows
+        pass
+    _logger.info("Serving metrics on port %d." % port)
+
+
+async def _loopLagLoop(interval: float):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        observe("event_loop_lag_seconds", time.perf_counter() - start - interval)
+
+
+async def _onMetricsRequest(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer any http request with the metrics.
+    """
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = renderPrometheus().encode("utf-8")
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     b"Content-Length: %d\r\n"
+                     b"Connection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _logDump():
+    _logger.warning("Metrics:\n%s" % renderPrometheus())
+
+
+def _percentile(histogram: Histogram, fraction: float):
+    if (histogram.count == 0):
+        return None
+    target = histogram.count * fraction
+    cumulative = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS + (math.inf,), histogram.counts):
+        cumulative = cumulative + count
+        if (cumulative >= target):
+            return bound
+    return math.inf
+
+
+def _escapeLabel(value: any):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
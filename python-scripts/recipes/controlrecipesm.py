@@ -1,54 +1,137 @@
 import logging
-import copy
+import time
+from collections import OrderedDict
 
 from transitions.extensions import AsyncGraphMachine
 from functools import partial
 
+from masterrecipefinder import MasterRecipe, EquipmentPhase
+
 RECIPE_SM_GRAPH_FILENAME = "Recipe.png"
+# Number of compiled state machines kept by each ControlRecipeSM
+RECIPE_SM_CACHE_SIZE = 8
+
+# Engines that can execute a control recipe
+# transitions AsyncGraphMachine (can draw graphs)
+ENGINE_TRANSITIONS = "transitions"
+# Successor table, advancing by direct index lookup
+ENGINE_TABLE = "table"
+
+
+class RecipeTable:
+    """Master recipe compiled into a successor table, used by the table engine.
+    States are referenced by their index.
+
+    Attributes:
+        states (tuple[str]): State names.
+        initial (int): Index of the initial state.
+        final (int): Index of the final state.
+        successors (tuple[tuple[int]]): Indices of the next states of each state, in the order the transitions are defined.
+        phases (tuple[list[dict]]): Phases launched when entering each state, with setpoints resolved.
+            None if the state has no actions. Shared by every run of a cached table, not to be modified.
+    """
+    __slots__ = ("states", "initial", "final", "successors", "phases")
+
+    def __init__(self, states: tuple, initial: int, final: int, successors: tuple, phases: tuple):
+        self.states = states
+        self.initial = initial
+        self.final = final
+        self.successors = successors
+        self.phases = phases
 
 
 class ControlRecipeSM:
-    """State machine for executing individual cycles of a control recipe
+    """State machine for executing individual cycles of a control recipe.
+
+    Recipes can be executed by a transitions AsyncGraphMachine (ENGINE_TRANSITIONS)
+    or by a successor table (ENGINE_TABLE), with the same API.
     """
 
-    def buildControlRecipe(self, masterRecipe: dict, makeGraph: bool = False, paramValues: dict = {}):
+    def buildControlRecipe(self, masterRecipe: MasterRecipe, makeGraph: bool = False, paramValues: dict = {}):
         """Sets up a state machine for a control recipe based off a master recipe.
 
-        Args:
-            masterRecipe (dict): Master recipe dict:
-                {
-                    "description" : "aeiou",
-                    "states" : ['E0', 'E1', 'E2', ...],
-                    "initialState" : "E0",
-                    "finalState" : "E5"
-                    "actions" : {
-                                "E0" : [{"me" : "ME_CODE_1", "numSrv" : numSrv1, "setpoint_param": None, "default_setpoint": None}],
-                                "E1" : [{"me" : "ME_CODE_2", "numSrv" : numSrv2, "setpoint_param": None, "default_setpoint": 30},
-                                        {"me" : "ME_CODE_3", "numSrv" : numSrv3, "setpoint_param": "PARAM_6_NAME", "default_setpoint": -9.5}, ...]
-                                ...
-                                },
-                    "transitions" : [{"name" : "tran_E0_E1", "initialState" : "E0", "finalState" : E1},
-                                     {"name" : "tran_E1_E2", "initialState" : "E1", "finalState" : E2}, ...],
-                    "parameters" : {"PARAM_1_NAME" : "PARAM_1_TYPE",
-                                    "PARAM_2_NAME" : "PARAM_2_TYPE", ...}
-                }
+        Compiled state machines are cached (least recently used are evicted), keyed by master recipe
+        name and version plus the values of the parameters used as setpoints. Building the same recipe
+        again with the same setpoints reuses the cached machine.
 
+        Args:
+            masterRecipe (MasterRecipe): Master recipe, as given by MasterRecipeFinder. It is not modified.
             makeGraph (bool, optional): Save a graph of the state machine. Defaults to False.
+                The machine is always built (not taken from the cache) when a graph is requested.
             paramValues (dict, optional): Parameter values dict. Defaults to {}. Format is:
                 {
                     "PARAM_1_NAME" : Value
                     "PARAM_2_NAME" : Value
                 }
         """
-
-        # Turn transitions dicts into lists to use in the state machine
+        # Only parameters used as setpoints change the machine (not "REPETICIONES", for example)
+        setpointParams = sorted({phase.setpointParam
+                                 for phases in masterRecipe.actions.values()
+                                 for phase in phases
+                                 if phase.setpointParam != None})
+        key = (masterRecipe.name, masterRecipe.version,
+               tuple((param, paramValues.get(param)) for param in setpointParams))
+
+        if ((not makeGraph) and (key in self._cache)):
+            self._cache.move_to_end(key)
+            compiled, buildTime = self._cache[key]
+            if (self._engine == ENGINE_TABLE):
+                self._table = compiled
+            else:
+                self._machine = compiled
+            self._initialState = masterRecipe.initialState
+            self._finalState = masterRecipe.finalState
+            self._cacheHits = self._cacheHits + 1
+            self._buildTimeSaved = self._buildTimeSaved + buildTime
+            self._logger.debug("Reused compiled state machine for %s, saved %.2f ms (total saved %.2f ms)"
+                               % (masterRecipe.name, buildTime * 1000, self._buildTimeSaved * 1000))
+            return
+
+        start = time.perf_counter()
+        if (self._engine == ENGINE_TABLE):
+            if (makeGraph):
+                self._logger.warning("Graphs can only be drawn with the transitions engine.")
+            self._compileRecipeTable(masterRecipe, paramValues)
+            compiled = self._table
+        else:
+            self._compileControlRecipe(masterRecipe, makeGraph, paramValues)
+            compiled = self._machine
+        buildTime = time.perf_counter() - start
+
+        self._cacheMisses = self._cacheMisses + 1
+        self._cache[key] = (compiled, buildTime)
+        if (len(self._cache) > RECIPE_SM_CACHE_SIZE):
+            self._cache.popitem(last=False)
+            self._cacheEvictions = self._cacheEvictions + 1
+        self._logger.debug("Built state machine for %s in %.2f ms" % (masterRecipe.name, buildTime * 1000))
+
+    def getCacheStats(self):
+        """Get counters of the compiled state machine cache.
+
+        Returns:
+            Dict: {"size": Cached machines, "hits": Builds that reused a machine, "misses": Builds that compiled a machine,
+                   "evictions": Machines evicted, "buildTimeSaved": Total build time saved by reusing machines (s)}
+        """
+        return {
+            "size": len(self._cache),
+            "hits": self._cacheHits,
+            "misses": self._cacheMisses,
+            "evictions": self._cacheEvictions,
+            "buildTimeSaved": self._buildTimeSaved
+        }
+
+    def _compileControlRecipe(self, masterRecipe: MasterRecipe, makeGraph: bool, paramValues: dict):
+        """Build a new state machine for a master recipe, with setpoints resolved from paramValues.
+        See buildControlRecipe().
+        """
+        # Turn transitions into lists to use in the state machine
         transitions = []
-        for i in masterRecipe["transitions"]:
-            transitions.append([i["name"], i["initialState"], i["finalState"]])
+        for i in masterRecipe.transitions:
+            transitions.append([i.name, i.initialState, i.finalState])
 
         # Initial and final states
-        self._initialState = masterRecipe["initialState"]
-        self._finalState = masterRecipe["finalState"]
+        self._initialState = masterRecipe.initialState
+        self._finalState = masterRecipe.finalState
 
         if (makeGraph):
             graphEngine = "graphviz"
@@ -56,7 +139,7 @@ class ControlRecipeSM:
             graphEngine = "mermaid"
 
         self._machine = AsyncGraphMachine(
-            states=masterRecipe["states"],
+            states=list(masterRecipe.states),
             initial=self._initialState,
             transitions=transitions,
             ignore_invalid_triggers=True,
@@ -64,16 +147,17 @@ class ControlRecipeSM:
         )
 
         # Associate actions to states
-        for stateName in masterRecipe["actions"]:
+        for stateName in masterRecipe.actions:
             state = self._machine.get_state(stateName)
 
             # Get actions (equipment phases to call) from master recipe
-            phases = self._getPhasesWithSetpointValues(masterRecipe["actions"][stateName], paramValues)
+            phases = self._getPhasesWithSetpointValues(masterRecipe.actions[stateName], paramValues)
 
             debugCallback = partial(
                 self._logger.debug, msg="Triggered on_enter callback of %s" % stateName)
             state.add_callback("enter", debugCallback)
-            callback = partial(self._fnStartPhases, phases=phases)
+            # Callbacks are looked up when the state is entered, so cached machines always use the current ones
+            callback = partial(self._startPhases, phases=phases)
             state.add_callback("enter", callback)
 
         if (makeGraph):
@@ -87,9 +171,40 @@ class ControlRecipeSM:
         self._logger.debug("Finished building control recipe state machine")
         self._logger.debug("Has states %s" % self._machine.states.keys())
 
+    def _compileRecipeTable(self, masterRecipe: MasterRecipe, paramValues: dict):
+        """Compile a master recipe into a successor table, with setpoints resolved from paramValues.
+        See buildControlRecipe().
+        """
+        states = tuple(masterRecipe.states)
+        index = {name: i for i, name in enumerate(states)}
+
+        successors = [[] for _ in states]
+        for i in masterRecipe.transitions:
+            successors[index[i.initialState]].append(index[i.finalState])
+
+        phases = [None] * len(states)
+        for stateName, statePhases in masterRecipe.actions.items():
+            phases[index[stateName]] = self._getPhasesWithSetpointValues(statePhases, paramValues)
+
+        self._initialState = masterRecipe.initialState
+        self._finalState = masterRecipe.finalState
+        self._table = RecipeTable(
+            states=states,
+            initial=index[masterRecipe.initialState],
+            final=index[masterRecipe.finalState],
+            successors=tuple(tuple(x) for x in successors),
+            phases=tuple(phases)
+        )
+        self._logger.debug("Finished building control recipe table with states %s", states)
+
     async def initControlRecipe(self):
         """Sets initial state (also triggering that state's actions).
         """
+        if (self._engine == ENGINE_TABLE):
+            self._logger.debug("Setting initial state %s", self._initialState)
+            await self._enterTableState(self._table.initial)
+            return
+
         self._logger.debug("Setting initial state %s" % self._machine.initial)
 
         await self._machine.init_recipe()
@@ -102,6 +217,10 @@ class ControlRecipeSM:
 
         Sends event that recipe is done if this function is called from the final state.
         """
+        if (self._engine == ENGINE_TABLE):
+            await self._advanceTableState()
+            return
+
         self._logger.debug("Advancing to next state")
 
         currentState = self._machine.get_model_state(self._machine.model)
@@ -126,10 +245,14 @@ class ControlRecipeSM:
     async def retryState(self):
         """Call this function to start current state's phases again.
         """
+        if (self._engine == ENGINE_TABLE):
+            await self._enterTableState(self._stateIndex)
+            return
+
         currentState = self._machine.get_model_state()
         self._machine.set_state(currentState)
 
-    def __init__(self, fnStartPhases: callable, fnNotifyFinished: callable):
+    def __init__(self, fnStartPhases: callable, fnNotifyFinished: callable, engine: str = ENGINE_TRANSITIONS):
         """Constructor.
 
         Args:
@@ -141,15 +264,66 @@ class ControlRecipeSM:
                 ...]
             fnNotifyFinished (callable): Function to call when the current cycle of the control recipe is done. Should be:
                 async fnNotifyFinished();
+            engine (str, optional): Engine that executes the recipe, ENGINE_TRANSITIONS or ENGINE_TABLE.
+                Defaults to ENGINE_TRANSITIONS.
+
+        Raises:
+            ValueError: Unknown engine.
         """
+        if (engine not in (ENGINE_TRANSITIONS, ENGINE_TABLE)):
+            raise ValueError("Unknown control recipe engine %s" % engine)
+        self._engine = engine
         self._machine = None
+        # Table engine: compiled recipe and index of the current state
+        self._table = None
+        self._stateIndex = None
+        # Compiled machines, (machine, build time) by (recipe name, recipe version, setpoint param values)
+        self._cache = OrderedDict()
+        self._cacheHits = 0
+        self._cacheMisses = 0
+        self._cacheEvictions = 0
+        self._buildTimeSaved = 0
         self._fnStartPhases = fnStartPhases
         self._fnNotifyFinished = fnNotifyFinished
         self._logger = logging.getLogger("ControlRecipeSM")
 
-    def _getPhasesWithSetpointValues(self, phasesNoSetpoint: list[dict], paramValues: dict = {}):
-        """From a list of equipment phases with optional fields "setpoint_param", "default_setpoint"
-        return a list specifying the setpoint value.
+    async def _enterTableState(self, stateIndex: int):
+        """Table engine: go to a state and start its phases.
+
+        Args:
+            stateIndex (int): Index of the state in the recipe table.
+        """
+        self._stateIndex = stateIndex
+        phases = self._table.phases[stateIndex]
+        if (phases != None):
+            self._logger.debug("Triggered on_enter callback of %s", self._table.states[stateIndex])
+            await self._startPhases(phases=phases)
+
+    async def _advanceTableState(self):
+        """Table engine: go to the next state, or notify that the cycle is finished if in the final state.
+        If the state has several next states, the first one is taken (like the transitions engine does
+        when the transitions have no conditions).
+        """
+        if (self._stateIndex == self._table.final):
+            self._logger.debug("Already in final state")
+            await self._fnNotifyFinished()
+        else:
+            successors = self._table.successors[self._stateIndex]
+            if (successors):
+                await self._enterTableState(successors[0])
+
+    async def _startPhases(self, phases: list[dict]):
+        """On enter callback of every state. Starts the state's phases.
+        fnStartPhases gets a copy, as the phases belong to a compiled machine that may be cached.
+
+        Args:
+            phases (list[dict]): Phases to launch.
+        """
+        await self._fnStartPhases(phases=[dict(phase) for phase in phases])
+
+    def _getPhasesWithSetpointValues(self, phasesNoSetpoint: tuple[EquipmentPhase, ...], paramValues: dict = {}):
+        """From a list of equipment phases with optional fields setpointParam, defaultSetpoint
+        return a list of phase dicts specifying the setpoint value.
 
         If a param has been specified, prioritises its value.
         If it isn't specified or its value is None, uses the default setpoint.
@@ -157,9 +331,9 @@ class ControlRecipeSM:
         (this should be the case for phases that don't use setpoints).
 
         Args:
-            phasesNoSetpoint (list[dict]): List of phases:
-                [{"me" : "ME_CODE_2", "numSrv" : numSrv2, "setpoint_param": None, "default_setpoint": 30},
-                 {"me" : "ME_CODE_3", "numSrv" : numSrv3, "setpoint_param": "PARAM_2_NAME", "default_setpoint": -9.5}, ...]
+            phasesNoSetpoint (tuple[EquipmentPhase]): Phases of a master recipe state:
+                (EquipmentPhase(me="ME_CODE_2", numSrv=numSrv2, setpointParam=None, defaultSetpoint=30),
+                 EquipmentPhase(me="ME_CODE_3", numSrv=numSrv3, setpointParam="PARAM_2_NAME", defaultSetpoint=-9.5), ...)
             paramValues (dict, optional): Parameter values. Defaults to {}.
                 Structured as:
                     {
@@ -167,31 +341,31 @@ class ControlRecipeSM:
                     "PARAM_2_NAME" : 50
                     }
 
-        """        
-        phases = copy.deepcopy(phasesNoSetpoint)
+        Returns:
+            list[dict]: Phases to launch:
+                [{"me": "ME_CODE_2", "numSrv": numSrv2, "setpoint": 30},
+                 {"me": "ME_CODE_3", "numSrv": numSrv3, "setpoint": 40}, ...]
+        """
+        phases = []
         # Setpoints for equipment phases, based off master recipe defaults and control recipe parameters:
-        for equipmentPhase in phases:
+        for equipmentPhase in phasesNoSetpoint:
             setpoint = None
             # Check if setpoint can be set from a control recipe parameter
-            paramName = equipmentPhase["setpoint_param"]
+            paramName = equipmentPhase.setpointParam
             if (paramName != None):
                 setpoint = paramValues[paramName]
 
             # If setpoint does not have a value yet,
             # set the default value if it exists
             if (setpoint == None):
-                setpoint = equipmentPhase["default_setpoint"]
+                setpoint = equipmentPhase.defaultSetpoint
 
             # (Setpoint may still have 0 value if the phase doesn't use a setpoint at all)
             # (Due to OPC, it has to be changed to a 0 because a none value cant be sent)
             if(setpoint == None):
                 setpoint = 0
 
-            # Store setpoint in phases
-            equipmentPhase["setpoint"] = setpoint
-
-            # Remove data that isn't needed to launch the phase
-            del equipmentPhase["setpoint_param"]
-            del equipmentPhase["default_setpoint"]
+            # Only the data needed to launch the phase is kept
+            phases.append({"me": equipmentPhase.me, "numSrv": equipmentPhase.numSrv, "setpoint": setpoint})
 
-        return phases
\ No newline at end of file
+        return phases
@@ -1,14 +1,15 @@
-import asyncio
-
-from mysqlclient import mysqlQuery, mysqlMultipleQueries
+from mysql.connector.errors import IntegrityError
+from mysqlclient import mysqlMultipleQueries, mysqlTransaction
+from referencedata import getReferenceData
 
 
 class ControlRecipeStorer:
     """Logs control recipes in database
     """
 
-    async def storeNewControlRecipe(self, masterRecipeName: str, username: str, paramValues: dict):
-        """Creates a database entry for a new control recipe.
+    async def storeNewControlRecipe(self, masterRecipeName: str, username: str, paramValues: dict, creationTime: str = None):
+        """Creates a database entry for a new control recipe, with its parameter values and batch.
+        Everything is stored in one transaction, so nothing is stored if any step fails.
 
         Args:
             recipe (str): Master recipe it is based on
@@ -18,103 +19,94 @@ class ControlRecipeStorer:
                     "PARAM_1_NAME" : Value
                     "PARAM_2_NAME" : Value
                 }
-        """
-        masterRecipeID = await mysqlQuery(
-            """
-                SELECT id_receta_maestra
-                FROM recetas_maestras
-                WHERE recetas_maestras.codigo_receta_maestra = %s
-            """,
-            (masterRecipeName,)
-        )
-        # Query returns ID as tuple inside a list - [(masterRecipeID,)]
-        masterRecipeID = masterRecipeID[0][0]
-        userID = await mysqlQuery(
-            """
-                SELECT id_usuario
-                FROM usuarios
-                WHERE usuarios.nombre = %s
-            """,
-            (username,)
-        )
-        # Query returns ID as tuple inside a list - [(userID,)]
-        userID = userID[0][0]
+            creationTime (str, optional): Time the recipe was started, as "YYYY-MM-DD hh:mm:ss".
+                Defaults to None, the current time of the database.
 
-        # Inserting new control recipe
-        controlRecipeID = await mysqlMultipleQueries(
-            """
-                INSERT INTO recetas_control
-                    (id_receta_maestra, id_usuario, cantidad_producida)
-                VALUES
-                    (%s, %s, 0);
+        Raises:
+            ValueError: Master recipe, user or a parameter of the master recipe doesn't exist.
 
-                SELECT LAST_INSERT_ID();
-            """,
-            (masterRecipeID, userID)
-        )
-        # Query returns two results. ID of the newly stored recipe is a tuple inside a list in the second result - [[],[(controlRecipeID,)]]
-        self._currentControlRecipe = controlRecipeID[1][0][0]
+        Returns:
+            int: ID of the new control recipe.
+        """
+        # IDs come from the reference data cache, usually without querying the database
+        referenceData = getReferenceData()
+        masterRecipeID = await referenceData.getMasterRecipeID(masterRecipeName)
+        if (masterRecipeID == None):
+            raise ValueError("Master recipe %s doesn't exist." % masterRecipeName)
+        userID = await referenceData.getUserID(username)
+        if (userID == None):
+            raise ValueError("User %s doesn't exist." % username)
+        paramIDs = await referenceData.getParameterIDs(masterRecipeName, list(paramValues))
+        for param_name in paramValues:
+            if (param_name not in paramIDs):
+                raise ValueError("Master recipe %s has no parameter %s." % (masterRecipeName, param_name))
 
-        # Store parameters values used in control recipe
-        for param_name, param_value in paramValues.items():
-            paramID = await mysqlQuery(
-                """
-                SELECT parametros.id_parametro
-                FROM parametros
-                INNER JOIN recetas_maestras
-                    ON parametros.id_receta_maestra = recetas_maestras.id_receta_maestra
-                WHERE parametros.nombre = %s
-                """,
-                (param_name,)
-            )
-            # Query returns ID as tuple inside a list - [(paramID,)]
-            paramID = paramID[0][0]
-            await mysqlQuery(
+        try:
+            async with mysqlTransaction() as transaction:
+                # Inserting new control recipe
+                await transaction.preparedQuery(
+                    "insertControlRecipe",
+                    """
+                        INSERT INTO recetas_control
+                            (id_receta_maestra, id_usuario, fecha_creada, cantidad_producida)
+                        VALUES
+                            (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP), 0)
+                    """,
+                    (masterRecipeID, userID, creationTime)
+                )
+                controlRecipeID = transaction.lastRowId
+
+                # Store parameters values used in control recipe, all rows in one INSERT, and the new batch
+                query = """
+                    INSERT INTO lotes
+                        (id_receta_control)
+                    VALUES
+                        (%s);
                 """
-                INSERT INTO valores_parametros
-                    (id_parametro, id_receta_control, valor)
-                VALUES
-                    (%s,%s,%s)
-                """,
-                (paramID, self._currentControlRecipe, str(param_value))
-            )
+                params = [controlRecipeID]
+                if (len(paramValues) > 0):
+                    query = query + """
+                    INSERT INTO valores_parametros
+                        (id_parametro, id_receta_control, valor)
+                    VALUES
+                        %s;
+                    """ % ", ".join(["(%s,%s,%s)"] * len(paramValues))
+                    for param_name, param_value in paramValues.items():
+                        params.extend([paramIDs[param_name], controlRecipeID, str(param_value)])
+                await transaction.multipleQueries(query, params)
+        except IntegrityError:
+            # A cached ID may belong to a row deleted since it was loaded
+            referenceData.invalidate()
+            raise
 
-            # Insert new batch
-            await mysqlQuery(
-            """
-                INSERT INTO lotes
-                    (id_receta_control)
-                VALUES
-                    (%s);
-            """,
-            (self._currentControlRecipe, )
-        )
+        return controlRecipeID
 
-    async def setCurrentRecipeProducedAmount(self, amount: int):
-        """Update the produced amount of the current recipe (mysql column "cantidad_producida").
+    async def storeRecipeUpdates(self, producedAmounts: dict, alarms: list):
+        """Update the produced amount of control recipes (mysql column "cantidad_producida")
+        and store alarms, in one round trip.
 
         Args:
-            amount (int): New value for produced amount.
-        """        
-        await mysqlQuery(
-            """
+            producedAmounts (dict): New produced amount of each control recipe {controlRecipeID: amount, ...}
+            alarms (list): Alarms to store, as (controlRecipeID, description, time) tuples,
+                time being "YYYY-MM-DD hh:mm:ss" or None for the current time of the database.
+        """
+        query = ""
+        params = []
+        for controlRecipeID, amount in producedAmounts.items():
+            query = query + """
                 UPDATE recetas_control
                 SET cantidad_producida = %s
-                WHERE recetas_control.id_receta_control = %s
-            """,
-            (amount, self._currentControlRecipe)
-        )
-
-    async def addCurrentRecipeAlarm(self, description: str):
-        await mysqlQuery(
+                WHERE recetas_control.id_receta_control = %s;
             """
+            params.extend([amount, controlRecipeID])
+        if (len(alarms) > 0):
+            query = query + """
                 INSERT INTO alarmas
-                    (id_receta_control, descripcion)
+                    (id_receta_control, descripcion, fecha)
                 VALUES
-                    (%s,%s)
-            """,
-            (self._currentControlRecipe, description)
-        )
-
-    def __init__(self):
-        self._currentControlRecipe = None
+                    %s;
+            """ % ", ".join(["(%s,%s,COALESCE(%s, CURRENT_TIMESTAMP))"] * len(alarms))
+            for alarm in alarms:
+                params.extend(alarm)
+        if (query != ""):
+            await mysqlMultipleQueries(query, params)
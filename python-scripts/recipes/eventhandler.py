@@ -1,16 +1,38 @@
 import asyncio
 import logging
+import time
 from appstatemachine import AppSM
 from recipehandler import RecipeHandler
-from mysqlclient import mysqlTestConnection, mysqlQuery
+from mysqlclient import mysqlTestConnection
 from opcuaclient import OpcuaClient
 from jsonsocketserver import JsonSocketServer
 from manualcontroller import ManualController
+from metrics import observe
+from eventjournal import EventJournal
+from referencedata import getReferenceData
+
+# Priorities of the event queue, lower is handled first
+PRIORITY_SAFETY = 0
+PRIORITY_NORMAL = 1
+# Maximum read-only HMI queries (recipe catalogue, users) running at the same time
+HMI_QUERY_CONCURRENCY = 4
 
 class EventHandler:
     """Event handler. Recieves events in a queue and calls class methods to react to them.
 
     Events are dicts, with first key { "EVENT_TYPE" : "EVENT_CODE" }
+
+    Safety events (emergency stop from the HMI, an equipment module going to aborted state, the last
+    socket client disconnecting) skip ahead of every event waiting in the queue. Besides, the equipment
+    modules are aborted as soon as one of them arrives, without waiting for the event being handled.
+    As normal events queued earlier are handled after it, phases are only started from the states
+    that run them, so they can't start again after an emergency stop.
+
+    Read-only HMI queries ("getRecipes", "getUsers") are answered from their own tasks, so the database
+    doesn't hold back the events that control the plant, which are still handled one at a time and in order.
+    If the query has a "requestId" key, it is copied to the answer.
+
+    If given a journal, every event is written to it as it arrives, to be replayed later.
     """
 
     async def handleEvent(self, event: dict[str, str]):
@@ -21,19 +43,52 @@ class EventHandler:
                 Dict with first key { "EVENT_TYPE" : "EVENT_CODE" }. Events can optionally have more keys (params, etc).
         """
         # self._logger.debug("Got %s", event)
-        await self._eventQueue.put(event)
+        priority = PRIORITY_NORMAL
+        if (self._isSafetyEvent(event)):
+            priority = PRIORITY_SAFETY
+            # Stop the plant now, the state machine reacts once the event is taken from the queue
+            if ((self._pendingAbort == None) or self._pendingAbort.done()):
+                self._logger.debug("Safety event %s, aborting modules.", event)
+                self._pendingAbort = asyncio.create_task(self._opcuaClient.abortAllPhases())
+        # Journal after launching the abort, nothing goes before it
+        if (self._journal != None):
+            self._journal.append(event)
+        # Sequence number keeps events of the same priority in order
+        self._eventCount = self._eventCount + 1
+        await self._eventQueue.put((priority, self._eventCount, time.perf_counter(), event))
+
+    def getQueueStats(self):
+        """Get time waited in the event queue by each type of event.
+
+        Returns:
+            Dict: {"EVENT_TYPE:EVENT_CODE": {"count": Events handled,
+                                             "averageWait": Average time in queue (s),
+                                             "maxWait": Maximum time in queue (s)},
+                   ...}
+        """
+        return {key: {"count": count, "averageWait": totalWait / count, "maxWait": maxWait}
+                for key, (count, totalWait, maxWait) in self._queueWaits.items()}
+
+    async def waitUntilIdle(self):
+        """Wait until every event in the queue, and those they generate, has been handled.
+        """
+        await self._eventQueue.join()
 
     async def loop(self):
         """Endless loop. Read events from event queue. Type can be "error", "appSMEvent",
         "socketServerEvent", "hmiEvent", "opcuaEvent", "recipeHandlerEvent", "manualControllerEvent".
         """        
         while True:
-            event = await self._eventQueue.get()
+            (priority, _, enqueueTime, event) = await self._eventQueue.get()
             self._logger.debug("Handling %s", event)
 
             # Check event is a dict and isn't empty
-            if (isinstance(event, dict) and dict):
+            if (isinstance(event, dict) and event):
                 type = next(iter(event))
+                eventKey = f"{type}:{event[type]}"
+                handlingStart = time.perf_counter()
+                self._recordQueueWait(eventKey, handlingStart - enqueueTime)
+                observe("event_queue_wait_seconds", handlingStart - enqueueTime, event=eventKey)
                 match type:
                     case "error":
                         await self._processError(event)
@@ -51,21 +106,74 @@ class EventHandler:
                         await self._processManualControllerEvent(event)
                     case _:
                         self._logger.info("Event is of unknown type.")
+                observe("event_handler_seconds", time.perf_counter() - handlingStart, event=eventKey)
             else:
                 self._logger.info("Event gotten is an invalid object.")
+            self._eventQueue.task_done()
 
-    def __init__(self, appSM: AppSM, opcuaClient: OpcuaClient, recipeHandler: RecipeHandler, socketServer: JsonSocketServer, manualController: ManualController):
+    def __init__(self, appSM: AppSM, opcuaClient: OpcuaClient, recipeHandler: RecipeHandler, socketServer: JsonSocketServer, manualController: ManualController,
+                 journal: EventJournal = None):
         """Constructor
+
+        Args:
+            journal (EventJournal, optional): Journal where events are written. Defaults to None, no journal.
         """        
-        self._eventQueue = asyncio.Queue()
+        self._eventQueue = asyncio.PriorityQueue()
+        self._eventCount = 0
+        # Abort of the equipment modules launched when a safety event arrived
+        self._pendingAbort = None
+        # Time waited in queue by event "type:code", as [count, totalWait, maxWait]
+        self._queueWaits = {}
+        # Read-only HMI queries running
+        self._querySemaphore = asyncio.Semaphore(HMI_QUERY_CONCURRENCY)
+        self._queryTasks = set()
         self._appSM = appSM
         self._opcuaClient = opcuaClient
         self._recipeHandler = recipeHandler
         self._socketServer = socketServer
         self._manualController = manualController
+        self._journal = journal
+        # Last state sent to socket clients, for clients that connect later
+        self._lastStateMessage = None
         # set up logging
         self._logger = logging.getLogger("EventHandler")
 
+    def _isSafetyEvent(self, event: dict):
+        """Check if an event requires stopping the plant.
+
+        Args:
+            event (dict): Event.
+
+        Returns:
+            bool: True for an emergency stop from the HMI, an equipment module in aborted state
+                or the last socket client disconnecting.
+        """
+        if (not isinstance(event, dict)):
+            return False
+        if (event.get("hmiEvent") == "emergencyStop"):
+            return True
+        if ((event.get("opcuaEvent") == "receivedData")
+                and (event["data"]["var"] == "EstadoActual") and (event["data"]["value"] == 3)):
+            return True
+        if ((event.get("error") == "socketClientDisconnected") and (self._socketServer.getClientCount() == 0)):
+            return True
+        return False
+
+    def _recordQueueWait(self, key: str, wait: float):
+        """Add the time an event waited in queue to its statistics.
+
+        Args:
+            key (str): "EVENT_TYPE:EVENT_CODE".
+            wait (float): Time waited (s).
+        """
+        stats = self._queueWaits.get(key)
+        if (stats == None):
+            self._queueWaits[key] = [1, wait, wait]
+        else:
+            stats[0] = stats[0] + 1
+            stats[1] = stats[1] + wait
+            stats[2] = max(stats[2], wait)
+
     async def _processHmiEvent(self, event: dict[str, str]):
         """React to events coming from the user interface (via the json socket server).
         Event can be "resetPlant","startManualControl","startManualPhases","getRecipes","runRecipe",
@@ -89,22 +197,16 @@ class EventHandler:
                 if (currentState.name == "controllingManually"):
                     await self._manualController.startPhases(phases = event["phases"])
                 else:
-                    asyncio.create_task(
-                        self._socketServer.sendQueue.put({"error": "notInControllingManually"}))
+                    self._socketServer.send(event["clientId"], {"error": "notInControllingManually"})
             case "getRecipes":
                 # Client is requesting recipe list.
                 # Recipe list will be fetched only if in idle state.
                 machine = self._appSM.machine
                 currentState = machine.get_model_state(machine.model)
                 if (currentState.name == "idle"):
-                    recipeInfo = await self._recipeHandler.getMasterRecipes()
-                    self._logger.debug(
-                        "Got master recipes info: %s" % recipeInfo)
-                    asyncio.create_task(self._socketServer.sendQueue.put(
-                        {"info": "recipes", "recipes": recipeInfo}))
+                    self._runQuery(event, self._queryRecipes)
                 else:
-                    asyncio.create_task(
-                        self._socketServer.sendQueue.put({"error": "notInIdle"}))
+                    self._socketServer.send(event["clientId"], {"error": "notInIdle"})
             case "runRecipe":
                 # Client has requested execution of a recipe
                 # Do it only if currently in idle state
@@ -122,8 +224,7 @@ class EventHandler:
                         paramValues=paramValues)
                 else:
                     self._logger.debug("Did not select recipe - not in idle")
-                    asyncio.create_task(
-                        self._socketServer.sendQueue.put({"error": "notInIdle"}))
+                    self._socketServer.send(event["clientId"], {"error": "notInIdle"})
             case "emergencyStop":
                 # Hmi has requested emergency stop
                 # Abort all phases and go to state waitingToReset
@@ -133,10 +234,7 @@ class EventHandler:
             case "unpause":
                 await self._recipeHandler.unpauseControlRecipe()
             case "getUsers":
-                users = await self._getUsers()
-                self._logger.debug("Got list of users: %s" % users)
-                asyncio.create_task(self._socketServer.sendQueue.put(
-                    {"info": "users", "users": users}))
+                self._runQuery(event, self._queryUsers)
             case "continueLastRecipe":
                 machine = self._appSM.machine
                 currentState = machine.get_model_state(machine.model)
@@ -144,11 +242,9 @@ class EventHandler:
                     if (await self._recipeHandler.continueControlRecipe()):
                         await self._appSM.machine.recipeSelected()
                     else:
-                        asyncio.create_task(
-                            self._socketServer.sendQueue.put({"error": "continuedRecipeWasCompleted"}))
+                        self._socketServer.send(event["clientId"], {"error": "continuedRecipeWasCompleted"})
                 else:
-                    asyncio.create_task(
-                        self._socketServer.sendQueue.put({"error": "notInIdle"}))
+                    self._socketServer.send(event["clientId"], {"error": "notInIdle"})
 
     async def _processAppSMEvent(self, event: dict[str, str]):
         """React to events comming from the App state machine (when it changes state).
@@ -159,9 +255,9 @@ class EventHandler:
             event (dict[str, str]): Event.
         """        
         eventCode = event["appSMEvent"]
-        # Tell socket client abour every change in state
-        asyncio.create_task(
-            self._socketServer.sendQueue.put({"state": eventCode}))
+        # Tell socket clients about every change in state
+        self._lastStateMessage = {"state": eventCode}
+        self._socketServer.broadcast(self._lastStateMessage)
         match eventCode:
             case "enterStarting":
                 # In order to start the app, connect to opcua and database servers,
@@ -198,14 +294,20 @@ class EventHandler:
         (connections, disconnects, etc)
         Events can be "connected"
 
+        The first client to connect (re)starts the app. Clients connecting while others are already
+        connected (other operator stations, historian) only get the current state.
+
         Args:
             event (dict[str, str]): Event received
         """
         eventCode = event["socketServerEvent"]
         match eventCode:
             case "connected":
-                await self._emergencyStop(event=event)
-                await self._appSM.start(eventHandler=self)
+                if ((self._socketServer.getClientCount() > 1) and (self._lastStateMessage != None)):
+                    self._socketServer.send(event["clientId"], self._lastStateMessage)
+                else:
+                    await self._emergencyStop(event=event)
+                    await self._appSM.start(eventHandler=self)
 
     async def _processOpcuaEvent(self, event: dict[str, str]):
         """React to events coming from the OPC UA client (changes in subscribed data, finishing phases).
@@ -237,8 +339,7 @@ class EventHandler:
                         await self._recipeHandler.transitionControlRecipe()
                     case "controllingManually":
                         await self._manualController.completePhase()
-                        asyncio.create_task(self._socketServer.sendQueue.put(
-                            {"event": "manualPhasesDone"}))
+                        self._socketServer.broadcast({"event": "manualPhasesDone"})
                 
     async def _processRecipeHandlerEvent(self, event: dict[str, str]):
         """React to events coming from recipe handler (finished recipe, have to start phases, etc.).
@@ -251,7 +352,13 @@ class EventHandler:
         match eventCode:
             case "startPhases":
                 # Recipe handler wants phases to be executed
-                await self._opcuaClient.startEquipmentPhases(event["phases"])
+                # Drop them if the recipe was aborted after asking for them
+                machine = self._appSM.machine
+                currentState = machine.get_model_state(machine.model)
+                if (currentState.name in ("producingBatch", "resetting")):
+                    await self._opcuaClient.startEquipmentPhases(event["phases"])
+                else:
+                    self._logger.info("Did not start phases - not in producingBatch or resetting")
             case "finishedCycle":
                 # TODO: Send info to socket client
                 pass
@@ -263,9 +370,8 @@ class EventHandler:
                     await self._appSM.machine.resetComplete()
                 elif (currentState.name == "producingBatch"):
                     await self._appSM.machine.recipeDone()
-                # Tell socket client
-                asyncio.create_task(self._socketServer.sendQueue.put(
-                    {"event": "recipeComplete"}))
+                # Tell socket clients
+                self._socketServer.broadcast({"event": "recipeComplete"})
 
     async def _processManualControllerEvent(self, event: dict[str, str]):
         """React to events coming from manual controller (when it requests to start phases).
@@ -278,7 +384,13 @@ class EventHandler:
         match eventCode:
             case "startPhases":
                 # Manual control wants phases to be executed
-                await self._opcuaClient.startEquipmentPhases(event["phases"])
+                # Drop them if manual control was aborted after asking for them
+                machine = self._appSM.machine
+                currentState = machine.get_model_state(machine.model)
+                if (currentState.name == "controllingManually"):
+                    await self._opcuaClient.startEquipmentPhases(event["phases"])
+                else:
+                    self._logger.info("Did not start phases - not in controllingManually")
 
     async def _processError(self, error: dict[str, str]):
         """React to error events.
@@ -294,18 +406,71 @@ class EventHandler:
             case "socketServerDecoding":
                 pass
             case "socketClientDisconnected":
-                self._emergencyStop(error)
+                # Stop only when no client is left to control the plant
+                if (self._socketServer.getClientCount() == 0):
+                    await self._emergencyStop(error)
+                else:
+                    # A client connected again before handling it, forget the abort it launched
+                    self._pendingAbort = None
+
+    def _runQuery(self, event: dict, fnQuery):
+        """Answer a read-only HMI query from its own task.
+
+        Args:
+            event (dict): Query event, with the "clientId" of the client to answer.
+            fnQuery (Callable): Coroutine function returning the answer (dict).
+        """
+        task = asyncio.create_task(self._answerQuery(event, fnQuery))
+        # Keep a reference until done, the event loop only keeps weak ones
+        self._queryTasks.add(task)
+        task.add_done_callback(self._queryTasks.discard)
+
+    async def _answerQuery(self, event: dict, fnQuery):
+        """Run a read-only HMI query, limiting how many run at the same time, and send the answer.
+        Sends {"error": "queryFailed"} if the query raises an error.
+
+        Args:
+            event (dict): Query event, with the "clientId" of the client to answer.
+            fnQuery (Callable): Coroutine function returning the answer (dict).
+        """
+        async with self._querySemaphore:
+            try:
+                answer = await fnQuery()
+            except Exception as e:
+                self._logger.warning("Query %s failed: %s" % (event["hmiEvent"], e))
+                answer = {"error": "queryFailed"}
+        if ("requestId" in event):
+            answer["requestId"] = event["requestId"]
+        self._socketServer.send(event["clientId"], answer)
+
+    async def _queryRecipes(self):
+        """Get master recipes info for the HMI.
+
+        Returns:
+            Dict: {"info": "recipes", "recipes": Info of each recipe, see RecipeHandler.getMasterRecipes()}
+        """
+        recipeInfo = await self._recipeHandler.getMasterRecipes()
+        self._logger.debug(
+            "Got master recipes info: %s" % recipeInfo)
+        return {"info": "recipes", "recipes": recipeInfo}
+
+    async def _queryUsers(self):
+        """Get list of users for the HMI.
+
+        Returns:
+            Dict: {"info": "users", "users": List of users}
+        """
+        users = await self._getUsers()
+        self._logger.debug("Got list of users: %s" % users)
+        return {"info": "users", "users": users}
 
     async def _getUsers(self):
-        """Get list of users from database
+        """Get list of users from the reference data cache, loaded from the database
 
         Returns:
             List[str]: List of users
         """
-        users = await mysqlQuery("SELECT nombre FROM usuarios")
-        # Usernames are returned as tuples in a list [(username1,),(username2),...]
-        users = [x[0] for x in users]
-        return users
+        return await getReferenceData().getUsers()
 
     async def _emergencyStop(self, event: dict[str, str]):
         """Stop all running equipment phases. Go to a safe state
@@ -313,8 +478,13 @@ class EventHandler:
         Args:
             event (dict[str, str]): Event that caused the emergency stop. For logging in database.
         """        
-        # Stop all running phases
-        await self._opcuaClient.abortAllPhases()
+        # Stop all running phases, unless being done since the event arrived
+        abortTask = self._pendingAbort
+        self._pendingAbort = None
+        if ((abortTask != None) and (not abortTask.done())):
+            await abortTask
+        else:
+            await self._opcuaClient.abortAllPhases()
 
         machine = self._appSM.machine
         currentState = machine.get_model_state(
@@ -323,9 +493,8 @@ class EventHandler:
             case "resetting":
                 # Go to state waitingToReset
                 await self._appSM.machine.abortProduction()
-                # Tell socket client about it
-                asyncio.create_task(
-                    self._socketServer.sendQueue.put({"event":"recipeAborted"}))
+                # Tell socket clients about it
+                self._socketServer.broadcast({"event":"recipeAborted"})
             case "producingBatch":
                 # Go to state waitingToReset
                 await self._appSM.machine.abortProduction()
@@ -343,11 +512,9 @@ class EventHandler:
                         await self._recipeHandler.storeEmergencyStop("Nueva conexion de cliente socket")
                 # Store control recipe in case it has to be continued later
                 await self._recipeHandler.rememberAbortedControlRecipe()
-                # Tell socket client about it
-                asyncio.create_task(
-                    self._socketServer.sendQueue.put({"event":"recipeAborted"}))
+                # Tell socket clients about it
+                self._socketServer.broadcast({"event":"recipeAborted"})
             case "controllingManually":
                 await self._appSM.machine.abortProduction()
                 await self._manualController.abort()
-                asyncio.create_task(
-                    self._socketServer.sendQueue.put({"event":"phasesAborted"}))
\ No newline at end of file
+                self._socketServer.broadcast({"event":"phasesAborted"})
\ No newline at end of file
@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional compact encoding of the events
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Folder where segments are written
+JOURNAL_DIRECTORY = "journal"
+# A new segment is started when the current one reaches this size (bytes)
+JOURNAL_SEGMENT_SIZE = 16 * 1024 * 1024
+# Oldest segments are deleted when there are more than this, counting the one opened in advance
+JOURNAL_MAX_SEGMENTS = 20
+# When to make written events durable
+FSYNC_ALWAYS = "always"  # After every event. Safest, slowest
+FSYNC_INTERVAL = "interval"  # At most once every fsyncInterval seconds
+FSYNC_NEVER = "never"  # Left to the operating system
+JOURNAL_FSYNC_INTERVAL = 1
+
+# Segment header: magic, format version, encoding of the events
+SEGMENT_HEADER = struct.Struct("<4sBB")
+SEGMENT_MAGIC = b"SPEJ"
+SEGMENT_VERSION = 1
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+# Record header: payload length, crc32 of the payload, timestamp (time.time())
+RECORD_HEADER = struct.Struct("<IId")
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".journal"
+
+
+class EventJournal:
+    """Append-only journal of events, for reproducing incidents and benchmarking with real event traces.
+
+    Events are written to segment files in a folder, each record being its timestamp and the event
+    encoded with MessagePack (json if not installed), protected by a crc32. When a segment reaches
+    segmentSize a new one is started, and the oldest are deleted to keep at most maxSegments.
+
+    Writes are buffered; fsyncPolicy decides when they are forced to disk. Syncs, closing full segments,
+    opening the next segment in advance and deleting old ones are done by a thread of the journal, in order,
+    so append() never waits for the disk (unless the thread is still opening the segment it needs).
+    Read the journal with readJournal().
+    """
+
+    def append(self, event: dict, timestamp: float = None):
+        """Write an event.
+
+        Args:
+            event (dict): Event.
+            timestamp (float, optional): time.time() of the event. Defaults to None, now.
+        """
+        if (timestamp == None):
+            timestamp = time.time()
+        if (self._file == None):
+            self._takeSegment()
+        payload = self._encode(event)
+        self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), timestamp) + payload)
+        self._segmentSize = self._segmentSize + RECORD_HEADER.size + len(payload)
+        self._eventsWritten = self._eventsWritten + 1
+
+        if (self._fsyncPolicy == FSYNC_ALWAYS):
+            self._sync()
+        elif ((self._fsyncPolicy == FSYNC_INTERVAL) and (time.monotonic() - self._lastSync >= self._fsyncInterval)):
+            self._sync()
+        if (self._segmentSize >= self._maxSegmentSize):
+            self._closeSegment()
+
+    def close(self):
+        """Write pending events to disk and close the current segment, deleting the one opened in advance.
+        Waits for the sync thread.
+        """
+        if (self._file != None):
+            self._closeSegment()
+        if (self._nextSegment != None):
+            self._lastSyncTask = self._syncThread.submit(self._discardSegment, self._nextSegment)
+            self._nextSegment = None
+        if (self._lastSyncTask != None):
+            self._lastSyncTask.result()
+
+    def getStats(self):
+        """Get journal metrics.
+
+        Returns:
+            Dict: {"eventsWritten": Events written since start,
+                   "syncs": Times written events were forced to disk,
+                   "segment": Path of the current segment, or None}
+        """
+        return {
+            "eventsWritten": self._eventsWritten,
+            "syncs": self._syncs,
+            "segment": self._path
+        }
+
+    def __init__(self, directory: str = JOURNAL_DIRECTORY, segmentSize: int = JOURNAL_SEGMENT_SIZE,
+                 maxSegments: int = JOURNAL_MAX_SEGMENTS, fsyncPolicy: str = FSYNC_INTERVAL,
+                 fsyncInterval: float = JOURNAL_FSYNC_INTERVAL):
+        """Constructor.
+
+        Args:
+            directory (str, optional): Folder for the segments, created if needed. Defaults to JOURNAL_DIRECTORY.
+            segmentSize (int, optional): Size of a segment before starting another one (bytes). Defaults to JOURNAL_SEGMENT_SIZE.
+            maxSegments (int, optional): Segments kept, at least 2 as the next one is opened in advance.
+                Defaults to JOURNAL_MAX_SEGMENTS.
+            fsyncPolicy (str, optional): FSYNC_ALWAYS, FSYNC_INTERVAL or FSYNC_NEVER. Defaults to FSYNC_INTERVAL.
+            fsyncInterval (float, optional): Seconds between syncs for FSYNC_INTERVAL. Defaults to JOURNAL_FSYNC_INTERVAL.
+
+        Raises:
+            ValueError: Unknown fsync policy, or less than 2 segments.
+        """
+        if (fsyncPolicy not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)):
+            raise ValueError("Unknown fsync policy %s" % fsyncPolicy)
+        if (maxSegments < 2):
+            raise ValueError("At least 2 segments are needed, got %d" % maxSegments)
+        self._directory = directory
+        self._maxSegmentSize = segmentSize
+        self._maxSegments = maxSegments
+        self._fsyncPolicy = fsyncPolicy
+        self._fsyncInterval = fsyncInterval
+        self._encoding = ENCODING_MSGPACK if (msgpack != None) else ENCODING_JSON
+        self._logger = logging.getLogger("EventJournal")
+
+        self._file = None
+        self._path = None
+        self._segmentSize = 0
+        self._lastSync = time.monotonic()
+        # Single thread, so syncs and closes run in the order they were requested
+        self._syncThread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="EventJournal")
+        self._lastSyncTask = None
+        # Segment opened in advance by the sync thread, future of (path, file)
+        self._nextSegment = self._syncThread.submit(self._openSegmentFile)
+
+        # Metrics
+        self._eventsWritten = 0
+        self._syncs = 0
+
+    def _encode(self, event: dict):
+        # Values that can't be encoded (dates, etc.) are written as strings
+        if (self._encoding == ENCODING_MSGPACK):
+            return msgpack.packb(event, default=str)
+        return json.dumps(event, default=str).encode("utf-8")
+
+    def _takeSegment(self):
+        """Start writing the segment opened in advance, and have the sync thread open the next one.
+
+        Raises:
+            OSError: The segment could not be opened. The next append() tries again.
+        """
+        nextSegment = self._nextSegment
+        if (nextSegment == None):
+            nextSegment = self._syncThread.submit(self._openSegmentFile)
+        self._nextSegment = self._syncThread.submit(self._openSegmentFile)
+        (self._path, self._file) = nextSegment.result()
+        self._segmentSize = SEGMENT_HEADER.size
+        self._logger.debug("Writing journal segment %s." % self._path)
+
+    def _openSegmentFile(self):
+        """Create a segment after the last one in the folder, deleting the oldest if there are too many.
+        Runs in the sync thread.
+
+        Returns:
+            Tuple[str, file]: Path and file of the segment, with its header written.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        segments = listSegments(self._directory)
+        if (len(segments) > 0):
+            index = _segmentIndex(segments[-1]) + 1
+        else:
+            index = 0
+        # The newest segment, which may be being written, is never deleted as there are at least 2
+        for path in segments[:max(0, len(segments) + 1 - self._maxSegments)]:
+            self._logger.debug("Deleting old segment %s." % path)
+            os.remove(path)
+
+        path = os.path.join(self._directory, "%s%08d%s" % (SEGMENT_PREFIX, index, SEGMENT_SUFFIX))
+        file = open(path, "ab")
+        file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self._encoding))
+        return (path, file)
+
+    def _discardSegment(self, segment):
+        """Close and delete a segment opened in advance that wasn't used. Runs in the sync thread.
+
+        Args:
+            segment (Future): Future of (path, file), see _openSegmentFile().
+        """
+        try:
+            (path, file) = segment.result()
+            file.close()
+            os.remove(path)
+        except OSError as e:
+            self._logger.warning("Could not delete unused segment: %s" % e)
+
+    def _closeSegment(self):
+        self._sync(close=True)
+        self._file = None
+        self._path = None
+
+    def _sync(self, close: bool = False):
+        """Pass the buffered events to the operating system, and have the sync thread force them to disk.
+
+        Args:
+            close (bool, optional): Close the file once synced. Defaults to False.
+        """
+        self._file.flush()
+        self._lastSync = time.monotonic()
+        self._lastSyncTask = self._syncThread.submit(self._syncFile, self._file, close)
+
+    def _syncFile(self, file, close: bool):
+        """Force a file to disk, closing it if asked. Runs in the sync thread.
+        """
+        try:
+            os.fsync(file.fileno())
+            self._syncs = self._syncs + 1
+        except OSError as e:
+            self._logger.error("Could not sync %s: %s" % (file.name, e))
+        if (close):
+            file.close()
+
+
+def listSegments(directory: str):
+    """Get the segments of a journal, oldest first.
+
+    Args:
+        directory (str): Folder of the journal.
+
+    Returns:
+        List[str]: Paths of the segments.
+    """
+    if (not os.path.isdir(directory)):
+        return []
+    names = [name for name in os.listdir(directory) if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+    return [os.path.join(directory, name) for name in sorted(names, key=_segmentIndex)]
+
+
+def readJournal(directory: str = JOURNAL_DIRECTORY):
+    """Read every event of a journal, oldest first.
+    A record cut short or corrupted (for example by a crash while writing) ends its segment.
+
+    Args:
+        directory (str, optional): Folder of the journal. Defaults to JOURNAL_DIRECTORY.
+
+    Yields:
+        Tuple[float, dict]: (timestamp, event)
+    """
+    logger = logging.getLogger("EventJournal")
+    for path in listSegments(directory):
+        with open(path, "rb") as file:
+            header = file.read(SEGMENT_HEADER.size)
+            if (len(header) < SEGMENT_HEADER.size):
+                continue
+            magic, version, encoding = SEGMENT_HEADER.unpack(header)
+            if ((magic != SEGMENT_MAGIC) or (version != SEGMENT_VERSION)):
+                logger.warning("%s is not a journal segment, skipped." % path)
+                continue
+            if ((encoding == ENCODING_MSGPACK) and (msgpack == None)):
+                raise ImportError("msgpack is needed to read %s" % path)
+
+            while True:
+                recordHeader = file.read(RECORD_HEADER.size)
+                if (len(recordHeader) == 0):
+                    break
+                if (len(recordHeader) < RECORD_HEADER.size):
+                    logger.warning("Incomplete record at the end of %s." % path)
+                    break
+                length, crc, timestamp = RECORD_HEADER.unpack(recordHeader)
+                payload = file.read(length)
+                if ((len(payload) < length) or (zlib.crc32(payload) != crc)):
+                    logger.warning("Incomplete or corrupted record at the end of %s." % path)
+                    break
+                if (encoding == ENCODING_MSGPACK):
+                    yield (timestamp, msgpack.unpackb(payload))
+                else:
+                    yield (timestamp, json.loads(payload))
+
+
+def _segmentIndex(path: str):
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
@@ -0,0 +1,531 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+
+from mysqlclient import mysqlQuery
+from opcuaclient import EQUIPMENT_MODULES, SUBSCRIBED_VARIABLES
+
+# States of the equipment modules, as in variable EstadoActual
+STATE_IDLE = 0
+STATE_RUNNING = 1
+STATE_COMPLETE = 2
+STATE_ABORTED = 3
+# Services of each equipment module by number, as in table fases_equipamiento.
+# Used when they are not loaded from the database.
+SIMULATED_SERVICES = {
+    "ME_TRANSPORTE": {0: "None", 1: "CogerBase", 2: "PosarBase", 3: "IrAPosicion", 4: "IrAEstacion",
+                      5: "CogerSpinner", 6: "RearmePosicionNeutra", 7: "RearmeDejarPieza"},
+    "ME_BASES": {0: "None", 1: "ExtenderBase", 2: "Rearme"},
+    "ME_SPINNERS": {0: "None", 1: "DispensarSpinner", 2: "Rearme"}
+}
+# Seconds (of plant time) each service takes, by service description
+SERVICE_DURATIONS = {
+    "None": 0,
+    "CogerBase": 4,
+    "PosarBase": 4,
+    "IrAPosicion": 6,
+    "IrAEstacion": 6,
+    "CogerSpinner": 4,
+    "RearmePosicionNeutra": 5,
+    "RearmeDejarPieza": 5,
+    "ExtenderBase": 2,
+    "DispensarSpinner": 3,
+    "Rearme": 2
+}
+# Seconds taken by services not in SERVICE_DURATIONS
+DEFAULT_SERVICE_DURATION = 1
+# Seconds (of plant time) taken by a call to a gateway method
+SIMULATED_CALL_LATENCY = 0.05
+# Plant seconds per real second, None for a discrete-event clock
+SIMULATION_SPEED = 1
+# Times the discrete-event clock yields to other tasks before checking that the event loop is idle
+CLOCK_IDLE_YIELDS = 3
+
+
+class VirtualClock:
+    """Clock of the simulated plant.
+
+    With a speed, plant time is real time running speed times faster. Timers and notifications then
+    interleave with the rest of the program depending on the machine and its load, so runs are
+    not deterministic, but the plant can be watched as it runs.
+
+    Without a speed the clock is a discrete-event one: plant time only advances when every task is
+    waiting, jumping to the next pending sleep(). Sleeps ending at the same time wake up in the
+    order they started. Everything the program does in reaction to a change in the plant is done
+    before plant time advances again, so runs are repeated exactly, as fast as the program allows.
+    Tasks waiting for real time or network I/O look idle, plant time can advance meanwhile.
+    """
+
+    def time(self):
+        """Get plant time.
+
+        Returns:
+            float: Seconds since the clock was created.
+        """
+        if (self._speed == None):
+            return self._now
+        return (time.monotonic() - self._start) * self._speed
+
+    async def sleep(self, seconds: float):
+        """Sleep for a time of the plant.
+
+        Args:
+            seconds (float): Plant seconds.
+        """
+        if (self._speed != None):
+            await asyncio.sleep(seconds / self._speed)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._timerCount = self._timerCount + 1
+        heapq.heappush(self._timers, (self._now + max(seconds, 0), self._timerCount, future))
+        if ((self._advanceTask == None) or self._advanceTask.done()):
+            self._advanceTask = asyncio.create_task(self._advanceLoop())
+        await future
+
+    def __init__(self, speed: float = SIMULATION_SPEED):
+        """Constructor.
+
+        Args:
+            speed (float, optional): Plant seconds per real second, None for a discrete-event clock.
+                Defaults to SIMULATION_SPEED.
+        """
+        self._speed = speed
+        self._start = time.monotonic()
+        # Discrete-event clock: plant time, and pending sleeps as (wake up time, order, future)
+        self._now = 0.0
+        self._timers = []
+        self._timerCount = 0
+        self._advanceTask = None
+
+    async def _advanceLoop(self):
+        """Wake up pending sleeps in order of plant time, each one once the event loop is idle.
+        """
+        loop = asyncio.get_running_loop()
+        while (len(self._timers) > 0):
+            for _ in range(CLOCK_IDLE_YIELDS):
+                await asyncio.sleep(0)
+            # Callbacks ready to run are tasks that aren't waiting yet
+            if (len(getattr(loop, "_ready", ())) > 0):
+                continue
+            (wakeUpTime, _, future) = heapq.heappop(self._timers)
+            # Sleeps of cancelled tasks are dropped without advancing
+            if (not future.done()):
+                self._now = max(self._now, wakeUpTime)
+                future.set_result(None)
+
+
+class PlantSimulator:
+    """Simulation of the equipment modules behind the opcua gateway.
+
+    Each module runs one service at a time, going from idle to running, and to complete once the
+    service's duration has passed. Completing the phase or resetting the module takes it back to idle,
+    and aborting takes running modules to aborted state. Faults make a service end in aborted state
+    halfway through; they can be injected for the next service of a module or happen at random with
+    faultProbability. Random faults come from a generator with a fixed seed, so a run can be repeated.
+
+    Listeners are awaited on every change of the module variables ("EstadoActual", "ServicioActual").
+    """
+
+    async def loadServicesFromDatabase(self):
+        """Load the services of each equipment module from table fases_equipamiento.
+        Sql client will raise error on timeout or conection error.
+        """
+        rows = await mysqlQuery("""
+            SELECT modulos_equipamiento.codigo_modulo_equipamiento, fases_equipamiento.num_srv, fases_equipamiento.descripcion
+            FROM fases_equipamiento
+            INNER JOIN modulos_equipamiento ON fases_equipamiento.id_modulo_equipamiento = modulos_equipamiento.id_modulo_equipamiento;
+        """)
+        services = {}
+        for (equipmentModuleName, numSrv, description) in rows:
+            services.setdefault(equipmentModuleName, {})[numSrv] = description
+        self._services = services
+        self._logger.debug("Loaded %d services from database." % len(rows))
+
+    def addListener(self, fnChanged):
+        """Add a coroutine function to be awaited on every change of a module variable, as
+        fnChanged(equipmentModuleName, variableName, value).
+
+        Args:
+            fnChanged (Callable): Listener.
+        """
+        self._listeners.append(fnChanged)
+
+    def getState(self, equipmentModuleName: str):
+        """Get the state of a module.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+
+        Returns:
+            int: STATE_IDLE, STATE_RUNNING, STATE_COMPLETE or STATE_ABORTED.
+        """
+        return self._states[equipmentModuleName]
+
+    def getCurrentService(self, equipmentModuleName: str):
+        """Get the service a module is running or has just run.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+
+        Returns:
+            int: Service number, 0 if none.
+        """
+        return self._currentServices[equipmentModuleName]
+
+    def getModules(self):
+        """Get the names of the simulated modules.
+
+        Returns:
+            List[str]: Module names.
+        """
+        return list(self._states)
+
+    def getServices(self):
+        """Get the services of each module.
+
+        Returns:
+            Dict: {"EQUIPMENT_MODULE_NAME": {numSrv: "Description", ...}, ...}
+        """
+        return self._services
+
+    def getServiceDuration(self, equipmentModuleName: str, numSrv: int):
+        """Get the plant time a service takes.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+            numSrv (int): Service number.
+
+        Returns:
+            float: Duration (s).
+        """
+        description = self._services.get(equipmentModuleName, {}).get(numSrv)
+        return self._durations.get(description, DEFAULT_SERVICE_DURATION)
+
+    def injectFault(self, equipmentModuleName: str, numSrv: int = None):
+        """Make the next service run by a module end in aborted state.
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+            numSrv (int, optional): Only fail when running this service. Defaults to None, any service.
+        """
+        self._injectedFaults[equipmentModuleName] = numSrv
+
+    async def startPhase(self, equipmentModuleName: str, numSrv: int, setpoint: int = 0):
+        """Start a service of an idle module (gateway method IniciarFase).
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+            numSrv (int): Service number.
+            setpoint (int, optional): Setpoint of the service. Defaults to 0.
+
+        Raises:
+            ValueError: Unknown module or service, or the module is not idle.
+        """
+        if (equipmentModuleName not in self._states):
+            raise ValueError("Unknown equipment module %s" % equipmentModuleName)
+        if (numSrv not in self._services.get(equipmentModuleName, {})):
+            raise ValueError("Unknown service %s of %s" % (numSrv, equipmentModuleName))
+        if (self._states[equipmentModuleName] != STATE_IDLE):
+            raise ValueError("%s is not idle (state %s)" % (equipmentModuleName, self._states[equipmentModuleName]))
+
+        duration = self.getServiceDuration(equipmentModuleName, numSrv)
+        fails = self._takeFault(equipmentModuleName, numSrv)
+        self._phasesStarted = self._phasesStarted + 1
+        await self._setVariable(equipmentModuleName, "ServicioActual", numSrv)
+        await self._setVariable(equipmentModuleName, "EstadoActual", STATE_RUNNING)
+        self._tasks[equipmentModuleName] = asyncio.create_task(
+            self._runService(equipmentModuleName, duration, fails))
+
+    async def completePhase(self, equipmentModuleName: str):
+        """Take a module in complete or aborted state back to idle (gateway method CompletarFase).
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+        """
+        if (self._states[equipmentModuleName] in (STATE_COMPLETE, STATE_ABORTED)):
+            await self._setVariable(equipmentModuleName, "ServicioActual", 0)
+            await self._setVariable(equipmentModuleName, "EstadoActual", STATE_IDLE)
+
+    async def resetModule(self, equipmentModuleName: str):
+        """Take a module back to idle, stopping its service if running (gateway method ResetModulo).
+
+        Args:
+            equipmentModuleName (str): Name of the module.
+        """
+        self._cancelService(equipmentModuleName)
+        self._resets = self._resets + 1
+        await self._setVariable(equipmentModuleName, "ServicioActual", 0)
+        await self._setVariable(equipmentModuleName, "EstadoActual", STATE_IDLE)
+
+    async def abortModules(self):
+        """Abort the services of all running modules (gateway method AbortarModulos).
+        """
+        self._aborts = self._aborts + 1
+        for equipmentModuleName, state in self._states.items():
+            if (state == STATE_RUNNING):
+                self._cancelService(equipmentModuleName)
+                await self._setVariable(equipmentModuleName, "EstadoActual", STATE_ABORTED)
+
+    def getStats(self):
+        """Get simulation metrics.
+
+        Returns:
+            Dict: {"plantTime": Plant time since start (s),
+                   "phasesStarted": Services started,
+                   "phasesCompleted": Services that reached complete state,
+                   "faults": Services that ended in aborted state by a fault,
+                   "aborts": Calls to abortModules(),
+                   "resets": Calls to resetModule()}
+        """
+        return {
+            "plantTime": self.clock.time(),
+            "phasesStarted": self._phasesStarted,
+            "phasesCompleted": self._phasesCompleted,
+            "faults": self._faults,
+            "aborts": self._aborts,
+            "resets": self._resets
+        }
+
+    def __init__(self, clock: VirtualClock = None, modules: list = EQUIPMENT_MODULES, durations: dict = SERVICE_DURATIONS,
+                 faultProbability: float = 0, seed: int = 0):
+        """Constructor.
+
+        Args:
+            clock (VirtualClock, optional): Clock of the plant. Defaults to None, a new one at SIMULATION_SPEED.
+            modules (list, optional): Names of the equipment modules. Defaults to EQUIPMENT_MODULES.
+            durations (dict, optional): Seconds each service takes, by description. Defaults to SERVICE_DURATIONS.
+            faultProbability (float, optional): Probability of a service failing. Defaults to 0.
+            seed (int, optional): Seed of the random faults. Defaults to 0.
+        """
+        self.clock = clock if (clock != None) else VirtualClock()
+        self._logger = logging.getLogger("PlantSimulator")
+        self._services = SIMULATED_SERVICES
+        self._durations = durations
+        self._faultProbability = faultProbability
+        self._random = random.Random(seed)
+        self._listeners = []
+
+        self._states = {module: STATE_IDLE for module in modules}
+        self._currentServices = {module: 0 for module in modules}
+        # Task running the service of each module
+        self._tasks = {}
+        # Modules that will fail their next service, with the service number or None for any
+        self._injectedFaults = {}
+
+        # Metrics
+        self._phasesStarted = 0
+        self._phasesCompleted = 0
+        self._faults = 0
+        self._aborts = 0
+        self._resets = 0
+
+    def _takeFault(self, equipmentModuleName: str, numSrv: int):
+        """Decide if a service that is starting will fail.
+
+        Returns:
+            bool: True if it fails.
+        """
+        if (equipmentModuleName in self._injectedFaults):
+            faultService = self._injectedFaults[equipmentModuleName]
+            if ((faultService == None) or (faultService == numSrv)):
+                del self._injectedFaults[equipmentModuleName]
+                return True
+        # Draw for every service, so faults don't depend on injected ones
+        return self._random.random() < self._faultProbability
+
+    async def _runService(self, equipmentModuleName: str, duration: float, fails: bool):
+        if (fails):
+            await self.clock.sleep(duration / 2)
+            self._faults = self._faults + 1
+            self._logger.debug("Fault in %s." % equipmentModuleName)
+            await self._setVariable(equipmentModuleName, "EstadoActual", STATE_ABORTED)
+        else:
+            await self.clock.sleep(duration)
+            self._phasesCompleted = self._phasesCompleted + 1
+            await self._setVariable(equipmentModuleName, "EstadoActual", STATE_COMPLETE)
+        self._tasks.pop(equipmentModuleName, None)
+
+    def _cancelService(self, equipmentModuleName: str):
+        task = self._tasks.pop(equipmentModuleName, None)
+        if (task != None):
+            task.cancel()
+
+    async def _setVariable(self, equipmentModuleName: str, variableName: str, value: int):
+        if (variableName == "EstadoActual"):
+            self._states[equipmentModuleName] = value
+        else:
+            self._currentServices[equipmentModuleName] = value
+        for fnChanged in self._listeners:
+            await fnChanged(equipmentModuleName, variableName, value)
+
+
+class SimulatedOpcuaClient:
+    """Stands in for OpcuaClient, running phases on a PlantSimulator instead of the plant.
+    Same interface and events as OpcuaClient: changes in the subscribed variables are sent as
+    "receivedData" events and {"opcuaEvent": "completedPhases"} once all phases launched together are done.
+    """
+
+    async def start(self, eventHandler: any):
+        """Start the client.
+
+        Args:
+            eventHandler (any): Event handler that will react to changes in subscribed variables.
+            Must have method:
+                async eventHandler.handleEvent(event: dict)
+        """
+        if (not self._started):
+            self._eventHandler = eventHandler
+            if (self._servicesFromDatabase):
+                try:
+                    await self.simulator.loadServicesFromDatabase()
+                except Exception as e:
+                    self._logger.warning("Could not load services from database (%s), using default ones." % e)
+                self._servicesFromDatabase = False
+            self.simulator.addListener(self._onDataChange)
+            asyncio.create_task(self._eventHandler.handleEvent({"opcuaEvent": "started"}))
+            self._started = True
+
+    async def stop(self):
+        """Cancel running phases.
+        """
+        if (self._runningTask != None):
+            self._runningTask.cancel()
+
+    async def startEquipmentPhases(self, phases: list[dict]):
+        """Create task to run specified phases.
+        Task will be cancelled when calling abortAllPhases().
+        On task completion, event {"opcuaEvent": "completedPhases"} will be sent.
+
+        Args:
+            phases (list[Dict]): Phases to launch, for example:
+                [
+                {"me": "ME_BASES", "numSrv": 4, "setpoint": None},
+                {"me": "ME_TRANSPORTE", "numSrv": 5, "setpoint": 2},
+                ...]
+        """
+        self._runningTask = asyncio.create_task(
+            self._executeSeveralPhases(phases=phases))
+
+    async def abortAllPhases(self):
+        """Cancel the startEquipmentPhases task and abort all equipment modules,
+        then reset aborted modules to idle state.
+
+        Returns:
+            Dict: Result of each module, see OpcuaClient.abortAllPhases(). Times are plant times.
+        """
+        start = self.simulator.clock.time()
+        if (self._runningTask != None):
+            self._runningTask.cancel()
+        await self.simulator.clock.sleep(SIMULATED_CALL_LATENCY)
+        await self.simulator.abortModules()
+        results = await asyncio.gather(
+            *[self._resetModule(module, start, onlyIfAborted=True) for module in self.simulator.getModules()])
+        return dict(zip(self.simulator.getModules(), results))
+
+    async def resetAllModules(self):
+        """Reset modules from aborted or completed state to idle state.
+
+        Returns:
+            Dict: Result of each module, see OpcuaClient.resetAllModules(). Times are plant times.
+        """
+        start = self.simulator.clock.time()
+        results = await asyncio.gather(
+            *[self._resetModule(module, start, onlyIfAborted=False) for module in self.simulator.getModules()])
+        return dict(zip(self.simulator.getModules(), results))
+
+    async def mockReceivedData(self, data: dict):
+        """Generate a mock event of data being received.
+
+        Args:
+            data (dict): Data, such as:
+                {"data": {"me" : "ME_BASES", "var" : "EstadoActual", "value" : 3} }
+        """
+        event = {"opcuaEvent": "receivedData"}
+        event.update(data)
+        await self._eventHandler.handleEvent(event)
+
+    def getStats(self):
+        """Get simulation metrics, see PlantSimulator.getStats().
+
+        Returns:
+            Dict: Metrics.
+        """
+        return self.simulator.getStats()
+
+    def __init__(self, simulator: PlantSimulator = None, servicesFromDatabase: bool = False):
+        """Constructor.
+
+        Args:
+            simulator (PlantSimulator, optional): Simulated plant. Defaults to None, a new one.
+            servicesFromDatabase (bool, optional): Load the services of the modules from the database
+                when starting. Defaults to False.
+        """
+        self.simulator = simulator if (simulator != None) else PlantSimulator()
+        self._servicesFromDatabase = servicesFromDatabase
+        self._eventHandler = None
+        self._runningTask = None
+        self._started = False
+        self._logger = logging.getLogger("SimulatedOpcuaClient")
+        self._stateChanged = asyncio.Condition()
+
+    async def _callMethod(self, fnMethod, *args):
+        """Call a method of the simulated gateway, after the latency of a call.
+        """
+        await self.simulator.clock.sleep(SIMULATED_CALL_LATENCY)
+        await fnMethod(*args)
+
+    async def _resetModule(self, equipmentModuleName: str, start: float, onlyIfAborted: bool):
+        state = self.simulator.getState(equipmentModuleName)
+        result = {"state": state, "reset": False, "time": None, "error": None}
+        if ((state == STATE_ABORTED) or ((not onlyIfAborted) and (state != STATE_IDLE))):
+            await self._callMethod(self.simulator.resetModule, equipmentModuleName)
+            result["state"] = self.simulator.getState(equipmentModuleName)
+            result["reset"] = True
+        result["time"] = self.simulator.clock.time() - start
+        return result
+
+    async def _executeSeveralPhases(self, phases: list[dict]):
+        """Launch several phases in parallel.
+        Sends event when done:
+            {"opcuaEvent": "completedPhases"}
+        """
+        self._logger.debug("Launching phases %s." % phases)
+        try:
+            await asyncio.gather(*[self._executeOnePhase(phase) for phase in phases])
+            self._logger.debug("Phase execution completed.")
+            await self._eventHandler.handleEvent({"opcuaEvent": "completedPhases"})
+        except asyncio.CancelledError:
+            self._logger.debug("Phase execution cancelled.")
+
+    async def _executeOnePhase(self, phase: dict):
+        """Start a phase and, once it is complete, send the module back to idle state.
+        """
+        module = phase["me"]
+        setpoint = phase.get("setpoint")
+        if (setpoint == None):
+            setpoint = 0
+
+        if (self.simulator.getState(module) in (STATE_COMPLETE, STATE_ABORTED)):
+            self._logger.debug(f"Trying to launch {module} but it is in state {self.simulator.getState(module)}, resetting.")
+            await self._callMethod(self.simulator.completePhase, module)
+        await self._callMethod(self.simulator.startPhase, module, phase["numSrv"], setpoint)
+        await self._waitForModuleState(module, STATE_COMPLETE)
+        self._logger.debug("%s phase completed, resetting" % module)
+        await self._callMethod(self.simulator.completePhase, module)
+
+    async def _waitForModuleState(self, equipmentModuleName: str, state: int):
+        async with self._stateChanged:
+            await self._stateChanged.wait_for(lambda: self.simulator.getState(equipmentModuleName) == state)
+
+    async def _onDataChange(self, equipmentModuleName: str, variableName: str, value: int):
+        """Listener of the simulator, wakes up phases waiting for a state and sends
+        changes in subscribed variables to the event handler.
+        """
+        async with self._stateChanged:
+            self._stateChanged.notify_all()
+        if (variableName in SUBSCRIBED_VARIABLES):
+            event = {"opcuaEvent": "receivedData"}
+            event["data"] = {"me": equipmentModuleName, "var": variableName, "value": value}
+            asyncio.create_task(self._eventHandler.handleEvent(event))
@@ -0,0 +1,406 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+from controlrecipestorer import ControlRecipeStorer
+from mysql.connector.errors import InterfaceError, OperationalError
+from mysqlclient import mysqlTestConnection
+
+# Records kept in memory waiting to be written. Records logged while it is full are dropped
+QUEUE_SIZE = 10000
+# Maximum number of records written in one batch
+BATCH_SIZE = 100
+# File records are spilled to while the database can't be reached
+SPILL_FILE = "productionlog.spill"
+# Seconds between attempts to reach the database while it is down
+RECONNECT_INTERVAL = 5
+# Seconds records are gathered in memory before being spilled together while the database is down
+SPILL_INTERVAL = 1
+# Database IDs of the last control recipes logged, kept to resolve their produced amounts and alarms
+RECIPE_IDS_KEPT = 100
+# Errors meaning the database can't be reached. Records failing with other errors are discarded
+CONNECTION_ERRORS = (OSError, TimeoutError, InterfaceError, OperationalError)
+
+
+class ProductionLogger:
+    """Write-behind logger of control recipes, their produced amounts and alarms.
+
+    Records are put in a bounded in-memory queue and written to the database by a background task,
+    so production and emergency stops never wait for mysql. The writer takes the pending records in
+    batches: new control recipes are stored first, then the produced amounts, coalesced to the latest
+    value of each recipe, and the alarms, all in one round trip.
+
+    While the database can't be reached records are appended to a spill file, in the same order
+    they were logged, and replayed from it once the database is back. A spill file left by a
+    previous run is replayed when the logger starts. The spill file is written and read from a
+    thread, every spillInterval seconds, so the event loop never waits for the disk.
+
+    Errors in the writer are logged and it carries on after reconnectInterval seconds; records it
+    couldn't spill are kept in memory.
+    """
+
+    def logNewControlRecipe(self, masterRecipeName: str, username: str, paramValues: dict):
+        """Log a new control recipe.
+
+        Args:
+            masterRecipeName (str): Master recipe it is based on
+            username (str): Username of person who executed the control recipe
+            paramValues (dict): Value of each parameter {"PARAM_1_NAME" : Value, ...}
+
+        Returns:
+            str: Key of the control recipe, to log its produced amount and alarms.
+        """
+        recipeKey = uuid.uuid4().hex
+        self._enqueue({
+            "type": "controlRecipe",
+            "recipe": recipeKey,
+            "masterRecipe": masterRecipeName,
+            "user": username,
+            "parameters": dict(paramValues),
+            "time": _now()
+        })
+        return recipeKey
+
+    def logProducedAmount(self, recipeKey: str, amount: int):
+        """Log the produced amount of a control recipe. Replaces any amount of the
+        same recipe that hasn't been written yet.
+
+        Args:
+            recipeKey (str): Key returned by logNewControlRecipe().
+            amount (int): New value for produced amount.
+        """
+        pending = self._pendingAmounts.get(recipeKey)
+        if (pending != None):
+            pending["amount"] = amount
+            self._coalesced = self._coalesced + 1
+            return
+        record = {"type": "producedAmount", "recipe": recipeKey, "amount": amount}
+        if (self._enqueue(record)):
+            self._pendingAmounts[recipeKey] = record
+
+    def logAlarm(self, recipeKey: str, description: str):
+        """Log an alarm of a control recipe.
+
+        Args:
+            recipeKey (str): Key returned by logNewControlRecipe().
+            description (str): Description of the alarm.
+        """
+        self._enqueue({"type": "alarm", "recipe": recipeKey, "description": description, "time": _now()})
+
+    async def start(self):
+        """Launch the writer, which first replays the spill file if there is one.
+        """
+        self._startWriter()
+
+    async def flush(self):
+        """Wait until every record logged so far has been written to the database or spilled.
+        """
+        if (not self._idle.is_set()):
+            self._startWriter()
+        await self._idle.wait()
+
+    async def stop(self):
+        """Flush and stop the writer.
+        """
+        if (self._writerTask != None):
+            await self.flush()
+            self._writerTask.cancel()
+            self._writerTask = None
+
+    def getStats(self):
+        """Get logger metrics.
+
+        Returns:
+            Dict: Metrics:
+                {
+                    "queued": Records waiting to be written,
+                    "written": Records written to the database,
+                    "batches": Batches written,
+                    "coalesced": Produced amounts replaced by a later one before being written,
+                    "spilled": Records spilled to the file,
+                    "replayed": Records written from the spill file,
+                    "dropped": Records lost because the queue was full,
+                    "discarded": Records rejected by the database,
+                    "databaseDown": Whether records are being spilled
+                }
+        """
+        return {
+            "queued": len(self._queue),
+            "written": self._written,
+            "batches": self._batches,
+            "coalesced": self._coalesced,
+            "spilled": self._spilled,
+            "replayed": self._replayed,
+            "dropped": self._dropped,
+            "discarded": self._discarded,
+            "databaseDown": self._databaseDown
+        }
+
+    def __init__(self, spillFile: str = SPILL_FILE, queueSize: int = QUEUE_SIZE, batchSize: int = BATCH_SIZE,
+                 reconnectInterval: float = RECONNECT_INTERVAL, spillInterval: float = SPILL_INTERVAL):
+        """Constructor. The writer is started by start(), or when the first record is logged.
+
+        Args:
+            spillFile (str, optional): File records are spilled to. Defaults to SPILL_FILE.
+            queueSize (int, optional): Records kept in memory. Defaults to QUEUE_SIZE.
+            batchSize (int, optional): Maximum number of records written together. Defaults to BATCH_SIZE.
+            reconnectInterval (float, optional): Seconds between attempts to reach the database while it is down.
+                Defaults to RECONNECT_INTERVAL.
+            spillInterval (float, optional): Seconds records are gathered before being spilled while the database is down.
+                Defaults to SPILL_INTERVAL.
+        """
+        self._spillFile = spillFile
+        self._queueSize = queueSize
+        self._batchSize = batchSize
+        self._reconnectInterval = reconnectInterval
+        self._spillInterval = spillInterval
+        self._storer = ControlRecipeStorer()
+        self._logger = logging.getLogger("ProductionLogger")
+
+        self._queue = collections.deque()
+        # Produced amount records still in the queue, by recipe key, to coalesce new amounts into them
+        self._pendingAmounts = {}
+        # Database ID of each control recipe, by recipe key
+        self._controlRecipeIDs = collections.OrderedDict()
+        self._writerTask = None
+        self._databaseDown = False
+        # Last attempt to write the spill file failed
+        self._spillFailing = False
+        # Set when there is nothing left to write
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Set when a record is logged
+        self._wakeUp = asyncio.Event()
+
+        # Metrics
+        self._written = 0
+        self._batches = 0
+        self._coalesced = 0
+        self._spilled = 0
+        self._replayed = 0
+        self._dropped = 0
+        self._discarded = 0
+
+    def _enqueue(self, record: dict):
+        """Put a record in the queue and wake up the writer.
+
+        Returns:
+            bool: False if the queue was full and the record was dropped.
+        """
+        if (len(self._queue) >= self._queueSize):
+            self._dropped = self._dropped + 1
+            self._logger.error("Queue full, dropped %s record." % record["type"])
+            return False
+        self._queue.append(record)
+        self._idle.clear()
+        self._wakeUp.set()
+        self._startWriter()
+        return True
+
+    def _takeRecords(self, count: int):
+        """Take up to count records from the queue. Produced amounts taken can't be coalesced anymore.
+        """
+        records = []
+        while (self._queue and (len(records) < count)):
+            record = self._queue.popleft()
+            if ((record["type"] == "producedAmount") and (self._pendingAmounts.get(record["recipe"]) is record)):
+                del self._pendingAmounts[record["recipe"]]
+            records.append(record)
+        return records
+
+    def _startWriter(self):
+        """Launch the writer if it isn't running.
+        """
+        if ((self._writerTask == None) or self._writerTask.done()):
+            if (os.path.exists(self._spillFile)):
+                self._idle.clear()
+            self._writerTask = asyncio.create_task(self._writeLoop())
+
+    async def _writeLoop(self):
+        """Loops forever writing the spill file, if any, and then the queue.
+        """
+        while True:
+            try:
+                if (self._databaseDown):
+                    await self._waitForDatabase()
+                elif (os.path.exists(self._spillFile)):
+                    await self._replaySpillFile()
+                elif (self._queue):
+                    records = self._takeRecords(self._batchSize)
+                    if (not await self._writeRecords(records)):
+                        await self._spill(records + self._takeRecords(len(self._queue)))
+                else:
+                    self._idle.set()
+                    self._wakeUp.clear()
+                    await self._wakeUp.wait()
+            except Exception:
+                # Records not written are still in the queue or the spill file
+                self._logger.exception("Writer failed, retrying in %s s." % self._reconnectInterval)
+                await asyncio.sleep(self._reconnectInterval)
+
+    async def _writeRecords(self, records: list):
+        """Write records to the database, in order. Marks the database as down on connection errors.
+        Records of control recipes that couldn't be stored are discarded.
+
+        Returns:
+            bool: False if the database couldn't be reached. Records not written must be spilled.
+        """
+        discardedBefore = self._discarded
+        try:
+            producedAmounts = {}
+            alarms = []
+            for record in records:
+                if (record["type"] == "controlRecipe"):
+                    if (record["recipe"] in self._controlRecipeIDs):
+                        # Already stored before a failure
+                        continue
+                    try:
+                        controlRecipeID = await self._storer.storeNewControlRecipe(
+                            masterRecipeName=record["masterRecipe"],
+                            username=record["user"],
+                            paramValues=record["parameters"],
+                            creationTime=record["time"])
+                    except ValueError as e:
+                        self._discarded = self._discarded + 1
+                        self._logger.error("Discarded control recipe: %s" % e)
+                        continue
+                    self._rememberControlRecipe(record["recipe"], controlRecipeID)
+                    continue
+                controlRecipeID = self._resolveControlRecipe(record)
+                if (controlRecipeID == None):
+                    self._discarded = self._discarded + 1
+                    self._logger.warning("Discarded %s record of unknown control recipe." % record["type"])
+                elif (record["type"] == "producedAmount"):
+                    if (controlRecipeID in producedAmounts):
+                        self._coalesced = self._coalesced + 1
+                    producedAmounts[controlRecipeID] = record["amount"]
+                else:
+                    alarms.append((controlRecipeID, record["description"], record["time"]))
+            await self._storer.storeRecipeUpdates(producedAmounts, alarms)
+        except CONNECTION_ERRORS as e:
+            self._databaseDown = True
+            self._logger.warning("Database unreachable, spilling records to %s: %s" % (self._spillFile, e))
+            return False
+        except Exception:
+            self._discarded = self._discarded + len(records)
+            self._logger.exception("Discarded batch of %d records." % len(records))
+            return True
+        self._written = self._written + len(records) - (self._discarded - discardedBefore)
+        self._batches = self._batches + 1
+        return True
+
+    def _rememberControlRecipe(self, recipeKey: str, controlRecipeID: int):
+        self._controlRecipeIDs[recipeKey] = controlRecipeID
+        if (len(self._controlRecipeIDs) > RECIPE_IDS_KEPT):
+            self._controlRecipeIDs.popitem(last=False)
+
+    def _resolveControlRecipe(self, record: dict):
+        """Get the database ID of the control recipe of a record, None if unknown.
+        """
+        if ("controlRecipeID" in record):
+            return record["controlRecipeID"]
+        return self._controlRecipeIDs.get(record["recipe"])
+
+    def _serialize(self, records: list):
+        """Lines of the spill file for records not written yet, with the database ID of
+        their control recipe if it is already stored.
+        """
+        lines = []
+        for record in records:
+            controlRecipeID = self._resolveControlRecipe(record)
+            if (record["type"] == "controlRecipe"):
+                if (controlRecipeID != None):
+                    continue
+            elif (controlRecipeID != None):
+                record = dict(record, controlRecipeID=controlRecipeID)
+            lines.append(json.dumps(record) + "\n")
+        return lines
+
+    async def _spill(self, records: list):
+        """Append records to the spill file. If it can't be written the records are put
+        back in the queue, to be spilled or written later.
+        """
+        lines = self._serialize(records)
+        if (len(lines) == 0):
+            return
+        try:
+            await asyncio.to_thread(_writeLines, self._spillFile, lines, append=True)
+        except OSError as e:
+            # Logged once, it is tried again every spillInterval
+            if (not self._spillFailing):
+                self._logger.error("Could not write %s, keeping records in memory: %s" % (self._spillFile, e))
+            self._spillFailing = True
+            self._queue.extendleft(reversed(records))
+            return
+        self._spillFailing = False
+        self._spilled = self._spilled + len(lines)
+
+    def _readSpillFile(self):
+        """Read the records of the spill file, skipping a torn or unreadable line. Runs in a thread.
+        """
+        records = []
+        with open(self._spillFile, "rb") as file:
+            for line in file:
+                try:
+                    # Also raises ValueError (UnicodeDecodeError) if the line isn't utf-8
+                    records.append(json.loads(line))
+                except ValueError:
+                    self._logger.warning("Skipped unreadable line of %s." % self._spillFile)
+        return records
+
+    async def _replaySpillFile(self):
+        """Write the records of the spill file. If the database goes down again the
+        records not written yet are kept in the file.
+        """
+        records = await asyncio.to_thread(self._readSpillFile)
+        self._logger.info("Replaying %d records from %s." % (len(records), self._spillFile))
+        for start in range(0, len(records), self._batchSize):
+            batch = records[start:start + self._batchSize]
+            if (not await self._writeRecords(batch)):
+                temporaryFile = self._spillFile + ".tmp"
+                await asyncio.to_thread(_writeLines, temporaryFile, self._serialize(records[start:]))
+                await asyncio.to_thread(os.replace, temporaryFile, self._spillFile)
+                return
+            self._replayed = self._replayed + len(batch)
+        await asyncio.to_thread(os.remove, self._spillFile)
+
+    async def _waitForDatabase(self):
+        """Spill the records logged, every spillInterval seconds, until the database can be reached again.
+        """
+        nextAttempt = time.monotonic() + self._reconnectInterval
+        while True:
+            await self._spill(self._takeRecords(len(self._queue)))
+            if (not self._queue):
+                self._idle.set()
+            await asyncio.sleep(max(0, min(self._spillInterval, nextAttempt - time.monotonic())))
+            if (time.monotonic() < nextAttempt):
+                continue
+            try:
+                await mysqlTestConnection()
+            except Exception:
+                nextAttempt = time.monotonic() + self._reconnectInterval
+                continue
+            self._logger.info("Database reachable again.")
+            self._databaseDown = False
+            self._idle.clear()
+            return
+
+
+def _writeLines(path: str, lines: list, append: bool = False):
+    """Write lines to a file and force them to disk. Blocks, run it in a thread.
+    """
+    with open(path, "a" if append else "w", encoding="utf-8") as file:
+        file.writelines(lines)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _now():
+    """Current time in the format of mysql DATETIME columns.
+    """
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+
+from mysqlclient import mysqlMultipleQueries
+
+# Seconds the reference data is used before being queried again
+REFERENCE_DATA_TTL = 60
+# Minimum seconds between reloads caused by looking up a name that isn't loaded,
+# so that repeated lookups of a wrong name don't query the database every time
+MISS_RELOAD_INTERVAL = 5
+
+
+class ReferenceDataCache:
+    """In-process cache of the small tables that map names to database IDs: usuarios,
+    recetas_maestras and parametros.
+
+    All tables are loaded together in one round trip, and reloaded when they are older than
+    ttl or after invalidate() is called. Looking up a name that isn't loaded also reloads them
+    (at most every MISS_RELOAD_INTERVAL seconds), so rows added to the database are found
+    without waiting for the ttl.
+
+    Use getReferenceData() to get the instance shared by the whole process.
+    """
+
+    async def getUsers(self):
+        """Get the names of all users.
+
+        Returns:
+            List[str]: List of users, sorted by ID.
+        """
+        await self._reloadIfStale()
+        return list(self._userIDs)
+
+    async def getUserID(self, username: str):
+        """Get the ID of a user (mysql column "id_usuario").
+
+        Returns:
+            int: ID, None if the user doesn't exist.
+        """
+        return await self._lookUp(lambda: self._userIDs.get(username))
+
+    async def getMasterRecipeID(self, masterRecipeName: str):
+        """Get the ID of a master recipe (mysql column "id_receta_maestra").
+
+        Returns:
+            int: ID, None if the master recipe doesn't exist.
+        """
+        return await self._lookUp(lambda: self._masterRecipeIDs.get(masterRecipeName))
+
+    async def getParameterIDs(self, masterRecipeName: str, paramNames: list[str]):
+        """Get the IDs of parameters of a master recipe (mysql column "id_parametro").
+
+        Returns:
+            Dict: {"PARAM_1_NAME": ID, ...}. Parameters that don't exist are left out.
+        """
+        def isLoaded():
+            recipeParameters = self._parameterIDs.get(masterRecipeName, {})
+            return True if all([name in recipeParameters for name in paramNames]) else None
+        await self._lookUp(isLoaded)
+        recipeParameters = self._parameterIDs.get(masterRecipeName, {})
+        return {name: recipeParameters[name] for name in paramNames if name in recipeParameters}
+
+    def invalidate(self):
+        """Reload the tables on the next lookup. If they are being loaded now, they are loaded
+        again on the next lookup, as what is being read may be older than the invalidation.
+        """
+        self._invalidations = self._invalidations + 1
+        self._loadedAt = None
+
+    def getCacheStats(self):
+        """Get counters of the cache.
+
+        Returns:
+            Dict: {"hits": Lookups answered without querying the database,
+                   "misses": Lookups of names that weren't loaded,
+                   "reloads": Times the tables were queried}
+        """
+        return {
+            "hits": self._cacheHits,
+            "misses": self._cacheMisses,
+            "reloads": self._reloads
+        }
+
+    def __init__(self, ttl: float = REFERENCE_DATA_TTL):
+        """Constructor. Nothing is queried until the first lookup.
+
+        Args:
+            ttl (float, optional): Seconds the data is used before being queried again. Defaults to REFERENCE_DATA_TTL.
+        """
+        self._ttl = ttl
+        self._userIDs = dict()
+        self._masterRecipeIDs = dict()
+        # {"RECIPE_1": {"PARAM_1_NAME": ID, ...}, ...}
+        self._parameterIDs = dict()
+        # time.monotonic() of the last load, None if it has to be reloaded
+        self._loadedAt = None
+        # Times invalidate() was called, to know if it was called during a load
+        self._invalidations = 0
+        self._lock = asyncio.Lock()
+        self._cacheHits = 0
+        self._cacheMisses = 0
+        self._reloads = 0
+        self._logger = logging.getLogger("ReferenceDataCache")
+
+    async def _lookUp(self, lookUp):
+        """Run lookUp on the loaded data, reloading it once if lookUp returns None (name not loaded).
+        """
+        await self._reloadIfStale()
+        value = lookUp()
+        if (value != None):
+            self._cacheHits = self._cacheHits + 1
+            return value
+        self._cacheMisses = self._cacheMisses + 1
+        if ((self._loadedAt == None) or ((time.monotonic() - self._loadedAt) >= MISS_RELOAD_INTERVAL)):
+            self.invalidate()
+            await self._reloadIfStale()
+            value = lookUp()
+        return value
+
+    async def _reloadIfStale(self):
+        """Query the tables if they were never loaded, invalidated or are older than ttl.
+        Concurrent callers wait for a single query. Sql client will raise error on timeout or conection error.
+        """
+        if ((self._loadedAt != None) and ((time.monotonic() - self._loadedAt) < self._ttl)):
+            return
+        async with self._lock:
+            if ((self._loadedAt != None) and ((time.monotonic() - self._loadedAt) < self._ttl)):
+                return
+            invalidations = self._invalidations
+            usersRows, recipesRows, parametersRows = await mysqlMultipleQueries(
+                """
+                SELECT id_usuario, nombre
+                FROM usuarios
+                ORDER BY id_usuario;
+
+                SELECT id_receta_maestra, codigo_receta_maestra
+                FROM recetas_maestras;
+
+                SELECT recetas_maestras.codigo_receta_maestra, parametros.nombre, parametros.id_parametro
+                FROM parametros
+                INNER JOIN recetas_maestras
+                    ON parametros.id_receta_maestra = recetas_maestras.id_receta_maestra;
+                """
+            )
+            self._userIDs = {name: userID for (userID, name) in usersRows}
+            self._masterRecipeIDs = {name: recipeID for (recipeID, name) in recipesRows}
+            parameterIDs = dict()
+            for recipeName, paramName, paramID in parametersRows:
+                parameterIDs.setdefault(recipeName, dict())[paramName] = paramID
+            self._parameterIDs = parameterIDs
+            # Data is used anyway, but only kept as fresh if invalidate() wasn't called while querying
+            if (self._invalidations == invalidations):
+                self._loadedAt = time.monotonic()
+            self._reloads = self._reloads + 1
+            self._logger.debug("Loaded %d users, %d master recipes and %d parameters." % (
+                len(usersRows), len(recipesRows), len(parametersRows)))
+
+
+# Process-wide cache
+_referenceData = None
+
+
+def getReferenceData():
+    """Get the reference data cache shared by the whole process, creating it if needed.
+
+    Returns:
+        ReferenceDataCache: Cache.
+    """
+    global _referenceData
+    if (_referenceData == None):
+        _referenceData = ReferenceDataCache()
+    return _referenceData
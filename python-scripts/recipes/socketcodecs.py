@@ -0,0 +1,173 @@
+import asyncio
+import json
+
+# Optional fast serializers. Their codecs are only available if installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_JSON = "json"  # Line delimited json, the default
+CODEC_ORJSON = "orjson"  # Length-prefixed frames with json encoded by orjson
+CODEC_MSGPACK = "msgpack"  # Length-prefixed frames with MessagePack
+# Bytes of the big-endian length before each frame
+FRAME_HEADER_SIZE = 4
+# Frames announcing a bigger payload are treated as a broken connection
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class LineJsonCodec:
+    """Dictionaries serialized as json, encoded as text and ended by an End Of Message marker.
+    The marker can't appear inside a message.
+    """
+
+    def encode(self, message: dict):
+        """Encode a message into a frame.
+
+        Args:
+            message (dict): Message.
+
+        Returns:
+            bytes: Frame.
+        """
+        return (json.dumps(message) + self._EOM).encode(self._encoding)
+
+    def decode(self, frame: bytes):
+        """Decode a frame read by readFrame().
+
+        Args:
+            frame (bytes): Frame.
+
+        Returns:
+            any: Decoded message.
+        """
+        return json.loads(frame.decode(self._encoding).removesuffix(self._EOM))
+
+    async def readFrame(self, reader: asyncio.StreamReader):
+        """Read one frame.
+
+        Args:
+            reader (asyncio.StreamReader): Stream to read from.
+
+        Raises:
+            asyncio.IncompleteReadError: Connection ended.
+            asyncio.LimitOverrunError: Frame bigger than the reader's limit.
+
+        Returns:
+            bytes: Frame.
+        """
+        return await reader.readuntil(self._EOMEncoded)
+
+    def __init__(self, EOM="\r\n", encoding="utf-8"):
+        """Constructor.
+
+        Args:
+            EOM (str, optional): Marks the End Of Message. Defaults to "\\r\\n".
+            encoding (str, optional): Byte encoding. Defaults to "utf-8".
+        """
+        self.name = CODEC_JSON
+        self._EOM = EOM
+        self._encoding = encoding
+        self._EOMEncoded = EOM.encode(encoding)
+
+
+class LengthPrefixedCodec:
+    """Dictionaries serialized to bytes, each frame preceded by its length.
+    No marker has to be searched for, and payloads may contain any byte.
+    """
+
+    def encode(self, message: dict):
+        """Encode a message into a frame.
+
+        Args:
+            message (dict): Message.
+
+        Returns:
+            bytes: Frame.
+        """
+        payload = self._fnDumps(message)
+        return len(payload).to_bytes(FRAME_HEADER_SIZE, "big") + payload
+
+    def decode(self, frame: bytes):
+        """Decode a frame read by readFrame().
+
+        Args:
+            frame (bytes): Frame, without the length.
+
+        Returns:
+            any: Decoded message.
+        """
+        return self._fnLoads(frame)
+
+    async def readFrame(self, reader: asyncio.StreamReader):
+        """Read one frame.
+
+        Args:
+            reader (asyncio.StreamReader): Stream to read from.
+
+        Raises:
+            asyncio.IncompleteReadError: Connection ended.
+            ConnectionError: Frame bigger than MAX_FRAME_SIZE.
+
+        Returns:
+            bytes: Frame, without the length.
+        """
+        size = int.from_bytes(await reader.readexactly(FRAME_HEADER_SIZE), "big")
+        if (size > MAX_FRAME_SIZE):
+            raise ConnectionError("Frame of %d bytes is too big" % size)
+        return await reader.readexactly(size)
+
+    def __init__(self, name: str, fnDumps, fnLoads):
+        """Constructor.
+
+        Args:
+            name (str): Name of the codec, used in the handshake.
+            fnDumps (Callable[[dict], bytes]): Serializer.
+            fnLoads (Callable[[bytes], any]): Deserializer.
+        """
+        self.name = name
+        self._fnDumps = fnDumps
+        self._fnLoads = fnLoads
+
+
+def getAvailableCodecs():
+    """Get names of the codecs that can be used, depending on the installed serializers.
+
+    Returns:
+        List[str]: Codec names.
+    """
+    codecs = [CODEC_JSON]
+    if (orjson != None):
+        codecs.append(CODEC_ORJSON)
+    if (msgpack != None):
+        codecs.append(CODEC_MSGPACK)
+    return codecs
+
+
+def getCodec(name: str = CODEC_JSON, EOM="\r\n", encoding="utf-8"):
+    """Create a codec.
+
+    Args:
+        name (str, optional): CODEC_JSON, CODEC_ORJSON or CODEC_MSGPACK. Defaults to CODEC_JSON.
+        EOM (str, optional): End Of Message of CODEC_JSON. Defaults to "\\r\\n".
+        encoding (str, optional): Byte encoding of CODEC_JSON. Defaults to "utf-8".
+
+    Raises:
+        ValueError: Unknown codec, or its serializer is not installed.
+
+    Returns:
+        LineJsonCodec | LengthPrefixedCodec: Codec.
+    """
+    if (name not in getAvailableCodecs()):
+        raise ValueError("Codec %s is not available" % name)
+    match name:
+        case "json":
+            return LineJsonCodec(EOM=EOM, encoding=encoding)
+        case "orjson":
+            return LengthPrefixedCodec(CODEC_ORJSON, orjson.dumps, orjson.loads)
+        case "msgpack":
+            return LengthPrefixedCodec(CODEC_MSGPACK, msgpack.packb, msgpack.unpackb)